@@ -0,0 +1,77 @@
+"""
+A micro-benchmark of storing and reading final annotations, comparing the json the task html submits with the binary
+encoding of annotation_codec, each compressed as blob_store stores it. Reads are timed to the form the auto-review
+checks use (parsed objects) and to NumPy point arrays (e.g. to rasterize masks), and to the json the review UI is sent.
+Run from the repository root:
+    python -m benchmarks.annotation_encoding --annotations 1000 --blob-kb 4
+"""
+
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from benchmarks import synthetic_db
+from mturksegutils import annotation_codec, blob_store, mturk_seg_vars
+
+
+def json_to_arrays(text):
+    """
+    Parses json annotations, and converts the points of each stroke to a NumPy array
+    """
+    objects = json.loads(text)
+    for annotation in objects:
+        for stroke in annotation['strokes']:
+            stroke['points'] = np.array(stroke['points'], dtype=np.int32).reshape(-1, 2)
+    return objects
+
+
+def time_reader(name, read, blobs, codec, repeats):
+    """
+    Times decompressing and reading every blob, and prints the fastest of several runs
+    """
+    elapsed = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for blob in blobs:
+            read(blob_store.decompress(blob, codec))
+        run_elapsed = time.perf_counter() - start
+        elapsed = run_elapsed if elapsed is None else min(elapsed, run_elapsed)
+    print(f'  {name:<34} {elapsed * 1e6 / len(blobs):>8.1f} us per assignment')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares storing final annotations as json and encoded')
+    parser.add_argument('--annotations', type=int, default=1000, help='the number of assignments')
+    parser.add_argument('--blob-kb', type=int, default=4, help='the size of the annotation data of each assignment')
+    parser.add_argument('--codec', default=mturk_seg_vars.blob_compression, help="'zlib' or 'zstd'")
+    parser.add_argument('--repeats', type=int, default=3, help='the number of times each reader is run')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = [synthetic_db.build_annotation_blobs(rng, args.blob_kb)[2] for _ in range(args.annotations)]
+    encoded = [annotation_codec.encode_annotation_json(text) for text in texts]
+    if any(data is None or json.loads(annotation_codec.json_view(data)) != json.loads(text)
+           for text, data in zip(texts, encoded)):
+        raise AssertionError('The encoding did not round trip')
+
+    json_blobs = [blob_store.compress(text, args.codec) for text in texts]
+    encoded_blobs = [blob_store.compress(data, args.codec) for data in encoded]
+    print(f'Final annotations of {args.annotations} assignments, bytes per assignment:')
+    for name, values in (('json', [text.encode('utf-8') for text in texts]), ('encoded', encoded),
+                         (f'json, {args.codec}', json_blobs), (f'encoded, {args.codec}', encoded_blobs)):
+        print(f'  {name:<34} {sum(len(value) for value in values) / len(values):>8.0f}')
+
+    print('Reads, including decompression:')
+    time_reader('json -> objects', json.loads, json_blobs, args.codec, args.repeats)
+    time_reader('json -> NumPy points', json_to_arrays, json_blobs, args.codec, args.repeats)
+    time_reader('encoded -> NumPy points', annotation_codec.decode_annotations, encoded_blobs, args.codec,
+                args.repeats)
+    time_reader('encoded -> json view', annotation_codec.json_view, encoded_blobs, args.codec, args.repeats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+A micro-benchmark of parsing assignment answer XML, comparing the selective extraction in
+assignment_manager.parse_answer_data with a full xmltodict parse (how answers were parsed before), with its pull parser
+fallback on its own, and with the extraction run in a process pool. Run from the repository root:
+    python -m benchmarks.answer_parsing --answers 20 --answer-mb 4
+    python -m benchmarks.answer_parsing --answers 5000 --answer-mb 0.01
+"""
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import random
+import time
+from xml.sax.saxutils import escape
+
+from benchmarks import synthetic_db
+from mturksegutils import assignment_manager, local_mturk
+
+
+def build_answer_xml(rng, answer_mb):
+    """
+    Builds a QuestionFormAnswers XML string in the form the task html submits
+    :param rng: the random number generator
+    :param answer_mb: the approximate size of the answer, in megabytes
+    """
+    fields = synthetic_db.build_annotation_blobs(rng, blob_kb=int(answer_mb * 1024))
+    answers = ''.join(f'<Answer><QuestionIdentifier>{name}</QuestionIdentifier>'
+                      f'<FreeText>{escape(value)}</FreeText></Answer>'
+                      for name, value in zip(assignment_manager.answer_identifiers, fields))
+    return f'<?xml version="1.0" encoding="ASCII"?><QuestionFormAnswers ' \
+           f'xmlns="{local_mturk.answer_xml_namespace}">{answers}</QuestionFormAnswers>'
+
+
+def parse_with_xmltodict(answer_xml):
+    """
+    Parses an answer with a full xmltodict parse, as parse_answer_data_for_assignment did before
+    """
+    import xmltodict
+
+    answer_dict = {}
+    answer_json = xmltodict.parse(answer_xml)['QuestionFormAnswers']['Answer']
+    for a in answer_json if isinstance(answer_json, list) else [answer_json]:
+        answer_dict[a['QuestionIdentifier']] = a['FreeText']
+    return tuple(answer_dict.get(identifier) for identifier in assignment_manager.answer_identifiers)
+
+
+def time_parser(name, parse, answer_xmls, total_mb, repeats):
+    """
+    Times a parser over every answer, and prints the fastest of several runs
+    """
+    elapsed = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = parse(answer_xmls)
+        run_elapsed = time.perf_counter() - start
+        elapsed = run_elapsed if elapsed is None else min(elapsed, run_elapsed)
+    print(f'  {name}: {elapsed:.3f}s, {total_mb / elapsed:.1f} MB/s, {len(answer_xmls) / elapsed:.1f} answers/s')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the ways of parsing assignment answer XML')
+    parser.add_argument('--answers', type=int, default=20, help='the number of answers to parse')
+    parser.add_argument('--answer-mb', type=float, default=4, help='the approximate size of each answer, in megabytes')
+    parser.add_argument('--processes', type=int, default=4, help='the size of the process pool')
+    parser.add_argument('--repeats', type=int, default=3, help='the number of times each parser is run')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    answer_xmls = [build_answer_xml(rng, args.answer_mb) for _ in range(args.answers)]
+    total_mb = sum(len(answer_xml) for answer_xml in answer_xmls) / (1024 * 1024)
+    identifiers = assignment_manager.answer_identifiers
+    print(f'Parsing {len(answer_xmls)} answers ({total_mb:.1f} MB)')
+
+    baseline = time_parser('xmltodict', lambda xmls: [parse_with_xmltodict(xml) for xml in xmls], answer_xmls,
+                           total_mb, args.repeats)
+    extracted = time_parser('selective extraction',
+                            lambda xmls: [assignment_manager.parse_answer_data(xml) for xml in xmls], answer_xmls,
+                            total_mb, args.repeats)
+    pulled = time_parser('pull parser only',
+                         lambda xmls: [tuple(assignment_manager.pull_answer_xml(xml, set(identifiers)).get(identifier)
+                                             for identifier in identifiers) for xml in xmls],
+                         answer_xmls, total_mb, args.repeats)
+    time_parser('selective extraction, interaction_log only',
+                lambda xmls: [assignment_manager.parse_answer_xml(xml, ('interaction_log',)) for xml in xmls],
+                answer_xmls, total_mb, args.repeats)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes,
+                                                mp_context=multiprocessing.get_context('spawn')) as pool:
+        # Start the workers and import the package in each of them before timing, as a long sync would have
+        list(pool.map(assignment_manager.parse_answer_data, answer_xmls[:1] * args.processes))
+        pooled = time_parser(f'selective extraction in {args.processes} processes',
+                             lambda xmls: list(pool.map(assignment_manager.parse_answer_data, xmls)), answer_xmls,
+                             total_mb, args.repeats)
+
+    if extracted != baseline or pulled != baseline or pooled != baseline:
+        raise AssertionError('The selective extraction returned different answers to xmltodict')
+
+
+if __name__ == '__main__':
+    main()
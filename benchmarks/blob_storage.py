@@ -0,0 +1,106 @@
+"""
+A benchmark of the database size and the scan times of the hits table with the annotation blobs stored inline, and
+after migrations.move_blobs_out_of_row has moved them to the compressed assignment_blobs table (see
+mturksegutils.blob_store). Each query runs on a new connection, so it reads its pages through SQLite's page cache rather
+than finding them there already. Run from the repository root:
+    python -m benchmarks.blob_storage --hits 100000
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from benchmarks import synthetic_db
+from mturksegutils import migrations, mturk_seg_vars, blob_store
+
+
+def get_scans(mturk_type, exp_group):
+    """
+    :return: a list of (name, sql, params, load_blobs) tuples, one for each scan of the hits table - load_blobs is True
+    for the scans whose callers go on to read the annotation data of the rows
+    """
+    return [
+        ('status scan (SELECT *)', "SELECT * FROM hits WHERE mturk_type = ?", (mturk_type,), False),
+        ('batch summary counts', "SELECT exp_group, mturk_type, status, COUNT(*) FROM hits "
+                                 "GROUP BY exp_group, mturk_type, status", (), False),
+        ('auto_approve_* rows', "SELECT * FROM hits WHERE mturk_type = ? AND exp_group = ? AND status = 'Submitted' "
+                                "ORDER BY auto_approve_time ASC", (mturk_type, exp_group), False),
+        ('auto_approve_* + blobs', "SELECT * FROM hits WHERE mturk_type = ? AND exp_group = ? "
+                                   "AND status = 'Submitted' ORDER BY auto_approve_time ASC",
+         (mturk_type, exp_group), True),
+        ('review queue + blobs', "SELECT * FROM hits WHERE mturk_type = ? AND status = 'Submitted' "
+                                 "ORDER BY auto_approve_time ASC LIMIT 1", (mturk_type,), True),
+    ]
+
+
+def time_scan(db_path, sql, params, load_blobs, repeats):
+    """
+    :return: the fastest of several runs of a scan, in milliseconds
+    """
+    elapsed = None
+    for _ in range(repeats):
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        if load_blobs:
+            blob_store.with_blobs(cursor, rows)
+        run_elapsed = time.perf_counter() - start
+        conn.close()
+        elapsed = run_elapsed if elapsed is None else min(elapsed, run_elapsed)
+    return elapsed * 1000
+
+
+def report(db_path, scans, repeats):
+    results = {'size_mb': os.path.getsize(db_path) / 2 ** 20}
+    print(f"  {'database size':<26} {results['size_mb']:>9.1f} MB")
+    for name, sql, params, load_blobs in scans:
+        results[name] = time_scan(db_path, sql, params, load_blobs, repeats)
+        print(f'  {name:<26} {results[name]:>9.2f} ms')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the database size and scan times with the annotation blobs '
+                                                 'stored inline and out of row')
+    parser.add_argument('--hits', type=int, default=100000, help='the number of HITs in the synthetic database')
+    parser.add_argument('--blob-kb', type=int, default=4, help='the size of the annotation data of each assignment')
+    parser.add_argument('--codec', default=mturk_seg_vars.blob_compression, help="'zlib' or 'zstd'")
+    parser.add_argument('--repeats', type=int, default=5, help='the number of times each scan is run')
+    args = parser.parse_args()
+
+    mturk_seg_vars.blob_compression = args.codec
+    mturk_type, exp_group = 'production', 'bench-3'
+    scans = get_scans(mturk_type, exp_group)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, 'experiment.db')
+        synthetic_db.build_experiment_db(db_path, args.hits, mturk_type=mturk_type, exp_group=exp_group,
+                                         blob_kb=args.blob_kb, inline_blobs=True)
+        # Everything but the blobs is migrated first, so that only the blob storage differs between the two runs
+        migrations.migrate(db_path, target_version=3)
+        migrations.vacuum(db_path)
+
+        print(f'Blobs stored inline ({args.hits} HITs):')
+        before = report(db_path, scans, args.repeats)
+
+        start = time.perf_counter()
+        migrations.migrate(db_path)
+        migrated = time.perf_counter() - start
+        start = time.perf_counter()
+        migrations.vacuum(db_path)
+        print(f'Moved the blobs out of row with {args.codec} in {migrated:.2f}s, and vacuumed in '
+              f'{time.perf_counter() - start:.2f}s')
+
+        print('Blobs stored out of row:')
+        after = report(db_path, scans, args.repeats)
+
+    print('Ratio (before / after):')
+    for name in before:
+        print(f'  {name:<26} {before[name] / after[name]:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
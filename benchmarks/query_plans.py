@@ -0,0 +1,117 @@
+"""
+A benchmark of the hot queries on the hits table before and after the schema migrations (see mturksegutils.migrations),
+which prints each query's plan from EXPLAIN QUERY PLAN and its latency. Before the migrations every query below scans
+the whole table, and after them each one seeks through an index. Run from the repository root:
+    python -m benchmarks.query_plans --hits 100000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from benchmarks import synthetic_db
+from mturksegutils import migrations
+
+
+def get_hot_queries(cursor, mturk_type, exp_group):
+    """
+    :return: a list of (name, sql, params) tuples, one for each of the hot access paths of the hits table
+    """
+    cursor.execute("SELECT assignment_id FROM hits WHERE assignment_id IS NOT NULL")
+    assignment_ids = [row[0] for row in cursor.fetchall()]
+    assignment_id = random.Random(0).choice(assignment_ids)
+    return [
+        ('review queue', "SELECT * FROM hits WHERE mturk_type = ? AND status = 'Submitted' "
+                         "ORDER BY auto_approve_time ASC LIMIT 1", (mturk_type,)),
+        ('submitted HIT deadlines', "SELECT hit_id, auto_approve_time FROM hits "
+                                    "WHERE mturk_type = ? AND status = 'Submitted'", (mturk_type,)),
+        ('auto_approve_* selection', "SELECT * FROM hits WHERE mturk_type = ? AND exp_group = ? "
+                                     "AND status = 'Submitted' ORDER BY auto_approve_time ASC",
+         (mturk_type, exp_group)),
+        ('batch summary counts', "SELECT exp_group, mturk_type, status, COUNT(*) FROM hits WHERE exp_group = ? "
+                                 "GROUP BY exp_group, mturk_type, status", (exp_group,)),
+        ('approve/reject lookup', "SELECT * FROM hits WHERE assignment_id = ?", (assignment_id,)),
+    ]
+
+
+def explain(cursor, sql, params):
+    cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+    return '; '.join(row[3] for row in cursor.fetchall())
+
+
+def time_query(cursor, sql, params, repeats):
+    """
+    :return: the fastest of several runs of a query, in milliseconds
+    """
+    elapsed = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        run_elapsed = time.perf_counter() - start
+        elapsed = run_elapsed if elapsed is None else min(elapsed, run_elapsed)
+    return elapsed * 1000
+
+
+def report(cursor, queries, repeats):
+    results = {}
+    for name, sql, params in queries:
+        results[name] = (explain(cursor, sql, params), time_query(cursor, sql, params, repeats))
+        print(f'  {name:<26} {results[name][1]:>9.3f} ms  {results[name][0]}')
+    return results
+
+
+def drop_migrated_indexes(cursor):
+    """
+    Returns a freshly built database to the schema it had before the migrations, without their indexes or records
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+                   "AND name != 'hits_exp_group_image_url'")
+    for (index_name,) in cursor.fetchall():
+        cursor.execute(f"DROP INDEX {index_name}")
+    cursor.execute("DROP TABLE IF EXISTS schema_migrations")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the plans and latency of the hot queries before and after '
+                                                 'the schema migrations')
+    parser.add_argument('--hits', type=int, default=100000, help='the number of HITs in the synthetic database')
+    parser.add_argument('--blob-kb', type=int, default=4, help='the size of the annotation data of each assignment')
+    parser.add_argument('--repeats', type=int, default=5, help='the number of times each query is run')
+    args = parser.parse_args()
+
+    mturk_type, exp_group = 'production', 'bench-3'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, 'experiment.db')
+        synthetic_db.build_experiment_db(db_path, args.hits, mturk_type=mturk_type, exp_group=exp_group,
+                                         blob_kb=args.blob_kb)
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        drop_migrated_indexes(cursor)
+        conn.commit()
+        queries = get_hot_queries(cursor, mturk_type, exp_group)
+
+        print(f'Before the migrations ({args.hits} HITs):')
+        before = report(cursor, queries, args.repeats)
+        conn.close()
+
+        start = time.perf_counter()
+        applied = migrations.migrate(db_path)
+        print(f'Applied migrations {applied} in {time.perf_counter() - start:.2f}s')
+
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        print('After the migrations:')
+        after = report(cursor, queries, args.repeats)
+        conn.close()
+
+    print('Speedup:')
+    for name, _, _ in queries:
+        print(f'  {name:<26} {before[name][1] / after[name][1]:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+"""
+End-to-end benchmarks for batch posting, syncing and reviewing, run against synthetic experiment databases and a local
+MTurk stand-in (see mturksegutils.local_mturk)
+
+Each benchmark runs in its own process, so that its peak memory is measured on its own. Run from the repository root:
+    python -m benchmarks.run_benchmarks --scales 10000,100000
+    python -m benchmarks.run_benchmarks --scales 10000 --save-baseline main
+    python -m benchmarks.run_benchmarks --scales 10000 --compare main
+
+Baselines are stored as json files in benchmarks/baselines, and --compare exits with status 1 if any result is worse
+than its baseline by more than --tolerance.
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+baselines_dir = os.path.join(repo_root, 'benchmarks', 'baselines')
+
+benchmark_names = ('post_batch', 'sync', 'sync_incremental', 'next_batch', 'review_fetch')
+
+# The metrics compared against a baseline, and whether a higher value is better
+compared_metrics = {
+    'throughput': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'peak_rss_mb': False
+}
+
+
+class CallTimer:
+    """
+    Wraps an mturk client and records the latency of every call, keyed by operation name
+    """
+
+    def __init__(self, mturk):
+        self.mturk = mturk
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.mturk, name)
+        if not callable(attribute):
+            return attribute
+
+        def timed_call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.latencies.setdefault(name, []).append(elapsed)
+
+        return timed_call
+
+
+def percentile(values, fraction):
+    """
+    :return: the nearest-rank percentile of the values, or None if there are none
+    """
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def reset_peak_rss():
+    # On Linux, writing 5 to clear_refs resets the peak resident set size, so setup is not counted in the measurement
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def read_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def configure_package(args, db_path):
+    """
+    Sets the package configuration for a benchmark - this must happen before the package modules are imported, since
+    several of them copy values from mturk_seg_vars at import time
+    """
+    from mturksegutils import mturk_seg_vars
+
+    mturk_seg_vars.db_path = db_path
+    mturk_seg_vars.html_task_path = os.path.join(repo_root, 'MTurkStudy.html')
+    mturk_seg_vars.main_seg_qual_name = 'benchmark-main-seg-qual'
+    mturk_seg_vars.any_object_count_qual_name = 'benchmark-any-object-count-qual'
+    mturk_seg_vars.invite_only_qual_name = 'benchmark-invite-only-qual'
+    mturk_seg_vars.reject_feedback_empty = 'No segment annotation provided'
+    mturk_seg_vars.mturk_request_budget_enabled = False
+    mturk_seg_vars.posting_requests_per_second = 1_000_000
+    mturk_seg_vars.sync_requests_per_second = 1_000_000
+
+
+@contextlib.contextmanager
+def mturk_clients(args):
+    """
+    Sets up the production and sandbox clients for a benchmark, and registers them as the package's shared clients
+    :return: the production LocalMTurkState and a CallTimer wrapping the production client
+    """
+    from mturksegutils import local_mturk, mturk_client
+
+    state_params = {'submission_delay': None, 'keep_questions': False, 'seed': args.seed}
+    server = None
+    if args.transport == 'http':
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+        server = local_mturk.LocalMTurkServer(latency=args.latency_ms / 1000, **state_params).start()
+        local_mturk.use_local_mturk(server)
+        state = server.states['production']
+        mturk = mturk_client.get_mturk_client(sandbox=False)
+        sandbox = mturk_client.get_mturk_client(sandbox=True)
+    else:
+        state = local_mturk.LocalMTurkState(**state_params)
+        mturk = local_mturk.LocalMTurkClient(state, latency=args.latency_ms / 1000)
+        sandbox = local_mturk.LocalMTurkClient(local_mturk.LocalMTurkState(**state_params), sandbox=True)
+
+    # Code that gets its client from mturk_client.get_mturk_client, such as sync_hits_to_db, is timed as well
+    timer = CallTimer(mturk)
+    with mturk_client.mturk_clients_lock:
+        mturk_client.mturk_clients['production'] = timer
+        mturk_client.mturk_clients['sandbox'] = sandbox
+        mturk_client.mturk_clients_pid = os.getpid()
+    try:
+        yield state, timer
+    finally:
+        if server is not None:
+            server.stop()
+
+
+def run_post_batch(args, db_path):
+    """
+    Posts a batch of HITs for every task in a synthetic task_config table
+    """
+    from benchmarks import synthetic_db
+    from mturksegutils import hit_builder
+    import sqlite3
+
+    exp_group = synthetic_db.build_task_config_db(db_path, args.scale, seed=args.seed)
+    with mturk_clients(args) as (state, mturk):
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        reset_peak_rss()
+        start = time.perf_counter()
+        num_posted, failed = hit_builder.create_segmentation_batch(mturk, conn, cursor, exp_group, end_at=args.scale,
+                                                                   print_status_every_n=1000)
+        elapsed = time.perf_counter() - start
+        conn.close()
+    latencies = mturk.latencies.get('create_hit_with_hit_type', [])
+    return num_posted, elapsed, latencies, mturk.latencies
+
+
+def run_sync(args, db_path, incremental=False):
+    """
+    Runs sync_hits_to_db, in full or incremental mode, over a synthetic experiment database whose open and submitted
+    HITs exist in the stand-in
+    """
+    from benchmarks import synthetic_db
+
+    with mturk_clients(args) as (state, mturk):
+        counts = synthetic_db.build_experiment_db(db_path, args.scale, state=state, blob_kb=args.blob_kb,
+                                                  seed=args.seed)
+        from mturksegutils import assignment_manager
+        reset_peak_rss()
+        start = time.perf_counter()
+        assignment_manager.sync_hits_to_db('bench-3', incremental=incremental)
+        elapsed = time.perf_counter() - start
+    all_latencies = [latency for latencies in mturk.latencies.values() for latency in latencies]
+    return counts['Open'] + counts['Submitted'], elapsed, all_latencies, mturk.latencies
+
+
+def run_next_batch(args, db_path):
+    """
+    Pulls batches of submitted results with get_next_batch_of_submitted_results until none are left
+    """
+    from benchmarks import synthetic_db
+    import sqlite3
+
+    with mturk_clients(args) as (state, mturk):
+        synthetic_db.build_experiment_db(db_path, args.scale, state=state, blob_kb=args.blob_kb, seed=args.seed)
+        from mturksegutils import assignment_manager
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        pull_latencies = []
+        num_pulled = 0
+        reset_peak_rss()
+        start = time.perf_counter()
+        for _ in range(args.max_pulls):
+            pull_start = time.perf_counter()
+            hits, num_auto_rejected = assignment_manager.get_next_batch_of_submitted_results(mturk, conn, cursor)
+            pull_latencies.append(time.perf_counter() - pull_start)
+            if len(hits) == 0 and num_auto_rejected == 0:
+                break
+            num_pulled += len(hits) + num_auto_rejected
+        elapsed = time.perf_counter() - start
+        conn.close()
+    return num_pulled, elapsed, pull_latencies, mturk.latencies
+
+
+def run_review_fetch(args, db_path):
+    """
+    Fetches the next result to review through the review app's route, as the review UI does
+    """
+    from benchmarks import synthetic_db
+
+    with mturk_clients(args) as (state, mturk):
+        synthetic_db.build_experiment_db(db_path, args.scale, state=state, blob_kb=args.blob_kb, seed=args.seed)
+        sys.path.insert(0, os.path.join(repo_root, 'mturksegreview'))
+        import MTurkReviewFlask
+        MTurkReviewFlask.mturk = mturk
+        client = MTurkReviewFlask.app.test_client()
+        fetch_latencies = []
+        reset_peak_rss()
+        start = time.perf_counter()
+        for _ in range(args.review_requests):
+            fetch_start = time.perf_counter()
+            response = client.post('/call_get_next_result_to_review')
+            response.get_json()
+            fetch_latencies.append(time.perf_counter() - fetch_start)
+        elapsed = time.perf_counter() - start
+    return args.review_requests, elapsed, fetch_latencies, mturk.latencies
+
+
+benchmarks = {
+    'post_batch': run_post_batch,
+    'sync': run_sync,
+    'sync_incremental': lambda args, db_path: run_sync(args, db_path, incremental=True),
+    'next_batch': run_next_batch,
+    'review_fetch': run_review_fetch
+}
+
+
+def run_case(args):
+    """
+    Runs one benchmark in this process and writes its result to args.result_file
+    """
+    db_path = os.path.join(args.work_dir, f'{args.run_case}-{args.scale}.db')
+    for suffix in ('', '-wal', '-shm', '.request_budget'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    configure_package(args, db_path)
+
+    result = {'benchmark': args.run_case, 'scale': args.scale, 'transport': args.transport, 'error': None}
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            num_items, elapsed, latencies, call_latencies = benchmarks[args.run_case](args, db_path)
+        result.update({
+            'items': num_items,
+            'seconds': elapsed,
+            'throughput': num_items / elapsed if elapsed > 0 else None,
+            'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'peak_rss_mb': read_peak_rss_mb(),
+            'mturk_calls': {name: len(values) for name, values in sorted(call_latencies.items())}
+        })
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+
+    with open(args.result_file, 'w') as f:
+        json.dump(result, f)
+
+
+def run_all(args):
+    """
+    Runs each requested benchmark at each scale in a separate process
+    :return: a dictionary of results, keyed by 'benchmark@scale'
+    """
+    results = {}
+    os.makedirs(args.work_dir, exist_ok=True)
+    for scale in args.scales:
+        for name in args.benchmarks:
+            result_file = os.path.join(args.work_dir, f'{name}-{scale}.json')
+            command = [sys.executable, '-m', 'benchmarks.run_benchmarks', '--run-case', name,
+                       '--scale', str(scale), '--result-file', result_file, '--work-dir', args.work_dir,
+                       '--transport', args.transport, '--latency-ms', str(args.latency_ms),
+                       '--blob-kb', str(args.blob_kb), '--max-pulls', str(args.max_pulls),
+                       '--review-requests', str(args.review_requests), '--seed', str(args.seed)]
+            print(f'Running {name} at {scale} HITs...', flush=True)
+            completed = subprocess.run(command, cwd=repo_root)
+            if completed.returncode != 0 or not os.path.exists(result_file):
+                result = {'benchmark': name, 'scale': scale, 'error': f'exited with status {completed.returncode}'}
+            else:
+                with open(result_file) as f:
+                    result = json.load(f)
+            results[f'{name}@{scale}'] = result
+            print_result(result)
+    return results
+
+
+def print_result(result):
+    if result.get('error'):
+        print(f"  {result['benchmark']}@{result['scale']}: FAILED - {result['error']}")
+        return
+
+    def fmt(value, unit=''):
+        return f'{value:.2f}{unit}' if value is not None else 'n/a'
+
+    print(f"  {result['benchmark']}@{result['scale']}: {result['items']} items in {fmt(result['seconds'], 's')}, "
+          f"{fmt(result['throughput'])}/s, p50 {fmt(result['p50_ms'], 'ms')}, p99 {fmt(result['p99_ms'], 'ms')}, "
+          f"peak RSS {fmt(result['peak_rss_mb'], 'MB')}")
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Compares a set of results to a baseline
+    :return: a list of descriptions of the regressions found
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None or result.get('error') or base.get('error'):
+            continue
+        for metric, higher_is_better in compared_metrics.items():
+            new_value, base_value = result.get(metric), base.get(metric)
+            if new_value is None or not base_value:
+                continue
+            change = (new_value - base_value) / base_value
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f'{key} {metric}: {base_value:.2f} -> {new_value:.2f} ({change:+.0%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks batch posting, sync and review against a local MTurk')
+    parser.add_argument('--benchmarks', default=','.join(benchmark_names),
+                        help=f'a comma separated list of benchmarks to run, from {", ".join(benchmark_names)}')
+    parser.add_argument('--scales', default='10000,100000',
+                        help='a comma separated list of the numbers of HITs to benchmark with, e.g. 10000,100000,1000000')
+    parser.add_argument('--transport', choices=('inprocess', 'http'), default='inprocess',
+                        help='call the stand-in directly, or through boto3 and a local HTTP server')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency added to every MTurk call')
+    parser.add_argument('--blob-kb', type=int, default=4, help='approximate size of the annotation blobs per HIT')
+    parser.add_argument('--max-pulls', type=int, default=50, help='the max number of batches pulled by next_batch')
+    parser.add_argument('--review-requests', type=int, default=500, help='the number of requests made by review_fetch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'mturkseg-benchmarks'),
+                        help='where the synthetic databases are written')
+    parser.add_argument('--output', help='a json file to write the results to')
+    parser.add_argument('--save-baseline', help='save the results as a named baseline')
+    parser.add_argument('--compare', help='compare the results to a named baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='the relative change allowed before a regression')
+    parser.add_argument('--run-case', choices=benchmark_names, help=argparse.SUPPRESS)
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case(args)
+        return
+
+    args.benchmarks = [name.strip() for name in args.benchmarks.split(',') if name.strip()]
+    args.scales = [int(scale) for scale in args.scales.split(',') if scale.strip()]
+    results = run_all(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(baselines_dir, exist_ok=True)
+        with open(os.path.join(baselines_dir, f'{args.save_baseline}.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved baseline {args.save_baseline}')
+    if args.compare:
+        with open(os.path.join(baselines_dir, f'{args.compare}.json')) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} regressions against baseline {args.compare}:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print(f'No regressions against baseline {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import json
+import random
+import sqlite3
+
+from mturksegutils import database_builder, blob_store, assignment_manager
+
+
+# The share of HITs in each status in a synthetic experiment database
+default_status_mix = {
+    'Approved': 0.60,
+    'Rejected': 0.05,
+    'Submitted': 0.15,
+    'Open': 0.20
+}
+
+# The share of open HITs that have a new submission waiting on MTurk when the benchmark starts
+open_with_submission_fraction = 0.3
+
+class_names = ['person', 'car', 'dog', 'cat', 'bicycle', 'chair', 'bottle', 'tree']
+annotation_modes = ['polygon-outline', 'polygon-bbox-paint', 'outline-paint', 'dot-link-polygon']
+
+
+def build_annotation_blobs(rng, blob_kb=4):
+    """
+    Builds an interaction log, in-progress annotation and final annotation in the form the task html submits
+    :param rng: the random number generator
+    :param blob_kb: the approximate combined size of the blobs, in kilobytes
+    :return: interaction_log, annotation_in_progress, result_data
+    """
+
+    ts = rng.randint(1_600_000_000_000, 1_700_000_000_000)
+    interaction_log = [f'start[{ts}]']
+    annotations = []
+    budget = blob_kb * 1024
+    while budget > 0:
+        # Each object is a polygon or a paint stroke made of rectangles between anchor points
+        cx, cy = rng.randint(0, 640), rng.randint(0, 480)
+        mode = rng.choice(['polygon', 'paint'])
+        strokes = []
+        for _ in range(rng.randint(1, 3)):
+            num_points = rng.randint(8, 40)
+            points = [[cx + rng.randint(-60, 60), cy + rng.randint(-60, 60)] for _ in range(num_points)]
+            strokes.append({'type': 'positive' if rng.random() > 0.1 else 'negative', 'points': points})
+            for x, y in points:
+                ts += rng.randint(50, 600)
+                interaction_log.append(f'pointer_down[left|{x}|{y}|{ts}]')
+                interaction_log.append(f'pointer_up[{x}|{y}|{rng.randint(40, 200)}]')
+        modes = {name: name == mode for name in ('dot', 'link', 'bbox', 'polygon', 'outline', 'paint')}
+        annotation = {'class': [rng.choice(class_names)], 'modes': modes, 'exteriors': [], 'interiors': [],
+                      'strokes': strokes}
+        annotations.append(annotation)
+        interaction_log.append(f'complete_annotation[{len(annotations) - 1}|{ts}]')
+        budget -= len(json.dumps(annotation)) * 2
+
+    return '-'.join(interaction_log), json.dumps([None, None, None, None, None]), json.dumps(annotations)
+
+
+def build_experiment_db(db_path, num_hits, state=None, mturk_type='production', exp_group='bench-3',
+                        blob_kb=4, status_mix=None, seed=0, chunk_size=5000, inline_blobs=False):
+    """
+    Builds a synthetic experiment database, and the matching HITs and assignments in a local MTurk state
+
+    :param db_path: the path of the database to create
+    :param num_hits: the number of HITs in the hits table
+    :param state: a local_mturk.LocalMTurkState to create the open and submitted HITs in, or None to skip MTurk
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group for every HIT
+    :param blob_kb: the approximate size of the annotation blobs stored for each assignment, in kilobytes
+    :param status_mix: the share of HITs in each status, defaults to default_status_mix
+    :param seed: the seed for the random number generator, so that the same database is built every time
+    :param chunk_size: the number of rows inserted per transaction
+    :param inline_blobs: True to store the annotation blobs inline in the hits and assignments tables, the way databases
+    created before migrations.move_blobs_out_of_row did
+    :return: a dictionary with the number of HITs in each status
+    """
+
+    if status_mix is None:
+        status_mix = default_status_mix
+    rng = random.Random(seed)
+
+    database_builder.db_path = db_path
+    database_builder.create_hits_table()
+    database_builder.create_exp_groups_table()
+    database_builder.create_task_config_table()
+    database_builder.create_training_task_table()
+    database_builder.create_qualification_types_table()
+    database_builder.create_hit_types_table()
+    database_builder.create_hit_posting_journal_table()
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO exp_groups VALUES (?, ?, ?, ?, ?)", (exp_group, mturk_type, 3, 0.06, False))
+
+    hit_type_id = None
+    if state is not None:
+        hit_type_id = state.create_hit_type(Title='Synthetic segmentation task', Description='Synthetic',
+                                            Reward='0.06', AssignmentDurationInSeconds=3600,
+                                            AutoApprovalDelayInSeconds=604800)['HITTypeId']
+        cursor.execute("INSERT OR REPLACE INTO hit_types VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))",
+                       (hit_type_id, mturk_type, exp_group, '0.06', 3600, '', ''))
+
+    statuses = list(status_mix.keys())
+    weights = list(status_mix.values())
+    counts = {status: 0 for status in statuses}
+    hit_rows = []
+    task_rows = []
+    for index in range(num_hits):
+        status = rng.choices(statuses, weights)[0]
+        counts[status] += 1
+        img_url = f'https://example.com/images/{exp_group}/{index:08d}.jpg'
+        classes = '-'.join(rng.sample(class_names, 3))
+        annotation_mode = rng.choice(annotation_modes)
+        task_rows.append((exp_group, img_url, annotation_mode, classes, 'None'))
+
+        hit_id = f'SYNTH{index:025d}'
+        assignment_id, worker_id, auto_approve_time = None, None, None
+        interaction_log, annotation_in_progress, result_data = None, None, None
+        if state is not None and status in ('Open', 'Submitted'):
+            # Open and submitted HITs are the ones a sync asks MTurk about, so they must exist in the local state
+            hit = state.create_hit_with_hit_type(HITTypeId=hit_type_id, LifetimeInSeconds=2419200,
+                                                 RequesterAnnotation=exp_group, HITLayoutId='SYNTHETICLAYOUT',
+                                                 HITLayoutParameters=[{'Name': 'classes', 'Value': classes}])['HIT']
+            hit_id = hit['HITId']
+            if status == 'Submitted' or rng.random() < open_with_submission_fraction:
+                state.submit_assignments(hit_id)
+            if status == 'Submitted':
+                assignment = state.assignments[state.assignments_by_hit[hit_id][0]]
+                assignment_id, worker_id = assignment['AssignmentId'], assignment['WorkerId']
+                auto_approve_time = assignment_manager.format_auto_approve_time(assignment['AutoApprovalTime'])
+        elif status != 'Open':
+            assignment_id = f'SYNTHA{index:024d}'
+            worker_id = f'W{rng.randint(0, 999):013d}'
+            auto_approve_time = assignment_manager.format_auto_approve_time(1_700_000_000 + index)
+        if status != 'Open':
+            interaction_log, annotation_in_progress, result_data = build_annotation_blobs(rng, blob_kb)
+
+        hit_rows.append((hit_id, mturk_type, exp_group, img_url, classes, annotation_mode, 'None', status,
+                         assignment_id, auto_approve_time, interaction_log, annotation_in_progress, result_data,
+                         worker_id))
+
+        if len(hit_rows) >= chunk_size:
+            write_rows(conn, cursor, hit_rows, task_rows, inline_blobs)
+            hit_rows, task_rows = [], []
+
+    write_rows(conn, cursor, hit_rows, task_rows, inline_blobs)
+    conn.close()
+    return counts
+
+
+def write_rows(conn, cursor, hit_rows, task_rows, inline_blobs=False):
+    if not inline_blobs:
+        for row in hit_rows:
+            if row[8] is not None:
+                blob_store.write_blobs(cursor, row[8], row[10], row[11], row[12])
+        hit_rows = [row[:10] + (None, None, None) + row[13:] for row in hit_rows]
+    cursor.executemany("INSERT INTO hits "
+                       "(hit_id, mturk_type, exp_group, image_url, classes, annotation_mode, pre_annotations, status, "
+                       "assignment_id, auto_approve_time, interaction_log, annotation_in_progress, result_data, "
+                       "worker_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", hit_rows)
+    cursor.executemany("INSERT INTO assignments "
+                       "(assignment_id, hit_id, mturk_type, worker_id, status, auto_approve_time, interaction_log, "
+                       "annotation_in_progress, result_data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(row[8], row[0], row[1], row[13], row[7], row[9], row[10], row[11], row[12])
+                        for row in hit_rows if row[8] is not None])
+    cursor.executemany("INSERT INTO task_config VALUES (?, ?, ?, ?, ?)", task_rows)
+    conn.commit()
+
+
+def build_task_config_db(db_path, num_tasks, mturk_type='production', exp_group='bench-3', seed=0):
+    """
+    Builds a database with an experiment group and its task_config rows, but no HITs, for benchmarking batch posting
+    :return: the experiment group ID
+    """
+
+    rng = random.Random(seed)
+    database_builder.db_path = db_path
+    database_builder.create_hits_table()
+    database_builder.create_exp_groups_table()
+    database_builder.create_task_config_table()
+    database_builder.create_hit_types_table()
+    database_builder.create_hit_posting_journal_table()
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO exp_groups VALUES (?, ?, ?, ?, ?)", (exp_group, mturk_type, 3, 0.06, False))
+    cursor.executemany("INSERT INTO task_config VALUES (?, ?, ?, ?, ?)",
+                       [(exp_group, f'https://example.com/images/{exp_group}/{index:08d}.jpg',
+                         rng.choice(annotation_modes), '-'.join(rng.sample(class_names, 3)), 'None')
+                        for index in range(num_tasks)])
+    conn.commit()
+    conn.close()
+    return exp_group
@@ -5,7 +5,7 @@ from mturksegutils import mturk_client, mturk_seg_vars, hit_builder, worker_qual
 # Open a connection to the database and set up the Mechanical Turk client
 conn = sqlite3.connect(mturk_seg_vars.db_path)
 cursor = conn.cursor()
-mturk = mturk_client.create_mturk_instance()
+mturk = mturk_client.get_mturk_client()
 
 # Even for a 1-off, you will want to be able to search for it later
 search_key = "1-off-task"
@@ -1,7 +1,7 @@
 from mturksegutils import mturk_seg_vars, worker_quals, mturk_client
 
 screening_results = "/path/to/results/from/screening/task.csv"
-mturk = mturk_client.create_mturk_instance()
+mturk = mturk_client.get_mturk_client()
 
 worker_quals.assign_qualifications_to_consent_and_vocab_batch(mturk, screening_results)
 
@@ -1,4 +1,4 @@
-from mturksegutils import mturk_seg_vars, database_builder, database_initializer
+from mturksegutils import mturk_seg_vars, database_builder, database_initializer, migrations
 import sqlite3
 import csv
 
@@ -17,12 +17,34 @@ task_config_files = [
 database_builder.create_exp_groups_table()
 database_builder.create_task_config_table()
 
-# For storing results later
+# For storing results later (this also creates the assignments table, which keeps every assignment of each HIT, and
+# the assignment_blobs table, which keeps their compressed annotation data)
 database_builder.create_hits_table()
 
 # Optional, if your experiment will use training tasks
 database_builder.create_training_task_table()
 
+# For caching the IDs of the custom qualification types and the HIT types registered for each experiment group
+database_builder.create_qualification_types_table()
+database_builder.create_hit_types_table()
+
+# For resuming an interrupted batch of HITs without posting duplicates
+database_builder.create_hit_posting_journal_table()
+
+# For tracking the incremental sync of each experiment group, and when each HIT was last synced with MTurk
+database_builder.create_sync_state_table()
+database_builder.create_hit_sync_times_table()
+
+# For auditing the HIT statuses inferred locally from their auto-approval times
+database_builder.create_status_inferences_table()
+
+# For the periodic summaries of the MTurk calls made by each workflow
+database_builder.create_mturk_call_metrics_table()
+
+# Record the schema version, so that later versions of the package can migrate this database in place
+# (an existing database is upgraded the same way, with python -m mturksegutils.migrations)
+migrations.migrate()
+
 # Open a connection to the newly created database
 conn = sqlite3.connect(database_path)
 cursor = conn.cursor()
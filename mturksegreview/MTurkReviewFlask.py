@@ -1,16 +1,34 @@
-from flask import Flask, request, render_template, jsonify
-from mturksegutils import mturk_seg_vars, mturk_client, assignment_manager
+from flask import Flask, request, render_template, jsonify, g
+from mturksegutils import mturk_seg_vars, mturk_client, assignment_manager, blob_store, db_connections, annotation_codec
 import review_utils
-import sqlite3
-import threading
 
 app = Flask(__name__)
 
 
-mturk = mturk_client.create_mturk_instance(sandbox=False)
-conn = sqlite3.connect(mturk_seg_vars.db_path, check_same_thread=False)     # The flask app is multi-threaded, which will prevent database updates under the default configuration
-cursor = conn.cursor()
-lock = threading.Lock()
+mturk = mturk_client.get_mturk_client(sandbox=False)
+# The flask app is multi-threaded, so each thread reads through its own connection, and the endpoints that write take
+# turns on one writer connection - reads are answered while a write endpoint is waiting on MTurk
+pool = db_connections.ConnectionPool()
+
+
+@app.before_request
+def use_interactive_request_priority():
+    """
+    MTurk calls made while handling a request from the review UI take priority over background jobs, and are attributed
+    to the 'review' workflow in the MTurk call metrics
+    """
+    g.request_priority_token = mturk_client.current_request_priority.set('interactive')
+    g.request_workflow_token = mturk_client.current_request_workflow.set('review')
+
+
+@app.teardown_request
+def reset_request_priority(exception=None):
+    token = g.pop('request_priority_token', None)
+    if token is not None:
+        mturk_client.current_request_priority.reset(token)
+    token = g.pop('request_workflow_token', None)
+    if token is not None:
+        mturk_client.current_request_workflow.reset(token)
 
 
 @app.route('/')
@@ -28,7 +46,8 @@ def refresh_batch_summary():
     :return: A JSON object containing the latest batch summary data
     """
 
-    batch_summary_obj = review_utils.refresh_batch_summary()
+    with pool.read() as cursor:
+        batch_summary_obj = review_utils.refresh_batch_summary(cursor)
     return jsonify({"result": batch_summary_obj})
 
 
@@ -42,9 +61,7 @@ def pull_new_result_set():
 
     result = {}
 
-    try:
-        lock.acquire(True)
-
+    with pool.write() as (conn, cursor):
         hits, num_auto_rejected = assignment_manager.get_next_batch_of_submitted_results(mturk, conn, cursor, auto_reject_empties=True)
         num_hits_under_review = len(hits)
         result = {
@@ -52,8 +69,6 @@ def pull_new_result_set():
             "num_auto_rejected": num_auto_rejected
         }
         #print(result, flush=True)
-    finally:
-        lock.release()
     
     return jsonify({"result": result})
 
@@ -62,30 +77,22 @@ def pull_new_result_set():
 @app.route('/call_get_next_result_to_review', methods=['POST'])
 def get_next_result_to_review():
     """
-    When called, this fetches the next HIT from the database that is ready to be reviewed
+    When called, this fetches the next submitted assignment from the database that is ready to be reviewed
+    Every assignment of a HIT posted with several is reviewed, not only the one mirrored on the HIT's row
     :return: A JSON object containing the data for the HIT and its revieable assignment
     """
 
     current_hit_record = {}
     mturk_type = mturk_client.get_mturk_type(mturk)
 
-    try:
-        lock.acquire(True)
-
-        # Filter the database to keep only the HITs with mturk_type = mturk_type and with status = "Submitted"
-        cursor.execute("""
-            SELECT * 
-            FROM hits 
-            WHERE mturk_type = ? 
-            AND status = 'Submitted'
-            ORDER BY auto_approve_time ASC 
-            LIMIT 1
-        """, (mturk_type,))
-
-        # Select the first hit, ordered by nearest auto_approve time
-        db_record = cursor.fetchone()
+    with pool.read() as cursor:
+        # Select the submitted assignment with the nearest auto_approve time, as a row in the form of the hits table
+        db_records = assignment_manager.select_submitted_assignments(cursor, mturk_type,
+                                                                     order_by_auto_approve_time=True, limit=1)
+        db_record = db_records[0] if len(db_records) > 0 else None
 
         if db_record is not None:
+            db_record = blob_store.with_blobs(cursor, [db_record])[0]
             current_hit_record['hit_id'] = db_record[0]
             current_hit_record['mturk_type'] = db_record[1]
             current_hit_record['exp_group'] = db_record[2]
@@ -99,25 +106,12 @@ def get_next_result_to_review():
             current_hit_record['interaction_log'] = db_record[10]
             current_hit_record['worker_id'] = db_record[13]
 
-            # Since ann_in_progress is stored as a json string, special characters need to be reformatted so that it can be parsed back as a json object
-            ann_in_progress = db_record[11]
-            if ann_in_progress is not None:
-                ann_in_progress = ann_in_progress.replace("\\", "")
-                ann_in_progress = ann_in_progress.replace("\"", "\'")
-            current_hit_record['annotation_in_progress'] = ann_in_progress
-
-            # Since ann_final is stored as a json string, special characters need to be reformatted so that it can be parsed back as a json object
-            ann_final = db_record[12]
-            if ann_final is not None:
-                ann_final = ann_final.replace("\\", "")
-                ann_final = ann_final.replace("\"", "\'")
-            current_hit_record['annotation_final'] = ann_final
+            # The annotations are sent as json the UI can parse as it is, whether they are stored as json or encoded
+            current_hit_record['annotation_in_progress'] = annotation_codec.json_view(db_record[11])
+            current_hit_record['annotation_final'] = annotation_codec.json_view(db_record[12])
 
         #print(current_hit_record, flush=True)
 
-    finally:
-        lock.release()
-
     return jsonify({"result": current_hit_record})
 
 
@@ -131,9 +125,7 @@ def get_next_qualifier_result_to_review():
     current_assignment_record = {}
     mturk_type = mturk_client.get_mturk_type(mturk)
 
-    try:
-        lock.acquire(True)
-
+    with pool.read() as cursor:
         # Filter the database to keep only the assignments with mturk_type = mturk_type and with status = "Submitted"
         cursor.execute("""
             SELECT * 
@@ -145,10 +137,11 @@ def get_next_qualifier_result_to_review():
             LIMIT 1
         """, (mturk_type,))
 
-        # Select the first assignment, ordered by nearest auto_approve time
+        # Select the first assignment, ordered by nearest auto_approve time, and load its annotation data
         db_record = cursor.fetchone()
 
         if db_record is not None:
+            db_record = blob_store.with_blobs(cursor, [db_record])[0]
             current_assignment_record['hit_id'] = db_record[0]
             current_assignment_record['mturk_type'] = db_record[1]
             current_assignment_record['exp_group'] = db_record[2]
@@ -162,25 +155,12 @@ def get_next_qualifier_result_to_review():
             current_assignment_record['interaction_log'] = db_record[10]
             current_assignment_record['worker_id'] = db_record[13]
 
-            # Since ann_in_progress is stored as a json string, special characters need to be reformatted so that it can be parsed back as a json object
-            ann_in_progress = db_record[11]
-            if ann_in_progress is not None:
-                ann_in_progress = ann_in_progress.replace("\\", "")
-                ann_in_progress = ann_in_progress.replace("\"", "\'")
-            current_assignment_record['annotation_in_progress'] = ann_in_progress
-
-            # Since ann_final is stored as a json string, special characters need to be reformatted so that it can be parsed back as a json object
-            ann_final = db_record[12]
-            if ann_final is not None:
-                ann_final = ann_final.replace("\\", "")
-                ann_final = ann_final.replace("\"", "\'")
-            current_assignment_record['annotation_final'] = ann_final
+            # The annotations are sent as json the UI can parse as it is, whether they are stored as json or encoded
+            current_assignment_record['annotation_in_progress'] = annotation_codec.json_view(db_record[11])
+            current_assignment_record['annotation_final'] = annotation_codec.json_view(db_record[12])
 
         #print(current_hit_record, flush=True)
 
-    finally:
-        lock.release()
-
     return jsonify({"result": current_assignment_record})
 
 
@@ -192,9 +172,7 @@ def mark_current_qual_record_as_good():
     assignment_id = data['assignment_id']
     print(data)
 
-    try:
-        lock.acquire(True)
-
+    with pool.write() as (conn, cursor):
         # Get the assignment_id by finding the table row with this hit_id in hits
         cursor.execute("SELECT * FROM training_tasks WHERE hit_id=? AND assignment_id=?", (hit_id, assignment_id,))
         record = cursor.fetchone()[0]
@@ -205,9 +183,6 @@ def mark_current_qual_record_as_good():
 
         print(f'Marked assignment {assignment_id} for training task {hit_id} as GOOD', flush=True)
 
-    finally:
-        lock.release()
-
     return jsonify({"result": "success"})
 
 
@@ -219,9 +194,7 @@ def mark_current_qual_record_as_bad():
     assignment_id = data['assignment_id']
     print(data)
 
-    try:
-        lock.acquire(True)
-
+    with pool.write() as (conn, cursor):
         # Get the assignment_id by finding the table row with this hit_id in hits
         cursor.execute("SELECT * FROM training_tasks WHERE hit_id=? AND assignment_id=?", (hit_id, assignment_id,))
         record = cursor.fetchone()[0]
@@ -232,9 +205,6 @@ def mark_current_qual_record_as_bad():
 
         print(f'Marked assignment {assignment_id} for training task {hit_id} as BAD', flush=True)
 
-    finally:
-        lock.release()
-
     return jsonify({"result": "success"})
 
 
@@ -243,19 +213,13 @@ def approve_current_record():
 
     data = request.json
     hit_id = data['hit_id']
+    # The assignment shown to the reviewer, which may be any one of the HIT's assignments
+    assignment_id = data['assignment_id']
 
-    try:
-        lock.acquire(True)
-
-        # Get the assignment_id by finding the table row with this hit_id in hits
-        cursor.execute("SELECT assignment_id FROM hits WHERE hit_id=?", (hit_id,))
-        assignment_id = cursor.fetchone()[0]
+    with pool.write() as (conn, cursor):
 
         assignment_manager.approve_assignment(mturk, conn, cursor, assignment_id)
-        print(f'Approved assignment for HIT ID {hit_id}', flush=True)
-
-    finally:
-        lock.release()
+        print(f'Approved assignment {assignment_id} for HIT ID {hit_id}', flush=True)
 
     return jsonify({"result": "success"})
 
@@ -265,20 +229,14 @@ def reject_current_record_too_inaccurate():
 
     data = request.json
     hit_id = data['hit_id']
+    # The assignment shown to the reviewer, which may be any one of the HIT's assignments
+    assignment_id = data['assignment_id']
 
-    try:
-        lock.acquire(True)
-
-        # Get the assignment_id by finding the table row with this hit_id in hits
-        cursor.execute("SELECT assignment_id FROM hits WHERE hit_id=?", (hit_id,))
-        assignment_id = cursor.fetchone()[0]
+    with pool.write() as (conn, cursor):
         feedback = mturk_seg_vars.reject_feedback_inaccurate
 
         assignment_manager.reject_and_repost_assignment(mturk, conn, cursor, assignment_id, feedback)
-        print(f'Rejected assignment for HIT ID {hit_id} - too inaccurate', flush=True)
-
-    finally:
-        lock.release()
+        print(f'Rejected assignment {assignment_id} for HIT ID {hit_id} - too inaccurate', flush=True)
 
     return jsonify({"result": "success"})
 
@@ -289,28 +247,22 @@ def reject_current_record_too_few():
 
     data = request.json
     hit_id = data['hit_id']
+    # The assignment shown to the reviewer, which may be any one of the HIT's assignments
+    assignment_id = data['assignment_id']
 
-    try:
-        lock.acquire(True)
-
-        # Get the assignment_id by finding the table row with this hit_id in hits
-        cursor.execute("SELECT assignment_id, exp_group FROM hits WHERE hit_id=?", (hit_id,))
-        record = cursor.fetchone()
-        assignment_id = record[0]
-        exp_group = record[1]
+    with pool.write() as (conn, cursor):
+        cursor.execute("SELECT exp_group FROM hits WHERE hit_id=?", (hit_id,))
+        exp_group = cursor.fetchone()[0]
 
         # Get the number of objects for this exp_group from the exp_group table
         cursor.execute("SELECT num_objects FROM exp_groups WHERE exp_group=?", (exp_group,))
         num_objects = cursor.fetchone()[0]
         #print(f'Number of objects for this exp_group: {num_objects}', flush=True)
 
-        feedback = mturk_seg_vars.reject_feedback_too_few.format(num_objects)
+        feedback = mturk_seg_vars.reject_feedback_too_few.format(num_objects=num_objects)
         assignment_manager.reject_and_repost_assignment(mturk, conn, cursor, assignment_id, feedback)
 
-        print(f'Rejected assignment for HIT ID {hit_id} - too few objects labeled', flush=True)
-
-    finally:
-        lock.release()
+        print(f'Rejected assignment {assignment_id} for HIT ID {hit_id} - too few objects labeled', flush=True)
 
     return jsonify({"result": "success"})
 
@@ -1,110 +1,49 @@
-import sqlite3
-from mturksegutils import mturk_seg_vars
+from mturksegutils import assignment_manager, db_connections
 
 
 
-def refresh_batch_summary():
+def refresh_batch_summary(cursor=None):
     """
     This method is called by the MTurkReviewFlask.py file to get the data for visualizing the status of each batch.
     It checks the database and gets the current number of hits for each batch that are approved or rejected.
+    :param cursor: an optional database cursor to read through, e.g. a read connection of the review app
     :return batch_summary_obj: a dictionary containing the status of each batch
     """
 
-    # Create the database connection
-    conn = sqlite3.connect(mturk_seg_vars.db_path)
-    cursor = conn.cursor()
+    # Create the database connection, if one was not given
+    conn = None
+    if cursor is None:
+        conn = db_connections.connect(read_only=True)
+        cursor = conn.cursor()
 
     # Create a dictionary for storing the batch summary data
     batch_summary_obj = {}
 
-    # For each batch and for both sandbox and production, call the get_status_of_hits method
+    # Count the HITs in each status for every batch and environment in one grouped query
+    status_counts = assignment_manager.get_hit_status_counts(cursor)
+
     cursor.execute("SELECT exp_group FROM exp_groups")
     batches = cursor.fetchall()
 
     for batch in batches:
-        # Get the status of all HITs for this batch
-        # First, count the number of sandbox HITs posted
-        cursor.execute(
-            """
-                SELECT COUNT(*) 
-                FROM hits 
-                WHERE exp_group = ? 
-                AND mturk_type = 'sandbox'
-            """, (batch))
-        posted_sandbox = cursor.fetchone()[0]
-
-        # Count the number of sandbox HITs approved
-        cursor.execute(
-            """
-                SELECT COUNT(*) 
-                FROM hits 
-                WHERE exp_group = ? 
-                AND mturk_type = 'sandbox'
-                AND status = 'Approved'
-            """, (batch))
-        approved_sandbox = cursor.fetchone()[0]
-
-        # Count the number of sandbox hits rejected
-        cursor.execute(
-            """
-                SELECT COUNT(*) 
-                FROM hits 
-                WHERE exp_group = ? 
-                AND mturk_type = 'sandbox'
-                AND status = 'Rejected'
-            """, (batch))
-        rejected_sandbox = cursor.fetchone()[0]
-
-        # Count the number of production HITs posted
-        cursor.execute(
-            """
-                SELECT COUNT(*) 
-                FROM hits 
-                WHERE exp_group = ? 
-                AND mturk_type = 'production'
-            """, (batch))
-        posted_production = cursor.fetchone()[0]
-
-        # Count the number of production HITs approved
-        cursor.execute(
-            """
-                SELECT COUNT(*)
-                FROM hits
-                WHERE exp_group = ?
-                AND mturk_type = 'production'
-                AND status = 'Approved'
-            """, (batch))
-        approved_production = cursor.fetchone()[0]
-
-        # Count the number of production HITs rejected
-        cursor.execute(
-            """
-                SELECT COUNT(*)
-                FROM hits
-                WHERE exp_group = ?
-                AND mturk_type = 'production'
-                AND status = 'Rejected'
-            """, (batch))
-        rejected_production = cursor.fetchone()[0]
-
-        # Calculate the number of HITs that are still open for sandbox and production
-        outstanding_sandbox = posted_sandbox - (approved_sandbox + rejected_sandbox)
-        outstanding_production = posted_production - (approved_production + rejected_production)
-
         # Format the data for this batch into a dictionary object and add it to the master dictionary
         batch_obj = {}
-        batch_production_obj = {}
-        batch_sandbox_obj = {}
-        batch_production_obj["posted"] = posted_production
-        batch_production_obj["approved"] = approved_production
-        batch_production_obj["rejected"] = rejected_production
-        batch_production_obj["outstanding"] = outstanding_production
-        batch_sandbox_obj["posted"] = posted_sandbox
-        batch_sandbox_obj["approved"] = approved_sandbox
-        batch_sandbox_obj["rejected"] = rejected_sandbox
-        batch_sandbox_obj["outstanding"] = outstanding_sandbox
-        batch_obj["sandbox"] = batch_sandbox_obj
-        batch_obj["production"] = batch_production_obj
+        for mturk_type in ('sandbox', 'production'):
+            counts = status_counts.get((batch[0], mturk_type), {})
+            posted = sum(counts.values())
+            approved = counts.get('Approved', 0)
+            rejected = counts.get('Rejected', 0)
+
+            # Calculate the number of HITs that are still open
+            batch_obj[mturk_type] = {
+                "posted": posted,
+                "approved": approved,
+                "rejected": rejected,
+                "outstanding": posted - (approved + rejected)
+            }
         batch_summary_obj[batch[0]] = batch_obj
 
-    return batch_summary_obj
\ No newline at end of file
+    if conn is not None:
+        conn.close()
+
+    return batch_summary_obj
@@ -264,7 +264,6 @@ function loadNextHit(selectQual) {
 
         // Load the current annotations
         let ann_in_progress_str = data.result.annotation_in_progress;
-        ann_in_progress_str = fixJsonStringQuotes(ann_in_progress_str);
         let ann_in_progress;
         try {
             ann_in_progress = JSON.parse(ann_in_progress_str);
@@ -276,7 +275,6 @@ function loadNextHit(selectQual) {
 
         // load the final annotations
         let ann_final_str = data.result.annotation_final;
-        ann_final_str = fixJsonStringQuotes(ann_final_str);
         let ann_final;
         try {
             ann_final = JSON.parse(ann_final_str);
@@ -315,6 +313,7 @@ function loadHitData(data) {
     
         // Fill the summary label with key HIT properties
         current_image_summary_label.innerHTML = "<b>HIT ID:</b> " + current_hit_id 
+        + "<br><b>Assignment ID:</b> " + current_assignment_id 
         + "<br><b>Experiment Group:</b> " + exp_group 
         + "<br><b>Auto-Approve Time:</b> " + auto_approve_time 
         + "<br><b>Annotation Mode:</b> " + ann_mode 
@@ -423,8 +422,8 @@ function approveCurrentLine() {
 
     debug_console.innerHTML = "Approving current line...";
 
-    if (current_hit_id != null) {
-        let argToSend = {'hit_id': current_hit_id};
+    if (current_hit_id != null && current_assignment_id != null) {
+        let argToSend = {'hit_id': current_hit_id, 'assignment_id': current_assignment_id};
 
         fetch('/call_approve_current_record', {
             method: 'POST',
@@ -444,7 +443,7 @@ function approveCurrentLine() {
         current_hit_id = null;
         current_assignment_id = null;
     } else {
-        debug_console.innerHTML = "Error approving current HIT: hit id is null";
+        debug_console.innerHTML = "Error approving current HIT: hit id or assignment_id is null";
     }
 }
 
@@ -453,8 +452,8 @@ function rejectCurrentLineTooInaccurate() {
 
     debug_console.innerHTML = "Rejecting current line...";
 
-    if (current_hit_id != null) {
-        let argToSend = {'hit_id': current_hit_id};
+    if (current_hit_id != null && current_assignment_id != null) {
+        let argToSend = {'hit_id': current_hit_id, 'assignment_id': current_assignment_id};
 
         fetch('/call_reject_current_record_too_inaccurate', {
             method: 'POST',
@@ -474,7 +473,7 @@ function rejectCurrentLineTooInaccurate() {
         current_hit_id = null;
         current_assignment_id = null;
     } else {
-        debug_console.innerHTML = "Error rejecting current HIT: hit id is null";
+        debug_console.innerHTML = "Error rejecting current HIT: hit id or assignment_id is null";
     }
 }
 
@@ -483,8 +482,8 @@ function rejectCurrentLineTooFew() {
 
     debug_console.innerHTML = "Rejecting current line...";
 
-    if (current_hit_id != null) {
-        let argToSend = {'hit_id': current_hit_id};
+    if (current_hit_id != null && current_assignment_id != null) {
+        let argToSend = {'hit_id': current_hit_id, 'assignment_id': current_assignment_id};
 
         fetch('/call_reject_current_record_too_few', {
             method: 'POST',
@@ -504,7 +503,7 @@ function rejectCurrentLineTooFew() {
         current_hit_id = null;
         current_assignment_id = null;
     } else {
-        debug_console.innerHTML = "Error rejecting current HIT: hit id is null";
+        debug_console.innerHTML = "Error rejecting current HIT: hit id or assignment_id is null";
     }
 }
 
@@ -924,20 +923,6 @@ function hashCode(str) {
 }
 
 
-function fixJsonStringQuotes(json_string) {
-/**
- * Fixes the quotes in a JSON string so that it can be parsed into a JSON object
- * @param {string} json_string - The JSON string to fix.
- * @return the fixed JSON string.
- */
-    if (json_string === null) {
-        return null;
-    }
-    let fixed_json_string = json_string.replace(/'/g, '"');
-    return fixed_json_string;
-}
-
-
 function showAnns(show) {
 /**
  * Sets the showAnnotations variable, which dictates whether annotations are displayed on the image
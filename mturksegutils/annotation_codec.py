@@ -0,0 +1,246 @@
+"""
+A compact, canonical binary encoding of the annotations a worker submits
+
+The task html submits its final annotations (the result_data answer) as the JSON.stringify output of a list of objects:
+    {"class": "car", "modes": {"dot": false, "link": false, "bbox": false, "polygon": true, "outline": false,
+     "paint": false}, "exteriors": [], "interiors": [], "strokes": [{"type": "positive", "points": [[x, y], ...]}]}
+encode_annotations stores the same objects in a versioned binary blob, little-endian:
+    header:  the magic bytes b'SEGA', the format version (uint8), a reserved byte, and the number of objects (uint16)
+    objects: for each object, whether its class is a string (0) or a list (1) (uint8), the number of class names
+             (uint8), each class name as its utf-8 length (uint8) and bytes, the modes as a bitmask in the order of
+             mode_names (uint8), the number of strokes (uint16), and for each stroke its type, the index of
+             stroke_types (uint8), and its number of points (uint32)
+    points:  padded to an even offset, the x, y coordinates of every point of every stroke as int16 pairs, each one the
+             difference from the point before it (the first point is the difference from 0, 0)
+Because the points of every stroke are delta-encoded in one run, decode_annotations reads them in place with
+np.frombuffer and recovers every point with a single cumulative sum, and the points of each stroke are views into that
+one array. to_json turns a blob back into the exact JSON.stringify output of the objects, for the review UI.
+
+Annotations that the format cannot represent exactly (e.g. fractional coordinates, or keys the format does not know)
+are left as JSON - encode_annotation_json returns None for them - so encoding never loses data. Stored values of either
+kind are read with parse_annotations or json_view, which tell them apart by the magic bytes.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+
+magic = b'SEGA'
+format_version = 1
+
+object_keys = ('class', 'modes', 'exteriors', 'interiors', 'strokes')
+mode_names = ('dot', 'link', 'bbox', 'polygon', 'outline', 'paint')
+stroke_keys = ('type', 'points')
+stroke_types = ('positive', 'negative')
+
+header_format = struct.Struct('<4sBBH')
+stroke_format = struct.Struct('<BI')
+int16_min, int16_max = -2 ** 15, 2 ** 15 - 1
+
+
+def is_encoded(value):
+    """
+    :return: True if a stored value is a blob from encode_annotations, rather than JSON text
+    """
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:len(magic)]) == magic
+
+
+def parse_annotation_json(text):
+    """
+    Parses the annotation JSON submitted by the task html
+    Values written by older versions of the package may have their quotes escaped with backslashes, which are removed
+    if the text does not parse as it is
+    :param text: the JSON text, or None
+    :return: the parsed annotations, or None if there are none ('', 'None' or null)
+    """
+
+    if text is None or text == '' or text == 'None':
+        return None
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(text.replace('\\', ''))
+
+
+def is_canonical_point(point):
+    return (type(point) is list and len(point) == 2 and type(point[0]) is int and type(point[1]) is int
+            and int16_min <= point[0] <= int16_max and int16_min <= point[1] <= int16_max)
+
+
+def encode_annotations(objects):
+    """
+    Encodes a list of annotated objects
+    :param objects: the objects, as parsed from the result_data JSON
+    :return: the encoded bytes
+    :raises ValueError: if the objects cannot be represented exactly
+    """
+
+    if type(objects) is not list or len(objects) > 0xFFFF:
+        raise ValueError('The annotations must be a list of at most 65535 objects')
+
+    parts = [header_format.pack(magic, format_version, 0, len(objects))]
+    points = []
+    for annotation in objects:
+        if type(annotation) is not dict or tuple(annotation.keys()) != object_keys:
+            raise ValueError(f'Each annotation must have exactly the keys {object_keys}')
+        if annotation['exteriors'] != [] or annotation['interiors'] != []:
+            raise ValueError('Annotations with exteriors or interiors are not supported')
+
+        class_value = annotation['class']
+        class_names = [class_value] if type(class_value) is str else class_value
+        if type(class_names) is not list or len(class_names) > 0xFF or \
+                any(type(name) is not str for name in class_names):
+            raise ValueError('The class of an annotation must be a string or a list of strings')
+        parts.append(struct.pack('<BB', 0 if type(class_value) is str else 1, len(class_names)))
+        for name in class_names:
+            encoded_name = name.encode('utf-8')
+            if len(encoded_name) > 0xFF:
+                raise ValueError(f'Class name too long: {name}')
+            parts.append(struct.pack('<B', len(encoded_name)) + encoded_name)
+
+        modes = annotation['modes']
+        if type(modes) is not dict or tuple(modes.keys()) != mode_names or \
+                any(type(value) is not bool for value in modes.values()):
+            raise ValueError(f'The modes of an annotation must be booleans for exactly {mode_names}')
+        strokes = annotation['strokes']
+        if type(strokes) is not list or len(strokes) > 0xFFFF:
+            raise ValueError('The strokes of an annotation must be a list of at most 65535 strokes')
+        parts.append(struct.pack('<BH', sum(1 << bit for bit, name in enumerate(mode_names) if modes[name]),
+                                 len(strokes)))
+
+        for stroke in strokes:
+            if type(stroke) is not dict or tuple(stroke.keys()) != stroke_keys or stroke['type'] not in stroke_types:
+                raise ValueError(f'Each stroke must have exactly the keys {stroke_keys}, and a type in {stroke_types}')
+            stroke_points = stroke['points']
+            if type(stroke_points) is not list or not all(is_canonical_point(point) for point in stroke_points):
+                raise ValueError('The points of a stroke must be [x, y] pairs of 16-bit integers')
+            parts.append(stroke_format.pack(stroke_types.index(stroke['type']), len(stroke_points)))
+            points.extend(stroke_points)
+
+    header = b''.join(parts)
+    if len(header) % 2 == 1:
+        header += b'\x00'
+    if len(points) == 0:
+        return header
+    # The differences between consecutive points are stored in int32 first, since they can fall outside int16 even
+    # though the points do not - e.g. from -30000 to 30000 - and such points are left as JSON
+    deltas = np.diff(np.array(points, dtype=np.int32), axis=0, prepend=np.zeros((1, 2), dtype=np.int32))
+    if deltas.min() < int16_min or deltas.max() > int16_max:
+        raise ValueError('The points are too far apart to be delta-encoded in 16 bits')
+    return header + deltas.astype('<i2').tobytes()
+
+
+def encode_annotation_json(text):
+    """
+    :param text: result_data JSON text, as submitted by the task html
+    :return: the encoded annotations, or None if the text is empty or cannot be encoded exactly, and should be kept as
+    it is
+    """
+
+    try:
+        objects = parse_annotation_json(text)
+    except json.JSONDecodeError:
+        return None
+    if objects is None:
+        return None
+    try:
+        return encode_annotations(objects)
+    except ValueError:
+        return None
+
+
+def decode_annotations(data):
+    """
+    Decodes a blob from encode_annotations
+    :param data: the encoded bytes
+    :return: the list of annotated objects, in the form they were encoded from, except that the points of each stroke
+    are an (n, 2) int32 NumPy array - a view into one array holding the points of every stroke
+    """
+
+    data = memoryview(data)
+    blob_magic, version, _, num_objects = header_format.unpack_from(data, 0)
+    if blob_magic != magic:
+        raise ValueError('Not an encoded annotation blob')
+    if version != format_version:
+        raise ValueError(f'Unsupported annotation format version {version}')
+
+    offset = header_format.size
+    objects = []
+    stroke_lengths = []
+    for _ in range(num_objects):
+        class_kind, num_class_names = struct.unpack_from('<BB', data, offset)
+        offset += 2
+        class_names = []
+        for _ in range(num_class_names):
+            length = data[offset]
+            class_names.append(bytes(data[offset + 1:offset + 1 + length]).decode('utf-8'))
+            offset += 1 + length
+        mode_bits, num_strokes = struct.unpack_from('<BH', data, offset)
+        offset += 3
+
+        strokes = []
+        for _ in range(num_strokes):
+            stroke_type, num_points = stroke_format.unpack_from(data, offset)
+            offset += stroke_format.size
+            strokes.append({'type': stroke_types[stroke_type], 'points': None})
+            stroke_lengths.append(num_points)
+
+        objects.append({
+            'class': class_names[0] if class_kind == 0 else class_names,
+            'modes': {name: bool(mode_bits & (1 << bit)) for bit, name in enumerate(mode_names)},
+            'exteriors': [],
+            'interiors': [],
+            'strokes': strokes
+        })
+
+    offset += offset % 2
+    total_points = sum(stroke_lengths)
+    deltas = np.frombuffer(data, dtype='<i2', count=total_points * 2, offset=offset).reshape(total_points, 2)
+    points = np.cumsum(deltas, axis=0, dtype=np.int32)
+
+    start = 0
+    strokes = (stroke for annotation in objects for stroke in annotation['strokes'])
+    for stroke, num_points in zip(strokes, stroke_lengths):
+        stroke['points'] = points[start:start + num_points]
+        start += num_points
+    return objects
+
+
+def parse_annotations(value):
+    """
+    Reads a stored annotation value of either kind
+    :param value: a blob from encode_annotations, annotation JSON text, or None
+    :return: the parsed annotations (with NumPy points if the value was encoded), or None if there are none
+    """
+
+    if is_encoded(value):
+        return decode_annotations(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value).decode('utf-8')
+    return parse_annotation_json(value)
+
+
+def to_json(objects):
+    """
+    :param objects: annotated objects, e.g. from decode_annotations
+    :return: the JSON text of the objects, in the compact form JSON.stringify produces
+    """
+
+    def default(value):
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        raise TypeError(f'Cannot serialize {type(value)}')
+
+    return json.dumps(objects, separators=(',', ':'), ensure_ascii=False, default=default)
+
+
+def json_view(value):
+    """
+    :param value: a blob from encode_annotations, annotation JSON text, or None
+    :return: the annotations as JSON text that parses with JSON.parse, or None if there are none
+    """
+
+    annotations = parse_annotations(value)
+    return None if annotations is None else to_json(annotations)
@@ -1,10 +1,13 @@
-import xmltodict
+import concurrent.futures
+import html
+import multiprocessing
 import sqlite3
-import json
 import datetime
 import time
+from xml.etree import ElementTree
 
-from mturksegutils import mturk_seg_vars, mturk_client, other_utils, hit_builder, worker_quals
+from mturksegutils import mturk_seg_vars, mturk_client, other_utils, hit_builder, worker_quals, database_builder, \
+    posting_engine, reconciliation, blob_store, db_connections, annotation_codec
 
 
 db_path = mturk_seg_vars.db_path
@@ -12,23 +15,130 @@ html_task_path = mturk_seg_vars.html_task_path
 reject_feedback_empty = mturk_seg_vars.reject_feedback_empty
 reject_feedback_inaccurate = mturk_seg_vars.reject_feedback_inaccurate
 
+# The question identifiers of the answers the task html submits
+answer_identifiers = ('interaction_log', 'annotation_in_progress', 'result_data')
 
-def select_assignments_and_sort_by_auto_approve_time(cursor):
+# The number of characters of answer XML fed to the parser at a time
+answer_xml_chunk_size = 1 << 20
+
+# The columns of a row of the hits table, with the status, assignment and annotation data of one of the HIT's
+# assignments in place of the last one recorded on the HIT's row - rows selected with these columns from the assignments
+# table joined to the hits table can be used wherever a row of the hits table is read (e.g. row[8] is the assignment_id)
+assignment_row_columns = """
+    hits.hit_id, hits.mturk_type, hits.exp_group, hits.image_url, hits.classes, hits.annotation_mode,
+    hits.pre_annotations, assignments.status, assignments.assignment_id, assignments.auto_approve_time,
+    assignments.interaction_log, assignments.annotation_in_progress, assignments.result_data, assignments.worker_id
+"""
+
+
+def select_assignments_and_sort_by_auto_approve_time(cursor, mturk_type=None):
     """
     Selects all assignments with status 'Submitted' and sorts them by auto_approve_time with earliest first
     :param cursor: the sqlite3 cursor object
+    :param mturk_type: 'sandbox' or 'production', or None for the assignments of both environments
     :return: a list of rows in the assignments table according to the above criteria
     """
 
-    cursor.execute("""
-        SELECT * FROM assignments 
-        WHERE status = 'Submitted' 
-        ORDER BY auto_approve_time ASC
-    """)
+    if mturk_type is None:
+        cursor.execute("SELECT * FROM assignments WHERE status = 'Submitted' ORDER BY auto_approve_time ASC")
+    else:
+        cursor.execute("""
+            SELECT * FROM assignments 
+            WHERE mturk_type = ?
+            AND status = 'Submitted' 
+            ORDER BY auto_approve_time ASC
+        """, (mturk_type,))
     results = cursor.fetchall()
     return results
 
 
+def select_submitted_assignments(cursor, mturk_type, exp_group=None, hit_ids=None, assignment_ids=None,
+                                 order_by_auto_approve_time=False, limit=None):
+    """
+    Selects the submitted assignments of a set of HITs, including every assignment of a HIT posted with several, rather
+    than only the last one recorded on the HIT's row
+    :param cursor: the database cursor
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group to select assignments from, or None for every group
+    :param hit_ids: an optional list of the HITs to select assignments from
+    :param assignment_ids: an optional list of the assignments to select
+    :param order_by_auto_approve_time: True to sort the assignments by auto_approve_time, earliest first
+    :param limit: the max number of assignments to select, or None for all of them
+    :return: a list of rows in the form of the rows of the hits table, one per assignment (see assignment_row_columns)
+    """
+
+    conditions = "assignments.status = 'Submitted' AND assignments.mturk_type = ?"
+    params = [mturk_type]
+    if exp_group is not None:
+        conditions += " AND hits.exp_group = ?"
+        params.append(exp_group)
+    for column, values in (('hit_id', hit_ids), ('assignment_id', assignment_ids)):
+        if values is not None:
+            if len(values) == 0:
+                return []
+            conditions += f" AND assignments.{column} IN ({', '.join('?' * len(values))})"
+            params.extend(values)
+    order = " ORDER BY assignments.auto_approve_time ASC" if order_by_auto_approve_time else ""
+    if limit is not None:
+        order += " LIMIT ?"
+        params.append(limit)
+
+    cursor.execute(f"SELECT {assignment_row_columns} FROM assignments JOIN hits ON hits.hit_id = assignments.hit_id "
+                   f"WHERE {conditions}{order}", params)
+    return cursor.fetchall()
+
+
+def get_assignments_for_hits(cursor, hit_ids):
+    """
+    Reads every assignment of a set of HITs, e.g. the several assignments of a HIT posted with repeats, in one pass over
+    the hit_id index of the assignments table
+    :param cursor: the database cursor
+    :param hit_ids: the IDs of the HITs
+    :return: a dictionary of the rows of the assignments table for each HIT, ordered by auto_approve_time, leaving out
+    the HITs with no assignments
+    """
+
+    assignments = {}
+    hit_ids = list(hit_ids)
+    # Chunked to stay under SQLite's limit on the number of query parameters
+    for start in range(0, len(hit_ids), 500):
+        chunk = hit_ids[start:start + 500]
+        cursor.execute(f"SELECT * FROM assignments WHERE hit_id IN ({', '.join('?' * len(chunk))}) "
+                       f"ORDER BY hit_id, auto_approve_time", chunk)
+        for row in cursor.fetchall():
+            assignments.setdefault(row[1], []).append(row)
+    return assignments
+
+
+def get_assignments_for_worker(cursor, worker_id, status=None):
+    """
+    Reads the assignments completed by a worker, through the worker_id index of the assignments table
+    :param cursor: the database cursor
+    :param worker_id: the worker's ID
+    :param status: the status of the assignments to read, or None for every status
+    :return: a list of rows from the assignments table
+    """
+
+    if status is None:
+        cursor.execute("SELECT * FROM assignments WHERE worker_id = ?", (worker_id,))
+    else:
+        cursor.execute("SELECT * FROM assignments WHERE worker_id = ? AND status = ?", (worker_id, status))
+    return cursor.fetchall()
+
+
+def set_assignment_status(cursor, assignment_id, status):
+    """
+    Sets the status of an assignment in the assignments table, and on the row of its HIT if it is the last assignment
+    recorded for the HIT
+    :param cursor: the database cursor - the caller is responsible for committing
+    :param assignment_id: the assignment
+    :param status: the new status
+    """
+
+    cursor.execute("UPDATE assignments SET status = ? WHERE assignment_id = ?", (status, assignment_id))
+    cursor.execute("UPDATE hits SET status = ? WHERE assignment_id = ?", (status, assignment_id))
+
+
 def parse_answer_data_for_assignment(assignment):
     """
     Parses an MTurk assignment answer data and returns the interaction log, annotation in progress, and result data
@@ -36,195 +146,620 @@ def parse_answer_data_for_assignment(assignment):
     :return: interaction_log, annotation_in_progress, result_data
     """
 
-    # The answer data is stored in an xml string inside the assignment object
-    assignment_answer = assignment['Answer']
-    answer_dict = {}
+    return parse_answer_data(assignment['Answer'])
+
+
+def parse_answer_data(answer_xml):
+    """
+    Parses the answer XML of an assignment and returns the interaction log, annotation in progress, and result data
+    Defined at module level so that it can be run in a process pool (see parse_answers_in_pool)
+    :param answer_xml: the QuestionFormAnswers XML string, or None
+    :return: interaction_log, annotation_in_progress, result_data - each is None if the worker did not submit it
+    """
+
+    answers = parse_answer_xml(answer_xml) if answer_xml is not None else {}
+    return tuple(answers.get(identifier) for identifier in answer_identifiers)
+
+
+def parse_answer_xml(answer_xml, identifiers=answer_identifiers):
+    """
+    Extracts the free text answers to a set of questions from an MTurk QuestionFormAnswers XML string
+    Only the requested answers are copied out, and extraction stops as soon as all of them have been found
+    :param answer_xml: the QuestionFormAnswers XML string
+    :param identifiers: the question identifiers of the answers to extract
+    :return: a dictionary of the answer text for each requested identifier that was found - as with xmltodict,
+    surrounding whitespace is stripped and an empty answer is None
+    """
+
+    wanted = set(identifiers)
+    answers = scan_answer_xml(answer_xml, wanted)
+    if answers is None:
+        answers = pull_answer_xml(answer_xml, wanted)
+    return answers
 
-    # Parse the xml answer data -> fields hierarchy depends on what the worker completed
-    if assignment_answer is not None:
-        answer_json = xmltodict.parse(assignment_answer)
-        if answer_json is not None:
-            answer_json = answer_json['QuestionFormAnswers']
-            if answer_json is not None:
-                answer_json = answer_json['Answer']
-                for a in answer_json:
-                    key = a['QuestionIdentifier']
-                    val = a['FreeText']
-                    answer_dict[key] = val
 
-    # By default we assume no results are present
-    interaction_log, annotation_in_progress, result_data = None, None, None
-    if 'interaction_log' in answer_dict.keys():
-        interaction_log = answer_dict['interaction_log']
-    if 'annotation_in_progress' in answer_dict.keys():
-        annotation_in_progress = answer_dict['annotation_in_progress']
-    if 'result_data' in answer_dict.keys():
-        result_data = answer_dict['result_data']
+def scan_answer_xml(answer_xml, wanted):
+    """
+    Extracts answers by slicing them out of the XML, without running an XML parser over the (large) answer text
+    This only handles the layout MTurk generates, where each answer is
+    <Answer><QuestionIdentifier>...</QuestionIdentifier><FreeText>...</FreeText></Answer>
+    and the answer text is plain character data - anything else is left to pull_answer_xml
+    :param answer_xml: the QuestionFormAnswers XML string
+    :param wanted: the set of question identifiers of the answers to extract
+    :return: a dictionary of the answer text for each requested identifier that was found, or None if the XML is not
+    in the expected layout
+    """
+
+    answers = {}
+    position = answer_xml.find('<QuestionFormAnswers')
+    if position < 0:
+        return None
+    while True:
+        position = answer_xml.find('<Answer>', position)
+        if position < 0:
+            return answers
+
+        identifier_start = position + len('<Answer><QuestionIdentifier>')
+        if not answer_xml.startswith('<QuestionIdentifier>', position + len('<Answer>')):
+            return None
+        identifier_end = answer_xml.find('</QuestionIdentifier><FreeText>', identifier_start)
+        if identifier_end < 0:
+            return None
+        text_start = identifier_end + len('</QuestionIdentifier><FreeText>')
+        text_end = answer_xml.find('</FreeText></Answer>', text_start)
+        if text_end < 0:
+            return None
+
+        identifier = answer_xml[identifier_start:identifier_end]
+        if identifier in wanted:
+            text = answer_xml[text_start:text_end]
+            # Markup (e.g. CDATA) and carriage returns (which XML parsers normalize) need a real parser
+            if '<' in text or '\r' in text:
+                return None
+            if '&' in text:
+                text = html.unescape(text)
+            answers[identifier] = text.strip() or None
+            if len(answers) == len(wanted):
+                return answers
+        position = text_end
+
+
+def pull_answer_xml(answer_xml, wanted):
+    """
+    Extracts answers by streaming the XML through a pull parser a chunk at a time, keeping only the requested answers
+    :param answer_xml: the QuestionFormAnswers XML string
+    :param wanted: the set of question identifiers of the answers to extract
+    :return: a dictionary of the answer text for each requested identifier that was found
+    """
+
+    answers = {}
+    identifier, text = None, None
+    parser = ElementTree.XMLPullParser(events=('end',))
+    for start in range(0, len(answer_xml), answer_xml_chunk_size):
+        parser.feed(answer_xml[start:start + answer_xml_chunk_size])
+        for _, element in parser.read_events():
+            # Tags are qualified by the QuestionFormAnswers namespace, e.g. '{http://...}Answer'
+            tag = element.tag.rpartition('}')[2]
+            if tag == 'QuestionIdentifier':
+                identifier = (element.text or '').strip()
+            elif tag == 'FreeText':
+                text = (element.text or '').strip() or None
+            elif tag == 'Answer':
+                if identifier in wanted:
+                    answers[identifier] = text
+                    if len(answers) == len(wanted):
+                        return answers
+                identifier, text = None, None
+                element.clear()
+    parser.close()
+    return answers
+
+
+def get_parse_pool(num_processes=None):
+    """
+    Starts a process pool for parsing answer XML, if more than one process is configured
+    :param num_processes: the number of processes, defaults to mturk_seg_vars.sync_parse_processes
+    :return: a ProcessPoolExecutor, or None if answers should be parsed in the calling thread
+    """
 
-    return interaction_log, annotation_in_progress, result_data
+    if num_processes is None:
+        num_processes = mturk_seg_vars.sync_parse_processes
+    if num_processes <= 1:
+        return None
+    # The workers are spawned rather than forked, since the sync threads may be running when the pool starts
+    return concurrent.futures.ProcessPoolExecutor(max_workers=num_processes,
+                                                  mp_context=multiprocessing.get_context('spawn'))
 
 
-def sync_hits_to_db(exp_group):
+def parse_answers_in_pool(results, parse_pool, batch_size=None):
+    """
+    Parses the answer XML of fetched assignments in a process pool, a batch of HITs at a time
+    :param results: (hit_id, response, error) tuples from list_assignments_for_hit, from posting_engine.fetch_results
+    :param parse_pool: a process pool from get_parse_pool
+    :param batch_size: the number of HITs parsed together, defaults to mturk_seg_vars.sync_commit_every_n
+    :return: a generator of (hit_id, response, error, parsed_answers) tuples, where parsed_answers holds the result of
+    parse_answer_data for each of the response's assignments
+    """
+
+    if batch_size is None:
+        batch_size = mturk_seg_vars.sync_commit_every_n
+
+    def parse_batch(batch):
+        answer_xmls = [assignment['Answer'] for _, response, error in batch if error is None
+                       for assignment in response['Assignments']]
+        chunksize = max(1, len(answer_xmls) // 32)
+        parsed = iter(parse_pool.map(parse_answer_data, answer_xmls, chunksize=chunksize))
+        for hit_id, response, error in batch:
+            if error is not None:
+                yield hit_id, response, error, None
+            else:
+                yield hit_id, response, error, [next(parsed) for _ in response['Assignments']]
+
+    batch = []
+    for result in results:
+        batch.append(result)
+        if len(batch) >= batch_size:
+            yield from parse_batch(batch)
+            batch = []
+    yield from parse_batch(batch)
+
+
+@mturk_client.request_workflow('sync')
+def sync_hits_to_db(exp_group, incremental=False):
     """
     Given an experiment group, checks the MTurk database for new assignments and adds them to the local database
     :param exp_group: the experiment group to update the database for
+    :param incremental: if True, only the HITs that MTurk lists as reviewable and the submitted assignments that are
+    past their auto-approval time are checked (see sync_reviewable_hits_to_db), rather than every submitted assignment
+    and every HIT with more submitted assignments on MTurk than are recorded
     """
 
     # Create sandbox and production MTurk instances
-    mturk_sandbox = mturk_client.create_mturk_instance(sandbox=True)
-    mturk_production = mturk_client.create_mturk_instance(sandbox=False)
+    mturk_sandbox = mturk_client.get_mturk_client(sandbox=True)
+    mturk_production = mturk_client.get_mturk_client(sandbox=False)
 
     # Connect to the database
-    conn = sqlite3.connect(db_path)
+    conn = db_connections.connect(db_path)
     cursor = conn.cursor()
 
-    # Ignore HITs where the status is 'Approved' or 'Rejected' - these can no longer be updated
-    cursor.execute("SELECT * FROM hits WHERE exp_group = ? AND status = ?", (exp_group, 'Submitted',))
-    submitted_hits = cursor.fetchall()
-    cursor.execute("SELECT * FROM hits WHERE exp_group = ? AND status = ?", (exp_group, 'Open',))
-    open_hits = cursor.fetchall()
+    if incremental:
+        cursor.execute("SELECT DISTINCT mturk_type FROM hits WHERE exp_group = ?", (exp_group,))
+        for (mturk_type,) in cursor.fetchall():
+            mturk = mturk_sandbox if mturk_type == 'sandbox' else mturk_production
+            num_updated = sync_reviewable_hits_to_db(mturk, conn, cursor, exp_group)
+            print(f"Added new assignments for {num_updated} {mturk_type} HITs")
+            num_inferred = infer_auto_approved_hits(cursor, mturk_type, exp_group)
+            conn.commit()
+            rows = select_ambiguous_submitted_hits(cursor, mturk_type, exp_group)
+            approved_count, rejected_count = update_status_of_submitted_hits(mturk, conn, cursor, rows)
+            print(f"{num_inferred + approved_count} {mturk_type} assignments were approved and {rejected_count} "
+                  f"rejected by MTurk")
+        conn.close()
+        return
+
+    # Assignments are fetched from MTurk by a pool of threads, but only this thread writes to the database
+    is_qual = exp_group.startswith('qual')
+    for mturk in (mturk_sandbox, mturk_production):
+        mturk_type = mturk_client.get_mturk_type(mturk)
+
+        # Check the submitted assignments in the DB and see if they were approved or rejected - approved and rejected
+        # assignments can no longer be updated
+        rows = select_submitted_assignments(cursor, mturk_type, exp_group)
+        if len(rows) > 0:
+            print(f"SUBMITTED {mturk_type} assignments:")
+            update_status_of_submitted_hits(mturk, conn, cursor, rows)
+
+        # Check for HITs with submitted assignments that are not in the DB yet, including the later assignments of a
+        # HIT whose row was already marked as submitted by its first one
+        hit_ids = select_hits_with_unrecorded_assignments(mturk, cursor, exp_group, is_qual=is_qual)
+        if len(hit_ids) > 0:
+            print(f"HITs with new {mturk_type} assignments:")
+            add_new_assignments_for_hits_to_database(mturk, conn, cursor, hit_ids, is_qual=is_qual)
 
-    # Iterate over the HITs listed as submitted in the DB and see if they were approved or rejected
-    print("SUBMITTED HITs:")
-    count = 0
-    for row in submitted_hits:
-        mturk_type = row[1]
-        mturk = mturk_sandbox if mturk_type == 'sandbox' else mturk_production
-        # check the status to see if the HIT has been approved or rejected and update the table accordingly
-        update_existing_assignment_for_hit(row, mturk, cursor)
-        count += 1
-        if count % 10 == 0:
-            print(f"Synced {count} of {len(submitted_hits)} submitted HITs")
+    conn.close()
 
-    conn.commit()
 
-    # Iterate over the HITs listed as open in the DB and see if they are now submitted
-    print("OPEN HITs:")
-    count = 0
-    for row in open_hits:
-        hit_id = row[0]
-        mturk_type = row[1]
-        mturk = mturk_sandbox if mturk_type == 'sandbox' else mturk_production
-        exp_group = row[2]
-        is_qual = False
-        if exp_group.startswith('qual'):
-            is_qual = True
-        add_new_assignments_for_hit_to_database(hit_id, mturk, cursor, is_qual=is_qual)
-        count += 1
-        if count % 10 == 0:
-            print(f"Synced {count} of {len(open_hits)} open HITs")
+def sync_reviewable_hits_to_db(mturk, conn, cursor, exp_group, page_size=100, list_untyped_hits=False,
+                               auto_reject_empties=True, mark_reviewing=True, resume=True, verbose=False):
+    """
+    Incrementally syncs the new assignments for an experiment group, without polling every open HIT
+    A HIT only becomes reviewable on MTurk once its assignments have been submitted (or it expires), so the reviewable
+    HITs of each of the group's HIT types are paged through, and assignments are only fetched for the HITs with more
+    submitted assignments than are recorded in the database
+    Once every submitted assignment of a listed HIT is recorded, the HIT is moved to the Reviewing status, so that it is
+    not listed again and each pass only lists the HITs that became reviewable since the last one. This costs one
+    UpdateHITReviewStatus request per HIT, and get_next_batch_of_submitted_results, which only lists Reviewable HITs,
+    no longer sees the moved HITs - so the empty submissions it would reject and repost are rejected and reposted here,
+    as their assignments are ingested
+    The position in the listing is saved in the sync_state table after each page, so an interrupted sync resumes from
+    the page it stopped on, and the time of each complete pass is recorded in last_synced_at (see
+    sync_scheduler.SyncScheduler.get_last_discovery_pass)
+    :param mturk: the mturk client instance
+    :param conn: the database connection
+    :param cursor: the database cursor
+    :param exp_group: the experiment group to sync
+    :param page_size: the number of HITs to list per request (MTurk allows at most 100)
+    :param list_untyped_hits: if the group has no recorded HIT types (e.g. its HITs were posted before HIT types were
+    recorded), list the reviewable HITs of every type instead of syncing nothing - those HITs are otherwise synced by
+    sync_hits_to_db
+    :param auto_reject_empties: whether to reject and repost the submitted assignments of the synced HITs that have no
+    annotations (qual tasks are never rejected here)
+    :param mark_reviewing: whether to move the synced HITs to the Reviewing status on MTurk - if False, the whole
+    listing is paged through on every pass, and MTurk's review state is left as it is
+    :param resume: whether to resume from the position saved by an interrupted pass - if False, the listing is paged
+    through from the start, so that every reviewable HIT is seen
+    :param verbose: whether or not to print details to the console
+    :return: the number of HITs that new assignments were added for
+    """
 
-    conn.commit()
-    conn.close()
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    is_qual = exp_group.startswith('qual')
+    database_builder.create_hit_types_table(cursor)
+    database_builder.create_sync_state_table(cursor)
+
+    cursor.execute("SELECT DISTINCT hit_type_id FROM hit_types WHERE mturk_type = ? AND exp_group = ?",
+                   (mturk_type, exp_group))
+    hit_type_ids = [row[0] for row in cursor.fetchall()]
+    if len(hit_type_ids) == 0:
+        if not list_untyped_hits:
+            if verbose:
+                print(f'No HIT types are recorded for {exp_group}, so its reviewable HITs are not listed')
+            return 0
+        # HITs posted before HIT types were recorded are found by listing the reviewable HITs of every type
+        hit_type_ids = ['']
+
+    num_updated = 0
+    for hit_type_id in hit_type_ids:
+        cursor.execute("SELECT next_token FROM sync_state WHERE mturk_type = ? AND exp_group = ? AND hit_type_id = ?",
+                       (mturk_type, exp_group, hit_type_id))
+        row = cursor.fetchone()
+        next_token = row[0] if row is not None and resume else None
+
+        while True:
+            params = {'Status': 'Reviewable', 'MaxResults': page_size}
+            if hit_type_id:
+                params['HITTypeId'] = hit_type_id
+            if next_token:
+                params['NextToken'] = next_token
+            response = mturk.list_reviewable_hits(**params)
+            hits = response['HITs']
+            page_token = next_token
+            next_token = response.get('NextToken') if len(hits) > 0 else None
+
+            recorded_counts = get_recorded_assignment_counts(cursor, mturk_type, exp_group,
+                                                             [hit['HITId'] for hit in hits], is_qual)
+            # A reviewable HIT has no assignments in progress, so every assignment that is no longer available has
+            # been submitted
+            num_submitted = {hit['HITId']: hit.get('MaxAssignments', 1) - hit.get('NumberOfAssignmentsAvailable', 0) -
+                             hit.get('NumberOfAssignmentsPending', 0)
+                             for hit in hits if hit['HITId'] in recorded_counts}
+            changed_hit_ids = [hit_id for hit_id in num_submitted if num_submitted[hit_id] > recorded_counts[hit_id]]
+            if len(changed_hit_ids) > 0:
+                num_updated += add_new_assignments_for_hits_to_database(mturk, conn, cursor, changed_hit_ids,
+                                                                        verbose=verbose, is_qual=is_qual)
+                recorded_counts.update(get_recorded_assignment_counts(cursor, mturk_type, exp_group, changed_hit_ids,
+                                                                      is_qual))
+                if auto_reject_empties and not is_qual:
+                    reject_and_repost_empty_responses(mturk, conn, cursor, exp_group, changed_hit_ids, verbose=verbose)
+
+            # Move the HITs whose assignments are all recorded out of the listing. They no longer hold their positions
+            # in it, so if any are moved the same page is listed again rather than skipping the HITs that take their
+            # place
+            num_moved = 0
+            for hit_id in num_submitted if mark_reviewing else []:
+                if num_submitted[hit_id] <= recorded_counts[hit_id]:
+                    mturk.update_hit_review_status(HITId=hit_id, Revert=False)
+                    num_moved += 1
+            if num_moved > 0:
+                next_token = page_token
+
+            # Save the position in the listing once the page's results are written, so that no page is ever skipped
+            last_synced_at = None if next_token or num_moved > 0 else datetime.datetime.now()
+            cursor.execute("""
+                INSERT INTO sync_state (mturk_type, exp_group, hit_type_id, next_token, last_synced_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (mturk_type, exp_group, hit_type_id) DO UPDATE SET
+                next_token = excluded.next_token,
+                last_synced_at = COALESCE(excluded.last_synced_at, sync_state.last_synced_at)
+            """, (mturk_type, exp_group, hit_type_id, next_token, last_synced_at))
+            conn.commit()
 
+            if not next_token and num_moved == 0:
+                break
 
-def get_status_of_hits(mturk, search_key, verbose=False):
-    # TODO: we should not be directly querying MTurk. Instead, query the database and then sync wih MTurk as requested.
+    return num_updated
+
+
+def select_hits_with_unrecorded_assignments(mturk, cursor, exp_group, is_qual=False):
     """
-    Given an MTurk instance, and an experiment group to filter by, returns the number of approved, rejected, submitted, and open HITs for that group
-    :param mturk: the mturk instance to query
-    :param search_key: the experiment group to filter by
-    :param verbose: whether to print detailed results to the console
-    :return: the number of approved, submitted, and open HITs for the specified experiment group
+    Selects the HITs of an experiment group that MTurk lists with more submitted assignments than are recorded in the
+    database, whatever the status of their rows, so that every assignment of a HIT posted with several is found - the
+    HIT's row is marked as submitted by its first assignment
+    The submitted assignments of each HIT (at most its MaxAssignments) are counted from a fresh index of the account's
+    HITs (see reconciliation.get_hit_index), which takes one request per 100 HITs. Open HITs missing from the index are
+    always included, since they may have been posted after it was listed
+    :param mturk: the mturk client instance
+    :param cursor: the database cursor
+    :param exp_group: the experiment group to check
+    :param is_qual: True if the HITs are qual tasks, whose assignments are recorded in the training_tasks table
+    :return: a list of HIT IDs
     """
 
-    # Establish a connection to the database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    cursor.execute("SELECT hit_id, status FROM hits WHERE exp_group = ? AND mturk_type = ?", (exp_group, mturk_type))
+    rows = cursor.fetchall()
+    if len(rows) == 0:
+        return []
+    index = reconciliation.get_hit_index(mturk, refresh=True)
+
+    hit_ids = []
+    # Chunked to stay under SQLite's limit on the number of query parameters
+    for start in range(0, len(rows), 500):
+        chunk = rows[start:start + 500]
+        recorded_counts = get_recorded_assignment_counts(cursor, mturk_type, exp_group, [row[0] for row in chunk],
+                                                         is_qual)
+        for hit_id, status in chunk:
+            hit = index.get_hit(hit_id)
+            if hit is None:
+                if status == 'Open':
+                    hit_ids.append(hit_id)
+            elif reconciliation.count_submitted_assignments(hit) > recorded_counts.get(hit_id, 0):
+                hit_ids.append(hit_id)
+    return hit_ids
+
 
-    # Define the exp_group value to filter by
-    exp_group_value = search_key
+def get_recorded_assignment_counts(cursor, mturk_type, exp_group, hit_ids, is_qual=False):
+    """
+    Counts the assignments recorded in the database for each of a set of HITs
+    :param cursor: the database cursor
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group of the HITs
+    :param hit_ids: the IDs of the HITs to count assignments for
+    :param is_qual: True if the HITs are qual tasks, whose assignments are recorded in the training_tasks table
+    :return: a dictionary of the number of recorded assignments for each HIT, leaving out the HITs that are not in the
+    hits table for the experiment group
+    """
 
-    # Get the mturk type to filter by
-    mturk_type = 'production'
-    if 'sandbox' in mturk._endpoint.host:
-        mturk_type = 'sandbox'
+    if len(hit_ids) == 0:
+        return {}
 
-    # Query the hits table for records with the desired exp_group and mturk_type and retrieve their hit_id
-    cursor.execute("SELECT hit_id FROM hits WHERE exp_group = ? AND mturk_type = ?", (exp_group_value, mturk_type))
-    result = cursor.fetchall()
+    # The rows are looked up by primary key and filtered here, since filtering on exp_group in the query can lead
+    # sqlite to scan the whole group through the exp_group index instead
+    placeholders = ', '.join('?' * len(hit_ids))
+    cursor.execute(f"SELECT hit_id, mturk_type, exp_group, assignment_id FROM hits WHERE hit_id IN ({placeholders})",
+                   hit_ids)
+    counts = {hit_id: 0 for hit_id, row_mturk_type, row_exp_group, assignment_id in cursor.fetchall()
+              if row_mturk_type == mturk_type and row_exp_group == exp_group}
 
-    # Set up counters for the number of hits in each state
-    num_hits_open = 0
-    num_hits_submitted = 0
-    num_hits_approved = 0
+    if len(counts) > 0:
+        # The assignments of qual HITs are recorded in the training_tasks table, and the others in the assignments table
+        table = 'training_tasks' if is_qual else 'assignments'
+        cursor.execute(f"SELECT hit_id, COUNT(*) FROM {table} WHERE hit_id IN ({placeholders}) GROUP BY hit_id",
+                       hit_ids)
+        for hit_id, count in cursor.fetchall():
+            if hit_id in counts:
+                counts[hit_id] = count
 
-    # Print the results
-    for row in result:
-        hit_id = row[0]
-        # get the hit from mturk
-        hit = mturk.get_hit(HITId=hit_id)
+    return counts
 
-        hit_status = hit['HIT']['HITStatus']
 
-        # If verbose: print the hit_id, the hit status, and the approval status
-        if verbose:
-            print(f"Hit ID: {hit_id}; Hit status: {hit_status}; Approval status: {hit['HIT']['HITReviewStatus']}")
+def parse_auto_approve_time(auto_approve_time):
+    """
+    :param auto_approve_time: an auto_approve_time value from the hits table (see format_auto_approve_time), or a
+    datetime, timestamp or datetime string
+    :return: the auto-approval time as a timezone-aware datetime, or None if it is not set
+    """
 
-        # If there are assignments for the HIT, print their details and count the open, submitted, and approved assignments
-        if hit_status == "Reviewable":
+    if auto_approve_time is None or auto_approve_time == '':
+        return None
+    if isinstance(auto_approve_time, (int, float)):
+        return datetime.datetime.fromtimestamp(auto_approve_time, datetime.timezone.utc)
+    parsed = datetime.datetime.fromisoformat(str(auto_approve_time))
+    if parsed.tzinfo is None:
+        parsed = parsed.astimezone()
+    return parsed
 
-            # If verbose, first list all assignments that have been rejected
-            if verbose:
-                rejected_assignments = mturk.list_assignments_for_hit(HITId=hit_id, AssignmentStatuses=['Rejected'])[
-                    'Assignments']
-                for assignment in rejected_assignments:
-                    assignment_id = assignment['AssignmentId']
-                    assignment_status = assignment['AssignmentStatus']
-                    print(f"    Assignment ID: {assignment_id}; Assignment status: {assignment_status}")
-
-            # Check if there is any assignment that has been approved
-            approved_assignments = mturk.list_assignments_for_hit(HITId=hit_id, AssignmentStatuses=['Approved'])[
-                'Assignments']
-            if len(approved_assignments) > 0:
-                num_hits_approved += 1
-
-                # If verbose: list the approved assignments
-                if verbose:
-                    # This loop is just for error testing - the segmentation task should never have multiple approved assignments for a single HIT
-                    for assignment in approved_assignments:
-                        assignment_id = assignment['AssignmentId']
-                        assignment_status = assignment['AssignmentStatus']
-                        print(f"    Assignment ID: {assignment_id}; Assignment status: {assignment_status}")
-                continue
 
-            # If no assignments are approved, check if some assignment has been submitted
-            submitted_assignments = mturk.list_assignments_for_hit(HITId=hit_id, AssignmentStatuses=['Submitted'])[
-                'Assignments']
-            if len(submitted_assignments) > 0:
-                num_hits_submitted += 1
+def format_auto_approve_time(auto_approve_time):
+    """
+    Normalizes an auto-approval time for storage, so that stored times compare in the same order as the times themselves
+    and infer_auto_approved_hits can select the assignments past a cutoff through the auto_approve_time indexes
+    :param auto_approve_time: an auto-approval time, as a datetime, a timestamp or a datetime string
+    :return: the time in UTC as a fixed width ISO string, or None if it is not set or cannot be read
+    """
 
-                # This loop is just for error testing - the segmentation task should never have multiple assignments
-                # for the same HIT that are in 'submitted' state at the same time
-                if verbose:
-                    for assignment in submitted_assignments:
-                        assignment_id = assignment['AssignmentId']
-                        assignment_status = assignment['AssignmentStatus']
-                        interaction_log, annotation_in_progress, result_data = parse_answer_data_for_assignment(
-                            assignment)
-                        if interaction_log is None:
-                            interaction_log = 'N/A'
-                        if annotation_in_progress is None:
-                            annotation_in_progress = 'N/A'
-                        if result_data is None:
-                            result_data = 'N/A'
-                        print(f"    Assignment ID: {assignment_id}; Assignment status: {assignment_status}")
-                        print(f'    - Interaction log: {interaction_log}')
-                        print(f'    - Annotation in progress: {annotation_in_progress}')
-                        print(f'    - Result data: {result_data}')
-
-            # If there are no submitted or approved assignments, then the HIT is open
-            if len(submitted_assignments) == 0 and len(approved_assignments) == 0:
-                num_hits_open += 1
-
-        # If there are no assinments for the HIT then it is open by default
-        elif hit_status == "Assignable":
-            num_hits_open += 1
+    try:
+        parsed = parse_auto_approve_time(auto_approve_time)
+    except (TypeError, ValueError):
+        return None
+    if parsed is None:
+        return None
+    return parsed.astimezone(datetime.timezone.utc).isoformat(sep=' ', timespec='microseconds')
+
+
+def select_overdue_submitted_hits(cursor, mturk_type, exp_group=None):
+    """
+    Selects the submitted assignments that are past their auto-approval time
+    Apart from changes made through this package, these are the only submitted assignments whose status MTurk changes
+    by itself
+    :param cursor: the database cursor
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group to select assignments from, or None for every group
+    :return: a list of rows in the form of the rows of the hits table, one per assignment (see
+    select_submitted_assignments)
+    """
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    overdue_rows = []
+    for row in select_submitted_assignments(cursor, mturk_type, exp_group):
+        auto_approve_time = parse_auto_approve_time(row[9])
+        if auto_approve_time is None or auto_approve_time <= now:
+            overdue_rows.append(row)
+    return overdue_rows
+
+
+def auto_approve_timestamp(auto_approve_time):
+    """
+    :param auto_approve_time: an auto_approve_time value from the hits table
+    :return: the auto-approval time in seconds since the epoch, or None if it is not set or cannot be read
+    """
+
+    try:
+        parsed = parse_auto_approve_time(auto_approve_time)
+    except (TypeError, ValueError):
+        return None
+    return parsed.timestamp() if parsed is not None else None
+
+
+def infer_auto_approved_hits(cursor, mturk_type, exp_group=None, hit_ids=None, assignment_ids=None,
+                             grace_seconds=None):
+    """
+    Marks the submitted assignments that are past their auto-approval time as approved, without calling MTurk
+    Once an assignment's auto-approval time passes it can no longer be rejected, so MTurk has approved it, unless it was
+    rejected earlier outside of this package - each inferred assignment is flagged in the status_inferences table, so
+    that audit_inferred_statuses can check them against MTurk later
+    :param cursor: the database cursor - the caller is responsible for committing
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group to infer statuses for, or None for every group
+    :param hit_ids: an optional list of the HITs to infer the statuses of the assignments of
+    :param assignment_ids: an optional list of the assignments to infer statuses for
+    :param grace_seconds: how far past its auto_approve_time an assignment must be, defaults to
+    mturk_seg_vars.status_inference_grace_seconds
+    :return: the number of assignments marked as approved
+    """
+
+    if grace_seconds is None:
+        grace_seconds = mturk_seg_vars.status_inference_grace_seconds
+    database_builder.create_status_inferences_table(cursor)
+
+    # auto_approve_time is stored by format_auto_approve_time, so comparing it to a cutoff in the same form uses the
+    # (mturk_type, status, auto_approve_time) index - times that could not be read are stored as NULL and never match
+    conditions = "assignments.status = 'Submitted' AND assignments.mturk_type = ? " \
+                 "AND assignments.auto_approve_time <= ?"
+    params = [mturk_type, format_auto_approve_time(time.time() - grace_seconds)]
+    if exp_group is not None:
+        conditions += " AND assignments.hit_id IN (SELECT hit_id FROM hits WHERE exp_group = ?)"
+        params.append(exp_group)
+    for column, values in (('hit_id', hit_ids), ('assignment_id', assignment_ids)):
+        if values is not None:
+            if len(values) == 0:
+                return 0
+            conditions += f" AND assignments.{column} IN ({', '.join('?' * len(values))})"
+            params.extend(values)
+
+    # The inferences and the hits mirror are written before the assignments, while the assignments still match
+    cursor.execute(f"INSERT OR REPLACE INTO status_inferences "
+                   f"(hit_id, assignment_id, mturk_type, inferred_status, inferred_at) "
+                   f"SELECT assignments.hit_id, assignments.assignment_id, assignments.mturk_type, 'Approved', ? "
+                   f"FROM assignments WHERE {conditions}", [datetime.datetime.now()] + params)
+    # As set_assignment_status does, for every inferred assignment at once
+    cursor.execute(f"UPDATE hits SET status = 'Approved' WHERE assignment_id IN "
+                   f"(SELECT assignments.assignment_id FROM assignments WHERE {conditions})", params)
+    cursor.execute(f"UPDATE assignments SET status = 'Approved' WHERE {conditions}", params)
+    return cursor.rowcount
+
+
+def select_ambiguous_submitted_hits(cursor, mturk_type, exp_group=None):
+    """
+    Selects the submitted assignments whose status cannot be inferred locally, because their auto_approve_time is
+    missing or cannot be read
+    :param cursor: the database cursor
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group to select assignments from, or None for every group
+    :return: a list of rows in the form of the rows of the hits table, one per assignment (see
+    select_submitted_assignments)
+    """
+
+    return [row for row in select_submitted_assignments(cursor, mturk_type, exp_group)
+            if auto_approve_timestamp(row[9]) is None]
+
+
+def audit_inferred_statuses(mturk, conn, cursor, max_audits=None):
+    """
+    Checks the HITs whose status was inferred by infer_auto_approved_hits against MTurk, and corrects any that MTurk
+    reports differently (e.g. an assignment rejected outside of this package before it auto-approved)
+    :param mturk: the mturk client instance
+    :param conn: the database connection
+    :param cursor: the database cursor
+    :param max_audits: the max number of inferences to check, oldest first, or None for every unaudited inference
+    :return: the number of inferences checked, and the number that were corrected
+    """
+
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    database_builder.create_status_inferences_table(cursor)
+    query = "SELECT hit_id, assignment_id, inferred_status FROM status_inferences " \
+            "WHERE mturk_type = ? AND audited_at IS NULL ORDER BY inferred_at"
+    params = (mturk_type,)
+    if max_audits is not None:
+        query += " LIMIT ?"
+        params += (max_audits,)
+    cursor.execute(query, params)
+    inferences = cursor.fetchall()
+
+    num_checked = 0
+    num_corrected = 0
+    jobs = (({'AssignmentId': assignment_id}, (hit_id, assignment_id, inferred_status))
+            for hit_id, assignment_id, inferred_status in inferences)
+    for (hit_id, assignment_id, inferred_status), response, error in posting_engine.fetch_results(mturk.get_assignment,
+                                                                                                   jobs):
+        if error is not None:
+            print(f'Failed to audit assignment {assignment_id} for HIT {hit_id}: {error}')
+            continue
+        mturk_status = response['Assignment']['AssignmentStatus']
+        if mturk_status != inferred_status:
+            print(f'HIT {hit_id} was inferred to be {inferred_status}, but MTurk reports it as {mturk_status}')
+            set_assignment_status(cursor, assignment_id, mturk_status)
+            num_corrected += 1
+        cursor.execute("UPDATE status_inferences SET audit_status = ?, audited_at = ? "
+                       "WHERE hit_id = ? AND assignment_id = ?",
+                       (mturk_status, datetime.datetime.now(), hit_id, assignment_id))
+        num_checked += 1
+        if num_checked % mturk_seg_vars.sync_commit_every_n == 0:
+            conn.commit()
+
+    conn.commit()
+    return num_checked, num_corrected
+
+
+def get_status_of_hits(mturk, search_key, verbose=False, max_age_minutes=None):
+    """
+    Given an MTurk instance, and an experiment group to filter by, returns the number of approved, submitted, and open HITs for that group
+    The counts are read from the database, which is kept up to date by the sync functions, so MTurk is only queried for
+    the HITs whose local state is older than max_age_minutes, if it is given
+    :param mturk: the mturk instance for the environment to count HITs in
+    :param search_key: the experiment group to filter by
+    :param verbose: whether to print detailed results to the console
+    :param max_age_minutes: if given, open and submitted HITs that have not been synced within this many minutes are
+    synced with MTurk before counting
+    :return: the number of approved, submitted, and open HITs for the specified experiment group
+    """
+
+    # Establish a connection to the database
+    conn = db_connections.connect(db_path)
+    cursor = conn.cursor()
+
+    mturk_type = mturk_client.get_mturk_type(mturk)
+
+    if max_age_minutes is not None:
+        num_refreshed = refresh_stale_hits(mturk, conn, cursor, search_key, max_age_minutes)
+        if verbose:
+            print(f'Synced {num_refreshed} HITs that were last synced more than {max_age_minutes} minutes ago')
+
+    status_counts = get_hit_status_counts(cursor, search_key).get((search_key, mturk_type), {})
+    num_hits_approved = status_counts.get('Approved', 0)
+    num_hits_submitted = status_counts.get('Submitted', 0)
+    num_hits_open = status_counts.get('Open', 0)
 
     if verbose:
+        cursor.execute("SELECT hit_id, status, assignment_id FROM hits WHERE exp_group = ? AND mturk_type = ?",
+                       (search_key, mturk_type))
+        for hit_id, status, assignment_id in cursor.fetchall():
+            print(f"Hit ID: {hit_id}; Status: {status}; Assignment ID: {assignment_id}")
+
         # Print the summary
         print("")
         print(f'HITs approved: {num_hits_approved}')
+        print(f'HITs rejected: {status_counts.get("Rejected", 0)}')
         print(f'HITs submitted: {num_hits_submitted}')
         print(f'HITs open: {num_hits_open}')
 
@@ -234,6 +769,86 @@ def get_status_of_hits(mturk, search_key, verbose=False):
     return num_hits_approved, num_hits_submitted, num_hits_open
 
 
+def get_hit_status_counts(cursor, exp_group=None):
+    """
+    Counts the HITs in each status for each experiment group and environment, in a single grouped query
+    :param cursor: the database cursor
+    :param exp_group: the experiment group to count HITs for, or None for every group
+    :return: a dictionary keyed by (exp_group, mturk_type), of dictionaries of the number of HITs in each status
+    """
+
+    if exp_group is None:
+        cursor.execute("SELECT exp_group, mturk_type, status, COUNT(*) FROM hits "
+                       "GROUP BY exp_group, mturk_type, status")
+    else:
+        cursor.execute("SELECT exp_group, mturk_type, status, COUNT(*) FROM hits WHERE exp_group = ? "
+                       "GROUP BY exp_group, mturk_type, status", (exp_group,))
+
+    status_counts = {}
+    for row_exp_group, mturk_type, status, count in cursor.fetchall():
+        status_counts.setdefault((row_exp_group, mturk_type), {})[status] = count
+    return status_counts
+
+
+def refresh_stale_hits(mturk, conn, cursor, exp_group, max_age_minutes):
+    """
+    Syncs the open HITs and the submitted assignments in an experiment group that have not been synced with MTurk
+    recently
+    Approved and rejected assignments are never refreshed, since their status can no longer change
+    :param mturk: the mturk client instance
+    :param conn: the database connection
+    :param cursor: the database cursor
+    :param exp_group: the experiment group to refresh
+    :param max_age_minutes: HITs last synced more than this many minutes ago (or never) are synced
+    :return: the number of open HITs and submitted assignments that were synced
+    """
+
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    database_builder.create_hit_sync_times_table(cursor)
+    synced_before = datetime.datetime.now() - datetime.timedelta(minutes=max_age_minutes)
+    cursor.execute("""
+        SELECT hits.hit_id, hits.status FROM hits
+        LEFT JOIN hit_sync_times ON hit_sync_times.hit_id = hits.hit_id
+        WHERE hits.exp_group = ? AND hits.mturk_type = ?
+        AND (hit_sync_times.synced_at IS NULL OR hit_sync_times.synced_at < ?)
+    """, (exp_group, mturk_type, synced_before))
+    stale_hits = cursor.fetchall()
+
+    # The row of a HIT with several assignments only has the status of the last one, so the submitted assignments are
+    # selected whatever the status of their HIT's row
+    stale_hit_ids = {hit_id for hit_id, status in stale_hits}
+    submitted_rows = [row for row in select_submitted_assignments(cursor, mturk_type, exp_group)
+                      if row[0] in stale_hit_ids]
+    open_hit_ids = [hit_id for hit_id, status in stale_hits if status == 'Open']
+    if len(submitted_rows) > 0:
+        update_status_of_submitted_hits(mturk, conn, cursor, submitted_rows)
+
+    # New submissions for any of the open HITs show up in the listing of reviewable HITs, so a single complete pass over
+    # the listing refreshes all of them, rather than fetching the assignments of each one. The pass starts from the
+    # beginning and lists HITs of every type if none are recorded for the group, so the open HITs are only recorded as
+    # synced once every reviewable HIT has been seen. Reading the status leaves MTurk's review state as it is, and
+    # rejects nothing
+    if len(open_hit_ids) > 0:
+        sync_reviewable_hits_to_db(mturk, conn, cursor, exp_group, list_untyped_hits=True, auto_reject_empties=False,
+                                   mark_reviewing=False, resume=False)
+        record_hit_sync_times(cursor, open_hit_ids)
+        conn.commit()
+
+    return len(submitted_rows) + len(open_hit_ids)
+
+
+def record_hit_sync_times(cursor, hit_ids):
+    """
+    Records that a set of HITs were just synced with MTurk, so that get_status_of_hits does not refresh them again
+    :param cursor: the database cursor - the caller is responsible for creating the hit_sync_times table and committing
+    :param hit_ids: the IDs of the HITs that were synced
+    """
+
+    now = datetime.datetime.now()
+    cursor.executemany("INSERT OR REPLACE INTO hit_sync_times (hit_id, synced_at) VALUES (?, ?)",
+                       [(hit_id, now) for hit_id in hit_ids])
+
+
 def get_next_batch_of_submitted_results(mturk, conn, cursor, max_results_to_pull=100, auto_reject_empties=True):
     """
     Pulls a set of submitted assignments from MTurk and syncs them with the database
@@ -251,6 +866,8 @@ def get_next_batch_of_submitted_results(mturk, conn, cursor, max_results_to_pull
 
     submitted_hit_ids = []
     num_auto_rejected = 0
+    database_builder.create_assignments_table(cursor)
+    database_builder.create_assignment_blobs_table(cursor)
 
     # get all unique values of exp_group in the exp_groups table
     cursor.execute("SELECT DISTINCT exp_group FROM exp_groups")
@@ -294,20 +911,9 @@ def get_next_batch_of_submitted_results(mturk, conn, cursor, max_results_to_pull
             worker_id = assignment['WorkerId']
             interaction_log, annotation_in_progress, result_data = parse_answer_data_for_assignment(assignment)
 
-            # Update the table row
-            cursor.execute("""
-                UPDATE hits 
-                SET assignment_id = ?, 
-                status = ?, 
-                worker_id = ?, 
-                auto_approve_time = ?, 
-                interaction_log = ?, 
-                annotation_in_progress = ?, 
-                result_data = ?
-                WHERE hit_id = ?
-            """, (
-                assignment_id, status, worker_id, auto_approve_time, interaction_log, annotation_in_progress,
-                result_data, hit_id))
+            # Record the assignment alongside any other assignments of the HIT
+            record_assignments_for_hit(cursor, hit_id, mturk_client.get_mturk_type(mturk), [assignment],
+                                       parsed_answers=[(interaction_log, annotation_in_progress, result_data)])
             conn.commit()
 
             if status != 'Submitted':
@@ -327,38 +933,63 @@ def get_next_batch_of_submitted_results(mturk, conn, cursor, max_results_to_pull
     return submitted_hit_ids, num_auto_rejected
 
 
-def get_hits_with_annotation(mturk, annotation, max_results=100):
+def get_hits_with_annotation(mturk, annotation, max_results=100, max_age_seconds=None):
     """
     Gets the IDs of all HITs having a particular requester annotation (used to store the experiment group name)
+    The HITs are looked up in the cached index of the account's HITs (see reconciliation.HitIndex), so the account is
+    only listed again once the index is older than max_age_seconds, or after HITs are posted through hit_builder
 
     :param mturk: the mturk client instance
     :param annotation: the requester annotation
-    :param max_results: the max number of results to search
+    :param max_results: the number of HITs to list per request, if the index is rebuilt
+    :param max_age_seconds: the oldest index to reuse, defaults to mturk_seg_vars.hit_index_max_age_seconds
     :return: a list of HIT IDs
     """
 
-    # The list to store HIT IDs
-    hit_ids = []
+    index = reconciliation.get_hit_index(mturk, max_age_seconds=max_age_seconds, max_results=max_results)
+    return index.get_hit_ids_with_annotation(annotation)
 
-    # Start with the initial call
-    response = mturk.list_hits(MaxResults=max_results)
 
-    while response:
-        for hit in response['HITs']:
-            if hit.get('RequesterAnnotation') == annotation:
-                hit_ids.append(hit['HITId'])
+def get_annotated_objects(annotations):
+    """
+    :param annotations: parsed in-progress or final annotations (see annotation_codec.parse_annotations), or None
+    :return: the annotations that are objects, leaving out the nulls the task html submits for each annotation type that
+    is not in progress
+    """
+    if annotations is None:
+        return []
+    return [ann for ann in annotations if isinstance(ann, dict)]
 
-        # Check if there are more results to fetch
-        if 'NextToken' in response:
-            response = mturk.list_hits(NextToken=response['NextToken'], MaxResults=max_results)
-        else:
-            response = None
 
-    return hit_ids
+def count_objects_with_strokes(annotations):
+    """
+    :param annotations: parsed in-progress or final annotations, or None
+    :return: the number of annotated objects that have at least one stroke
+    """
+    return sum(1 for ann in get_annotated_objects(annotations) if len(ann.get('strokes', [])) > 0)
 
 
-def check_if_response_is_empty(interaction_log_str, annotation_in_progress_str, result_data_str):
+def has_object_without_strokes(annotations):
     """
+    :param annotations: parsed in-progress or final annotations, or None
+    :return: True if any annotated object has an empty list of strokes
+    """
+    return any('strokes' in ann and len(ann['strokes']) == 0 for ann in get_annotated_objects(annotations))
+
+
+def get_class_names(annotations):
+    """
+    :param annotations: parsed in-progress or final annotations, or None
+    :return: the set of class names set on the annotated objects
+    """
+    return {ann['class'] for ann in get_annotated_objects(annotations) if isinstance(ann.get('class'), str)}
+
+
+def check_if_response_is_empty(interaction_log_str, annotation_in_progress, result_data):
+    """
+    :param interaction_log_str: the interaction log string
+    :param annotation_in_progress: the in-progress annotation, as submitted or stored (see blob_store.load_blobs)
+    :param result_data: the final annotations, as submitted or stored
     :return: True if the annotation data is empty, false otherwise
     """
 
@@ -366,68 +997,66 @@ def check_if_response_is_empty(interaction_log_str, annotation_in_progress_str,
     if interaction_log_str is not None and len(interaction_log_str.split('-')) < 2:
         return True
 
-    # If there is no data for either the in progress of final annotations, the worker did not make any annotations
-    if annotation_in_progress_str == 'None' and result_data_str == 'None':
-        return True
-
-    if annotation_in_progress_str is not None and annotation_in_progress_str != 'None':
-        annotation_in_progress = json.loads(annotation_in_progress_str)
-        for ann in annotation_in_progress:
-            if 'data' in ann.keys() and len(ann['data']) > 0:
-                return False
-            elif 'strokes' in ann.keys() and len(ann['strokes']) > 0:
-                return False
+    for ann in get_annotated_objects(annotation_codec.parse_annotations(annotation_in_progress)):
+        if 'data' in ann.keys() and len(ann['data']) > 0:
+            return False
+        elif 'strokes' in ann.keys() and len(ann['strokes']) > 0:
+            return False
 
-    if result_data_str is not None and result_data_str != 'None':
-        result_data = json.loads(result_data_str)
-        for ann in result_data:
-            if 'strokes' in ann.keys() and len(ann['strokes']) > 0:
-                return False
-
-    return True
+    # If there is no data for either the in progress of final annotations, the worker did not make any annotations
+    return count_objects_with_strokes(annotation_codec.parse_annotations(result_data)) == 0
 
 
 def reject_empty_responses(mturk, cursor, exp_group, verbose=True):
     """
     Automatically reject all assignments listed in the database that have no annotation result data
     :param mturk: the mturk client instance
-    :param cursor: the database cursor
+    :param cursor: the database cursor - the caller is responsible for committing
     :param verbose: if true, print detailed logs to the console
     """
 
     mturk_type = mturk_client.get_mturk_type(mturk)
 
-    # Get all submitted hits
-    cursor.execute("""
-        SELECT * FROM hits 
-        WHERE status = 'Submitted' 
-        AND exp_group = ? 
-        AND mturk_type = ?
-    """, (exp_group, mturk_type))
-    results = cursor.fetchall()
+    # Get all submitted assignments, including the earlier assignments of HITs with several
+    results = blob_store.with_blobs(cursor, select_submitted_assignments(cursor, mturk_type, exp_group))
 
     # For each submitted assignment, check the result data
     for row in results:
         assignment_id = row[8]
-        interaction_log = row[10]
-        ann_in_progress = row[11]
-        ann_final = row[12]
-
-        # Fix json string formatting artifacts introduced by sqlite
-        if ann_in_progress is not None:
-            ann_in_progress = ann_in_progress.replace("\\", "")
-            ann_in_progress = ann_in_progress.replace("\"", "\'")
-        if ann_final is not None:
-            ann_final = ann_final.replace("\\", "")
-            ann_final = ann_final.replace("\"", "\'")
-
-        is_empty = check_if_response_is_empty(interaction_log, ann_in_progress, ann_final)
+        is_empty = check_if_response_is_empty(row[10], row[11], row[12])
         if is_empty:
             mturk.reject_assignment(AssignmentId=assignment_id, RequesterFeedback=reject_feedback_empty)
+            set_assignment_status(cursor, assignment_id, 'Rejected')
             if verbose:
                 print(f'Rejecting assignment {assignment_id} for exp_group {exp_group} due to empty result data')
 
 
+def reject_and_repost_empty_responses(mturk, conn, cursor, exp_group, hit_ids, verbose=False):
+    """
+    Rejects and reposts the submitted assignments of a set of HITs that have no annotation result data, as
+    get_next_batch_of_submitted_results does for the HITs it pulls
+    :param mturk: the mturk client instance
+    :param conn: the database connection
+    :param cursor: the database cursor
+    :param exp_group: the experiment group of the HITs
+    :param hit_ids: the HITs whose assignments to check
+    :param verbose: if true, print detailed logs to the console
+    :return: the number of assignments that were rejected
+    """
+
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    rows = blob_store.with_blobs(cursor, select_submitted_assignments(cursor, mturk_type, exp_group, hit_ids=hit_ids))
+
+    num_rejected = 0
+    for row in rows:
+        if check_if_response_is_empty(row[10], row[11], row[12]):
+            reject_and_repost_assignment(mturk, conn, cursor, row[8], reject_feedback_empty)
+            num_rejected += 1
+            if verbose:
+                print(f'Rejected and reposted assignment {row[8]} for exp_group {exp_group} due to empty result data')
+    return num_rejected
+
+
 def update_existing_assignment_for_hit(row, mturk, cursor, verbose=False):
     """
     Given a row from the hits table, checks whether the assignment associated with that hit has been updated
@@ -452,7 +1081,7 @@ def update_existing_assignment_for_hit(row, mturk, cursor, verbose=False):
 
     # Update the database if the new data is different from the existing data
     if new_status != current_status:
-        cursor.execute("UPDATE assignments SET status = ? WHERE assignment_id = ?", (new_status, assignment_id))
+        set_assignment_status(cursor, assignment_id, new_status)
         if verbose:
             print(f'UPDATING assignment {assignment_id}: status = {new_status}')
 
@@ -472,10 +1101,78 @@ def add_new_assignments_for_hit_to_database(hit_id, mturk, cursor, verbose=False
 
     mturk_assignments = mturk.list_assignments_for_hit(
         HITId=hit_id, AssignmentStatuses=['Submitted', 'Approved', 'Rejected'])['Assignments']
+    record_assignments_for_hit(cursor, hit_id, mturk_client.get_mturk_type(mturk), mturk_assignments, verbose=verbose,
+                               is_qual=is_qual)
+
+
+def add_new_assignments_for_hits_to_database(mturk, conn, cursor, hit_ids, verbose=False, is_qual=False):
+    """
+    Fetches the assignments for a set of HITs and adds them to the database
+    The requests are sent concurrently by posting_engine.fetch_results, and the results are written from the calling
+    thread only, committing once every mturk_seg_vars.sync_commit_every_n HITs
+    :param mturk: the mturk client instance
+    :param conn: the database connection
+    :param cursor: the database cursor
+    :param hit_ids: a list of the hit ids to query
+    :param verbose: whether or not to print details to the console
+    :param is_qual: True if these are qual tasks and should be logged to the training_tasks table
+    :return: the number of HITs whose assignments were fetched
+    """
+
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    database_builder.create_hit_sync_times_table(cursor)
+    database_builder.create_assignments_table(cursor)
+    database_builder.create_assignment_blobs_table(cursor)
+    jobs = (({'HITId': hit_id, 'AssignmentStatuses': ['Submitted', 'Approved', 'Rejected']}, hit_id)
+            for hit_id in hit_ids)
+
+    # The answers are parsed in the writer thread, unless a process pool is configured for them - small syncs never use
+    # the pool, since starting it takes longer than parsing their answers
+    results = posting_engine.fetch_results(mturk.list_assignments_for_hit, jobs)
+    parse_pool = get_parse_pool() if len(hit_ids) >= mturk_seg_vars.sync_commit_every_n else None
+    if parse_pool is None:
+        results = ((hit_id, response, error, None) for hit_id, response, error in results)
+    else:
+        results = parse_answers_in_pool(results, parse_pool)
+
+    count = 0
+    try:
+        for hit_id, response, error, parsed_answers in results:
+            if error is not None:
+                print(f'Failed to get the assignments for HIT {hit_id}: {error}')
+                continue
+            record_assignments_for_hit(cursor, hit_id, mturk_type, response['Assignments'], verbose=verbose,
+                                       is_qual=is_qual, parsed_answers=parsed_answers)
+            record_hit_sync_times(cursor, [hit_id])
+            count += 1
+            if count % mturk_seg_vars.sync_commit_every_n == 0:
+                print(f"Synced {count} of {len(hit_ids)} HITs")
+                conn.commit()
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+
+    conn.commit()
+    return count
+
+
+def record_assignments_for_hit(cursor, hit_id, mturk_type, mturk_assignments, verbose=False, is_qual=False,
+                               parsed_answers=None):
+    """
+    Writes the assignments fetched from MTurk for a HIT to the database
+    :param cursor: the database cursor
+    :param hit_id: the hit id the assignments belong to
+    :param mturk_type: 'sandbox' or 'production'
+    :param mturk_assignments: the assignments returned by list_assignments_for_hit
+    :param verbose: whether or not to print details to the console
+    :param is_qual: True if this is a qual task and should be logged to the training_tasks table
+    :param parsed_answers: the result of parse_answer_data for each assignment, if they have already been parsed
+    """
+
     print(f'Number of assignments found: {len(mturk_assignments)}')
 
     # In general there should only be one, but loop regardless
-    for assignment in mturk_assignments:
+    for index, assignment in enumerate(mturk_assignments):
 
         # Get the assignment info
         assignment_id = assignment['AssignmentId']
@@ -483,15 +1180,16 @@ def add_new_assignments_for_hit_to_database(hit_id, mturk, cursor, verbose=False
         if assignment_status == 'Reviewable':
             assignment_status = 'Submitted'
         worker_id = assignment['WorkerId']
-        auto_approve_time = assignment['AutoApprovalTime']
+        auto_approve_time = format_auto_approve_time(assignment['AutoApprovalTime'])
 
         # Get the detailed results from the assignment
-        interaction_log, annotation_in_progress, result_data = parse_answer_data_for_assignment(assignment)
+        if parsed_answers is not None:
+            interaction_log, annotation_in_progress, result_data = parsed_answers[index]
+        else:
+            interaction_log, annotation_in_progress, result_data = parse_answer_data_for_assignment(assignment)
 
         # For qual tasks there is a separate table that needs to be updated
         if is_qual:
-            mturk_type = mturk_client.get_mturk_type(mturk)
-
             # Get the relevant hit parameters
             cursor.execute("""
                 SELECT * FROM hits where hit_id = ?""", (hit_id,))
@@ -517,12 +1215,9 @@ def add_new_assignments_for_hit_to_database(hit_id, mturk, cursor, verbose=False
                     status, 
                     assignment_id, 
                     auto_approve_time, 
-                    interaction_log, 
-                    annotation_in_progress, 
-                    result_data, 
                     worker_id, 
                     qual_score) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, -1)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, -1)
                 """, (hit_id,
                       mturk_type,
                       exp_group,
@@ -533,28 +1228,33 @@ def add_new_assignments_for_hit_to_database(hit_id, mturk, cursor, verbose=False
                       assignment_status,
                       assignment_id,
                       auto_approve_time,
-                      interaction_log,
-                      annotation_in_progress,
-                      result_data,
                       worker_id))
-            except:
+                blob_store.write_blobs(cursor, assignment_id, interaction_log, annotation_in_progress, result_data)
+            except sqlite3.IntegrityError:
                 print("Error! This record is already in the training_tasks table.")
 
         else:
-            # Update the table row
+            # Every assignment is kept in the assignments table, so the results of a HIT posted with several
+            # assignments are not overwritten by the next worker's
+            cursor.execute("""
+                INSERT OR REPLACE INTO assignments
+                (assignment_id, hit_id, mturk_type, worker_id, status, auto_approve_time)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (assignment_id, hit_id, mturk_type, worker_id, assignment_status, auto_approve_time))
+
+            # The HIT's row mirrors the last assignment recorded for it, and its annotation data is stored out of row
             cursor.execute("""
                 UPDATE hits 
                 SET assignment_id = ?, 
                 status = ?, 
                 worker_id = ?, 
                 auto_approve_time = ?, 
-                interaction_log = ?, 
-                annotation_in_progress = ?, 
-                result_data = ?
+                interaction_log = NULL, 
+                annotation_in_progress = NULL, 
+                result_data = NULL
                 WHERE hit_id = ?
-            """, (
-                assignment_id, assignment_status, worker_id, auto_approve_time, interaction_log, annotation_in_progress,
-                result_data, hit_id))
+            """, (assignment_id, assignment_status, worker_id, auto_approve_time, hit_id))
+            blob_store.write_blobs(cursor, assignment_id, interaction_log, annotation_in_progress, result_data)
 
         if verbose:
             print(f'ADDING assignment {assignment_id}: status = {assignment_status}')
@@ -571,9 +1271,9 @@ def approve_assignment(mturk, conn, cursor, assignment_id):
 
     try:
         mturk.approve_assignment(AssignmentId=assignment_id)
-    except:
-        print(f'Failed to approve assignment {assignment_id}')
-    cursor.execute("UPDATE hits SET status = ? WHERE assignment_id = ?", ('Approved', assignment_id))
+    except Exception as e:
+        print(f'Failed to approve assignment {assignment_id}: {e}')
+    set_assignment_status(cursor, assignment_id, 'Approved')
     cursor.execute("UPDATE training_tasks SET status = ? WHERE assignment_id = ?", ('Approved', assignment_id))
     # TODO: eventually we should add a table for screened workers which should be updated
     conn.commit()
@@ -593,14 +1293,17 @@ def reject_and_repost_assignment(mturk, conn, cursor, assignment_id, feedback):
     # First, reject the assignment on mturk
     try:
         mturk.reject_assignment(AssignmentId=assignment_id, RequesterFeedback=feedback)
-    except:
-        print(f'Failed to reject assignment {assignment_id}')
+    except Exception as e:
+        print(f'Failed to reject assignment {assignment_id}: {e}')
 
-    # Second, update the corresponding row in the hits table of the database
-    cursor.execute("UPDATE hits SET status = ? WHERE assignment_id = ?", ('Rejected', assignment_id))
+    # Second, update the assignment and the corresponding row in the hits table of the database
+    set_assignment_status(cursor, assignment_id, 'Rejected')
+    conn.commit()
 
-    # Third, post a new hit with the same parameters as the original hit
-    cursor.execute("SELECT * FROM hits WHERE assignment_id = ?", (assignment_id,))
+    # Third, post a new hit with the same parameters as the original hit - the HIT is found through the assignments
+    # table, since its row only records the last of its assignments
+    cursor.execute("SELECT * FROM hits WHERE hit_id = (SELECT hit_id FROM assignments WHERE assignment_id = ?)",
+                   (assignment_id,))
     hit_result = cursor.fetchone()
 
     # Get the hit data
@@ -619,8 +1322,8 @@ def reject_and_repost_assignment(mturk, conn, cursor, assignment_id, feedback):
     # Fix non-compliant task parameters
     pre_annotations, time_limit = other_utils.fix_non_compliant_task_parameters(pre_annotations, time_limit)
 
-    # Generate the MTurk task XML from the html file
-    question = hit_builder.load_html_as_mturk_question(html_task_path)
+    # Get the compiled MTurk task XML for the html file
+    question = hit_builder.load_question_template(html_task_path, minify=mturk_seg_vars.minify_question_html)
 
     # Get the qualification requirements for the task
     qualification_requirements = worker_quals.get_task_qualification_set(mturk)
@@ -630,14 +1333,15 @@ def reject_and_repost_assignment(mturk, conn, cursor, assignment_id, feedback):
                                         time_limit, qualification_requirements)
 
 
+@mturk_client.request_workflow('auto_review')
 def approve_all_submitted_training_qual_tasks():
     """
     Approves all tasks designated as training, regardless of whether they were assessed as high quality
     """
 
     # Establish a connection to the database and MTurk
-    mturk = mturk_client.create_mturk_instance(sandbox=False)
-    conn = sqlite3.connect(mturk_seg_vars.db_path)
+    mturk = mturk_client.get_mturk_client(sandbox=False)
+    conn = db_connections.connect()
     cursor = conn.cursor()
 
     # select assignment_id from the table 'training_tasks' where exp_group starts with 'qual' and status = 'Submitted'
@@ -651,6 +1355,7 @@ def approve_all_submitted_training_qual_tasks():
         approve_assignment(mturk, conn, cursor, assignment_id)
 
 
+@mturk_client.request_workflow('auto_review')
 def auto_approve_if_has_multiple_annotations(exp_group, sandbox=False, verbose=False):
     """
     Automatically approves all assignments for the given experiment group if it has at least two distinct annotations
@@ -659,23 +1364,18 @@ def auto_approve_if_has_multiple_annotations(exp_group, sandbox=False, verbose=F
     """
 
     # Establish a connection to the database and MTurk
-    conn = sqlite3.connect(mturk_seg_vars.db_path)
+    conn = db_connections.connect()
     cursor = conn.cursor()
-    mturk = mturk_client.create_mturk_instance(sandbox=sandbox)
+    mturk = mturk_client.get_mturk_client(sandbox=sandbox)
     mturk_type = mturk_client.get_mturk_type(mturk)
 
-    cursor.execute("""
-        SELECT * 
-        FROM hits 
-        WHERE mturk_type = ? 
-        AND exp_group = ?
-        AND status = 'Submitted'
-        ORDER BY auto_approve_time ASC 
-    """, (mturk_type, exp_group,))
-    db_records = cursor.fetchall()
+    # Every submitted assignment, including the earlier assignments of HITs with several
+    db_records = blob_store.with_blobs(cursor, select_submitted_assignments(cursor, mturk_type, exp_group,
+                                                                            order_by_auto_approve_time=True))
 
     if verbose:
-        print(f'There are {len(db_records)} submitted HITs for experiment group {exp_group} running in {mturk_type}.')
+        print(f'There are {len(db_records)} submitted assignments for experiment group {exp_group} running in '
+              f'{mturk_type}.')
 
     # Iterate over each submitted HIT
     count = 0
@@ -683,144 +1383,100 @@ def auto_approve_if_has_multiple_annotations(exp_group, sandbox=False, verbose=F
 
         assignment_id = db_record[8]
 
-        # Check if it had an in-progress annotation when it was submitted
-        ann_in_progress = db_record[11]
-        if ann_in_progress is not None:
-            ann_in_progress = ann_in_progress.replace("\\", "")
-            ann_in_progress = ann_in_progress.replace("\"", "\'")
-
-        # Check if it had completed annotations when it was submitted
-        ann_final = db_record[12]
-        if ann_final is not None:
-            ann_final = ann_final.replace("\\", "")
-            ann_final = ann_final.replace("\"", "\'")
+        # The in-progress annotation and the completed annotations when it was submitted
+        ann_in_progress = annotation_codec.parse_annotations(db_record[11])
+        ann_final = annotation_codec.parse_annotations(db_record[12])
 
         # Check if it has two annotations
         has_two_objects = False
         # There can only be one in-progress annotation, so there must be at least one final annotation
-        if ann_final is not None and ann_final != 'None' and ann_final != '[]':
-            if ann_in_progress is not None and ann_in_progress != 'None':
-                # Make sure the data for in-progress annotation is not an empty array
-                if "\'strokes\':[]" not in ann_in_progress:
-                    # Count the instances of "\'strokes\'" in the final annotation
-                    num_strokes_final = ann_final.count("\'strokes\'")
-                    num_empty_strokes_final = ann_final.count("\'strokes\':[]")
-                    num_full_strokes_final = num_strokes_final - num_empty_strokes_final
-                    if num_full_strokes_final >= 1:
-                        has_two_objects = True
+        if ann_final:
+            if ann_in_progress is not None:
+                # Make sure the in-progress annotation has strokes
+                if not has_object_without_strokes(ann_in_progress):
+                    has_two_objects = count_objects_with_strokes(ann_final) >= 1
             else:
                 # Check that the final annotations list has at least two objects
-                num_strokes_final = ann_final.count("\'strokes\'")
-                num_empty_strokes_final = ann_final.count("\'strokes\':[]")
-                num_full_strokes_final = num_strokes_final - num_empty_strokes_final
-                if num_full_strokes_final >= 2:
-                    has_two_objects = True
+                has_two_objects = count_objects_with_strokes(ann_final) >= 2
 
         # Approve the assignment if it has at least two objects
         if has_two_objects:
             count += 1
             if verbose:
-                print(ann_in_progress)
+                print(annotation_codec.json_view(db_record[11]))
                 print("")
-                print(ann_final)
+                print(annotation_codec.json_view(db_record[12]))
                 print("")
                 print("=====================================")
             try:
                 approve_assignment(mturk, conn, cursor, assignment_id)
                 if verbose:
                     print(f"Approved assignment {assignment_id}.")
-            except:
-                print(f"Warning! MTurk failed to approve assignment {assignment_id}!")
+            except Exception as e:
+                print(f"Warning! MTurk failed to approve assignment {assignment_id}! {e}")
 
     print(f'Auto approved {count} assignments.')
 
 
+@mturk_client.request_workflow('auto_review')
 def auto_approve_if_has_multiple_classes(exp_group, sandbox=False, verbose=False):
     """
     Automatically approves assignments that have multiple object classes annotated
     :param exp_group: the experiment group to check
     """
 
-    # The list of class strings occurring in the annotation result or annotation in progress data
-    class_strings = [
-        "\'class\':\'airplane\'",
-        "\'class\':\'backpack\'",
-        "\'class\':\'bicycle\'",
-        "\'class\':\'boat\'",
-        "\'class\':\'bus\'",
-        "\'class\':\'car\'",
-        "\'class\':\'cat\'",
-        "\'class\':\'dog\'",
-        "\'class\':\'motorcycle\'",
-        "\'class\':\'person\'",
-        "\'class\':\'train\'",
-        "\'class\':\'truck\'"
-    ]
+    # The class names counted in the annotation result or annotation in progress data
+    class_names = {'airplane', 'backpack', 'bicycle', 'boat', 'bus', 'car', 'cat', 'dog', 'motorcycle', 'person',
+                   'train', 'truck'}
 
     # Set up the database and mturk sessions
-    conn = sqlite3.connect(mturk_seg_vars.db_path)
+    conn = db_connections.connect()
     cursor = conn.cursor()
-    mturk = mturk_client.create_mturk_instance(sandbox=sandbox)
+    mturk = mturk_client.get_mturk_client(sandbox=sandbox)
     mturk_type = mturk_client.get_mturk_type(mturk)
 
-    # Get all submitted hits for this experiment group and rank them in order of auto_approve_time
-    cursor.execute("""
-        SELECT * 
-        FROM hits 
-        WHERE mturk_type = ? 
-        AND exp_group = ?
-        AND status = 'Submitted'
-        ORDER BY auto_approve_time ASC 
-    """, (mturk_type, exp_group,))
-    db_records = cursor.fetchall()
+    # Get all submitted assignments for this experiment group and rank them in order of auto_approve_time, including
+    # the earlier assignments of HITs with several
+    db_records = blob_store.with_blobs(cursor, select_submitted_assignments(cursor, mturk_type, exp_group,
+                                                                            order_by_auto_approve_time=True))
 
     if verbose:
-        print(f'There are {len(db_records)} submitted HITs for experiment group {exp_group} running in {mturk_type}.')
+        print(f'There are {len(db_records)} submitted assignments for experiment group {exp_group} running in '
+              f'{mturk_type}.')
 
     # Iterate over each database record that was fetched and approve those that have at least two unique class strings listed
     count = 0
     for db_record in db_records:
         assignment_id = db_record[8]
 
-        # Create a string that contains all the annotation data for this assignment
-        full_result = ""
-
-        # Format the special characters in the current annotation data and add that to the result string
-        ann_in_progress = db_record[11]
-        if ann_in_progress is not None:
-            ann_in_progress = ann_in_progress.replace("\\", "")
-            ann_in_progress = ann_in_progress.replace("\"", "\'")
-            full_result = full_result + ann_in_progress
-
-        # Format the special characters in the final annotation data and add that to the result string
-        ann_final = db_record[12]
-        if ann_final is not None:
-            ann_final = ann_final.replace("\\", "")
-            ann_final = ann_final.replace("\"", "\'")
-            full_result = full_result + ann_final
-
-        # Test if there are at least two unique class strings across all the result data
-        if (other_utils.contains_two_substrinsgs(full_result, class_strings)
-                and ann_final is not None and ann_final != 'None' and ann_final != '[]'):
+        # Collect the classes of the objects across all the annotation data for this assignment
+        ann_in_progress = annotation_codec.parse_annotations(db_record[11])
+        ann_final = annotation_codec.parse_annotations(db_record[12])
+        annotated_classes = (get_class_names(ann_in_progress) | get_class_names(ann_final)) & class_names
+
+        # Test if there are at least two unique classes across all the result data
+        if len(annotated_classes) >= 2 and ann_final:
             if verbose:
-                print(ann_in_progress)
+                print(annotation_codec.json_view(db_record[11]))
                 print("")
-                print(ann_final)
+                print(annotation_codec.json_view(db_record[12]))
                 print("")
                 print("=====================================")
 
             # Depending on the timing of mturk and db updates, we may attempt to approve an assignment that is already approved on mturk
             try:
                 approve_assignment(mturk, conn, cursor, assignment_id)
+                count += 1
                 if verbose:
                     print(f"Approved assignment {assignment_id}.")
-            except:
-                print(f"Warning! MTurk failed to approve assignment {assignment_id}!")
+            except Exception as e:
+                print(f"Warning! MTurk failed to approve assignment {assignment_id}! {e}")
 
     # Report the number of assignments that were approved
     print(f'Auto approved {count} assignments.')
 
 
+@mturk_client.request_workflow('review')
 def override_rejected_hits(hits_to_correct, update_db=True):
     """
     Takes a list of HIT IDs, and if they are rejeted, overrides the rejection
@@ -830,8 +1486,8 @@ def override_rejected_hits(hits_to_correct, update_db=True):
     """
 
     # Establish a connection to the database and MTurk
-    mturk = mturk_client.create_mturk_instance(sandbox=False)
-    conn = sqlite3.connect(mturk_seg_vars.db_path)
+    mturk = mturk_client.get_mturk_client(sandbox=False)
+    conn = db_connections.connect()
     cursor = conn.cursor()
 
     # Iterate over each HIT listed
@@ -843,10 +1499,11 @@ def override_rejected_hits(hits_to_correct, update_db=True):
         mturk.approve_assignment(AssignmentId=assignment_id, RequesterFeedback="Corrected - mistakenly rejected", OverrideRejection=True)
 
         # Update the status for this line in the database
-        cursor.execute("UPDATE hits SET status = ? WHERE assignment_id = ?", ('Approved', assignment_id))
+        set_assignment_status(cursor, assignment_id, 'Approved')
         conn.commit()
 
 
+@mturk_client.request_workflow('sync')
 def pull_training_task_assignments_to_db(sandbox=False):
     """
     Pulls all submitted training tasks from MTurk and syncs to the table
@@ -854,11 +1511,12 @@ def pull_training_task_assignments_to_db(sandbox=False):
     """
 
     # get all rows from the table 'hits' where exp_group starts with 'qual'
-    mturk = mturk_client.create_mturk_instance(sandbox=sandbox)
+    mturk = mturk_client.get_mturk_client(sandbox=sandbox)
     mturk_type = mturk_client.get_mturk_type(mturk)
 
-    conn = sqlite3.connect(mturk_seg_vars.db_path)
+    conn = db_connections.connect()
     cursor = conn.cursor()
+    database_builder.create_assignment_blobs_table(cursor)
 
     cursor.execute("SELECT * FROM hits WHERE mturk_type = ? AND exp_group LIKE 'qual%'", (mturk_type,))
     rows = cursor.fetchall()
@@ -878,6 +1536,7 @@ def pull_training_task_assignments_to_db(sandbox=False):
         print(row)
 
 
+@mturk_client.request_workflow('remove_hits')
 def remove_hits_early(exp_group, sandbox=True, verbose=False):
     """
     Removes posted HITs from MTurk, as long as they haven't already been assigned or submitted
@@ -885,8 +1544,8 @@ def remove_hits_early(exp_group, sandbox=True, verbose=False):
     :param sandbox: if True, remove hits from the sandbox, else, remove hits from production
     """
 
-    mturk = mturk_client.create_mturk_instance(sandbox=sandbox)
-    conn = sqlite3.connect(mturk_seg_vars.db_path)
+    mturk = mturk_client.get_mturk_client(sandbox=sandbox)
+    conn = db_connections.connect()
     cursor = conn.cursor()
 
     cursor.execute("SELECT * FROM hits WHERE exp_group=?", (exp_group,))
@@ -903,8 +1562,8 @@ def remove_hits_early(exp_group, sandbox=True, verbose=False):
             mturk.delete_hit(HITId=hit_id)
             delete_count += 1
             if verbose: print(f'    Deleted HIT {hit_id}')
-        except:
-            if verbose: print(f'    Could not delete HIT {hit_id}')
+        except Exception as e:
+            if verbose: print(f'    Could not delete HIT {hit_id}: {e}')
 
         # If it can't be deleted, then expire it by moving up the auto-expire time
         try:
@@ -913,65 +1572,102 @@ def remove_hits_early(exp_group, sandbox=True, verbose=False):
             mturk.update_expiration_for_hit(HITId=hit_id, ExpireAt=current_time)
             expired_count += 1
             if verbose: print(f'    Expired HIT {hit_id}')
-        except:
-            if verbose: print(f'    Could not expire HIT {hit_id}')
+        except Exception as e:
+            if verbose: print(f'    Could not expire HIT {hit_id}: {e}')
 
     print(f'deleted {delete_count}')
     print(f'expired {expired_count}')
 
 
-def update_status_for_approved_and_rejected_hits(sandbox=False):
+@mturk_client.request_workflow('status_update')
+def update_status_for_approved_and_rejected_hits(sandbox=False, incremental=False, infer=False):
     """
     HITs that have their status modified directly by MTurk (e.g., due to expiry) will not have that change automatically reflected in the table
-    This method checks each HIT listed as submitted in the table and updates the record if it was approved or rejected by MTurk
+    This method checks each assignment listed as submitted in the table and updates the record if it was approved or
+    rejected by MTurk
     :param sandbox: True if updating hits in the sandbox, False otherwise
+    :param incremental: if True, only the submitted assignments that are past their auto-approval time are checked
+    :param infer: if True, the assignments past their auto-approval time are marked as approved locally (see
+    infer_auto_approved_hits), MTurk is only asked about the assignments with no auto-approval time, and the oldest
+    unaudited inferences are checked against MTurk (up to mturk_seg_vars.status_inference_audits_per_pass)
     """
 
     # Open connections to the DB and MTurk
-    conn = sqlite3.connect(mturk_seg_vars.db_path)
+    conn = db_connections.connect()
     cursor = conn.cursor()
-    mturk = mturk_client.create_mturk_instance(sandbox=sandbox)
+    mturk = mturk_client.get_mturk_client(sandbox=sandbox)
     mturk_type = mturk_client.get_mturk_type(mturk)
 
+    # Pull all the submitted assignments, including the earlier assignments of HITs with several
+    if infer:
+        num_inferred = infer_auto_approved_hits(cursor, mturk_type)
+        conn.commit()
+        print(f'Marked {num_inferred} assignments past their auto-approval time as approved, pending audit')
+        rows = select_ambiguous_submitted_hits(cursor, mturk_type)
+        print(f'There are currently {len(rows)} submitted assignments in the database with no auto-approval time')
+    elif incremental:
+        rows = select_overdue_submitted_hits(cursor, mturk_type)
+        print(f'There are currently {len(rows)} submitted assignments in the database past their auto-approval time')
+    else:
+        rows = select_submitted_assignments(cursor, mturk_type)
+        print(f'There are currently {len(rows)} submitted assignments in the database')
+
+    approved_count, rejected_count = update_status_of_submitted_hits(mturk, conn, cursor, rows)
+
+    print(f'Approved {approved_count} assignments')
+    print(f'Rejected {rejected_count} assignments')
+
+    if infer and mturk_seg_vars.status_inference_audits_per_pass != 0:
+        num_checked, num_corrected = audit_inferred_statuses(
+            mturk, conn, cursor, max_audits=mturk_seg_vars.status_inference_audits_per_pass)
+        print(f'Audited {num_checked} inferred statuses against MTurk, and corrected {num_corrected}')
+
+    rows = select_submitted_assignments(cursor, mturk_type)
+    print(f'There are now {len(rows)} submitted assignments in the database')
+
+
+def update_status_of_submitted_hits(mturk, conn, cursor, rows):
+    """
+    Checks each of a set of submitted assignments on MTurk, and updates the ones that were approved or rejected
+    The requests are sent concurrently by posting_engine.fetch_results, and the results are written from this thread
+    :param mturk: the mturk client instance
+    :param conn: the database connection
+    :param cursor: the database cursor
+    :param rows: the rows to check, one per assignment, as returned by select_submitted_assignments
+    :return: the number of assignments that were approved, and the number that were rejected
+    """
+
     # Initialize the count variables
     approved_count = 0
     rejected_count = 0
     row_count = 0
 
-    # Pull all the rows from the hits table listed as submitted
-    cursor.execute("SELECT * FROM hits WHERE status='Submitted' AND mturk_type=?", (mturk_type,))
-    rows = cursor.fetchall()
-    print(f'There are currently {len(rows)} submitted HITs in the database')
-
     # For each row, get the status of the assignment for that hit from MTurk
-    for row in rows:
+    database_builder.create_hit_sync_times_table(cursor)
+    jobs = (({'AssignmentId': row[8]}, row) for row in rows)
+    for row, assignment, error in posting_engine.fetch_results(mturk.get_assignment, jobs):
         hit_id = row[0]
-        assignment_id = row[8]
-
-        # get the assignment from mturk
-        assignment = mturk.get_assignment(AssignmentId=assignment_id)
+        if error is not None:
+            print(f'Failed to get assignment {row[8]} for HIT {hit_id}: {error}')
+            continue
         mturk_status = assignment['Assignment']['AssignmentStatus']
+        record_hit_sync_times(cursor, [hit_id])
 
         # Update the table for any HITs that were auto-approved or auto-rejected by MTurk (usually due to task expiry)
         if mturk_status == 'Approved':
             approved_count += 1
-            cursor.execute("UPDATE hits SET status=? WHERE hit_id=?", (mturk_status, hit_id))
+            set_assignment_status(cursor, row[8], mturk_status)
         elif mturk_status == 'Rejected':
             rejected_count += 1
-            cursor.execute("UPDATE hits SET status=? WHERE hit_id=?", (mturk_status, hit_id))
+            set_assignment_status(cursor, row[8], mturk_status)
 
         # Only commit changes at intervals to improve performance
         row_count += 1
-        if row_count % 10 == 0:
+        if row_count % mturk_seg_vars.sync_commit_every_n == 0:
             print(f'Processed {row_count} rows')
             conn.commit()
 
     # At the end, commit any remaining changes
     conn.commit()
 
-    print(f'Approved {approved_count} HITs')
-    print(f'Rejected {rejected_count} HITs')
-
-    cursor.execute("SELECT * FROM hits WHERE status='Submitted' AND mturk_type='production'")
-    rows = cursor.fetchall()
-    print(f'There are now {len(rows)} submitted HITs in the database')
\ No newline at end of file
+    return approved_count, rejected_count
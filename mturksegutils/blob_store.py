@@ -0,0 +1,154 @@
+"""
+Compressed, out-of-row storage for the annotation data of each assignment
+
+The interaction_log, annotation_in_progress and result_data of an assignment are large json strings that only the review
+app and the auto-review checks read, so they are kept compressed in the assignment_blobs table, keyed by assignment_id,
+instead of inline in the hits, assignments and training_tasks tables. Those tables keep their blob columns, empty, so
+the positions of the other columns in their rows do not change, and reading a HIT's status no longer pulls its
+annotation data through SQLite's page cache.
+
+Final annotations that annotation_codec can encode exactly are stored in its binary form rather than as json, which is
+smaller even once both are compressed, and is decoded straight to NumPy arrays - so the result_data loaded for an
+assignment is either the encoded bytes or a json string, and is read with annotation_codec.parse_annotations or
+annotation_codec.json_view.
+
+Callers that need the annotation data load it for the rows they hold with with_blobs, or for a set of assignments with
+load_blobs. Databases created before the data was moved are migrated by migrations.move_blobs_out_of_row, and their
+final annotations are encoded by migrations.encode_result_data.
+"""
+
+import zlib
+
+from mturksegutils import mturk_seg_vars, annotation_codec
+
+
+blob_columns = ('interaction_log', 'annotation_in_progress', 'result_data')
+
+# The positions of the assignment ID and the blob columns in the rows of the hits and training_tasks tables
+row_assignment_id_index = 8
+row_blob_indexes = (10, 11, 12)
+
+# Compressors and decompressors for zstd, which are reused because they are expensive to create
+zstd_codecs = {}
+
+
+def get_zstd_codec(name):
+    if name not in zstd_codecs:
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("The 'zstd' blob compression requires the zstandard package")
+        zstd_codecs['compressor'] = zstandard.ZstdCompressor(level=mturk_seg_vars.blob_compression_level)
+        zstd_codecs['decompressor'] = zstandard.ZstdDecompressor()
+    return zstd_codecs[name]
+
+
+def compress(text, codec=None):
+    """
+    :param text: the string or bytes to compress, or None
+    :param codec: 'zlib' or 'zstd', defaults to mturk_seg_vars.blob_compression
+    :return: the compressed bytes (the utf-8 bytes of a string), or None if it was None
+    """
+
+    if text is None:
+        return None
+    if codec is None:
+        codec = mturk_seg_vars.blob_compression
+    data = text.encode('utf-8') if isinstance(text, str) else text
+    if codec == 'zlib':
+        return zlib.compress(data, mturk_seg_vars.blob_compression_level)
+    if codec == 'zstd':
+        return get_zstd_codec('compressor').compress(data)
+    raise ValueError(f'Unknown blob compression: {codec}')
+
+
+def decompress(data, codec):
+    """
+    :param data: the bytes returned by compress, or None
+    :param codec: the codec the bytes were compressed with
+    :return: the original string, the original bytes if they were encoded by annotation_codec, or None
+    """
+
+    if data is None:
+        return None
+    if codec == 'zlib':
+        data = zlib.decompress(data)
+    elif codec == 'zstd':
+        data = get_zstd_codec('decompressor').decompress(data)
+    else:
+        raise ValueError(f'Unknown blob compression: {codec}')
+    return data if annotation_codec.is_encoded(data) else data.decode('utf-8')
+
+
+def write_blobs(cursor, assignment_id, interaction_log, annotation_in_progress, result_data, codec=None):
+    """
+    Stores the annotation data of an assignment, replacing any that was stored before
+    The final annotations are stored encoded by annotation_codec if they can be encoded exactly, and as json otherwise
+    :param cursor: the database cursor - the caller is responsible for committing
+    :param assignment_id: the assignment
+    :param interaction_log: the interaction log string
+    :param annotation_in_progress: the json string of the in-progress annotation
+    :param result_data: the json string of the final annotations
+    :param codec: 'zlib' or 'zstd', defaults to mturk_seg_vars.blob_compression
+    """
+
+    if codec is None:
+        codec = mturk_seg_vars.blob_compression
+    encoded_result_data = annotation_codec.encode_annotation_json(result_data)
+    if encoded_result_data is not None:
+        result_data = encoded_result_data
+    cursor.execute("""
+        INSERT OR REPLACE INTO assignment_blobs
+        (assignment_id, codec, interaction_log, annotation_in_progress, result_data)
+        VALUES (?, ?, ?, ?, ?)
+    """, (assignment_id, codec, compress(interaction_log, codec), compress(annotation_in_progress, codec),
+          compress(result_data, codec)))
+
+
+def load_blobs(cursor, assignment_ids):
+    """
+    Loads the annotation data of a set of assignments
+    :param cursor: the database cursor
+    :param assignment_ids: the assignments
+    :return: a dictionary of the (interaction_log, annotation_in_progress, result_data) of each assignment, leaving out
+    the assignments with no stored data - result_data is the bytes encoded by annotation_codec, or a json string
+    """
+
+    blobs = {}
+    assignment_ids = list(assignment_ids)
+    # Chunked to stay under SQLite's limit on the number of query parameters
+    for start in range(0, len(assignment_ids), 500):
+        chunk = assignment_ids[start:start + 500]
+        cursor.execute(f"SELECT assignment_id, codec, interaction_log, annotation_in_progress, result_data "
+                       f"FROM assignment_blobs WHERE assignment_id IN ({', '.join('?' * len(chunk))})", chunk)
+        for assignment_id, codec, *data in cursor.fetchall():
+            blobs[assignment_id] = tuple(decompress(value, codec) for value in data)
+    return blobs
+
+
+def with_blobs(cursor, rows):
+    """
+    Fills in the blob columns of rows read with SELECT * from the hits or training_tasks tables
+    Rows whose data is still stored inline, in a database that has not been migrated, are returned unchanged
+    :param cursor: the database cursor
+    :param rows: the rows
+    :return: the rows, as tuples, with their interaction_log, annotation_in_progress and result_data filled in (see
+    load_blobs)
+    """
+
+    def is_out_of_row(row):
+        return row[row_assignment_id_index] is not None and all(row[index] is None for index in row_blob_indexes)
+
+    assignment_ids = [row[row_assignment_id_index] for row in rows if is_out_of_row(row)]
+    if len(assignment_ids) == 0:
+        return [tuple(row) for row in rows]
+    blobs = load_blobs(cursor, assignment_ids)
+
+    filled_rows = []
+    for row in rows:
+        row = list(row)
+        if is_out_of_row(row) and row[row_assignment_id_index] in blobs:
+            for index, value in zip(row_blob_indexes, blobs[row[row_assignment_id_index]]):
+                row[index] = value
+        filled_rows.append(tuple(row))
+    return filled_rows
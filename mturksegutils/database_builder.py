@@ -6,10 +6,13 @@ from mturksegutils import mturk_seg_vars
 db_path = mturk_seg_vars.db_path
 
 
-def create_hits_table():
+def create_hits_table(cursor=None):
     """
     Creates a table for storing the data on each MTurk HIT
-    Currently assumes only a single assignment per HIT in the main experiment
+    Every assignment of a HIT is stored in the assignments table - the assignment columns here mirror the HIT's most
+    recently synced assignment, for the code that handles one assignment per HIT
+    The annotation data of the assignments is stored in the assignment_blobs table, and the interaction_log,
+    annotation_in_progress and result_data columns are left empty (see blob_store.py)
     - hit_id: the unique HIT ID assignned by Amazon when the HIT is created
     - mturk type: "production" if the hit is posted to the production environment, "sandbox" otherwise
     - exp_group: which experiment group the hit is a part of
@@ -24,10 +27,13 @@ def create_hits_table():
     - annotation_in_progress: the json data for in-progress annotations for the assignment, if one is available
     - result_data: the json data for final annotations for the assignment, if one is available
     - worker_id: the unique Amazon ID for the worker who completed the assignment, if one is available
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a migration
     """
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
 
     # Table 'hits' stores data on each individual HIT and any associated assignment
     cursor.execute('''
@@ -41,16 +47,153 @@ def create_hits_table():
         pre_annotations TEXT,
         status TEXT,
         assignment_id TEXT,
-        auto_approve_time DATETIME
+        auto_approve_time DATETIME,
         interaction_log TEXT,
         annotation_in_progress TEXT,
         result_data TEXT,
         worker_id TEXT
     )
     ''')
+    create_hits_image_url_index(cursor)
+    create_hits_indexes(cursor)
+    create_assignments_table(cursor)
+    create_assignment_blobs_table(cursor)
 
-    conn.commit()
-    conn.close()
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_hits_image_url_index(cursor=None):
+    """
+    Creates an index for looking up the HITs posted for each task, e.g. when resuming a batch
+    :param cursor: an optional database cursor to create the index through, e.g. in the middle of a transaction
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS hits_exp_group_image_url ON hits (exp_group, image_url)
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_hits_indexes(cursor=None):
+    """
+    Creates the indexes for the hot lookups of the hits table, so that none of them scans the whole table
+    - (mturk_type, status, auto_approve_time, hit_id): the review queue, which takes the submitted HIT nearest its
+      auto-approval time, and the status syncs and scheduler, which read only the IDs and times of the submitted HITs
+    - (exp_group, mturk_type, status, auto_approve_time): the submitted or open HITs of one experiment group, e.g. in
+      auto_approve_* and the sync, and the per-group status counts of the batch summary
+    - (assignment_id): approving and rejecting an assignment
+    :param cursor: an optional database cursor to create the indexes through, e.g. in the middle of a migration
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS hits_mturk_type_status_auto_approve_time
+    ON hits (mturk_type, status, auto_approve_time, hit_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS hits_exp_group_mturk_type_status
+    ON hits (exp_group, mturk_type, status, auto_approve_time)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS hits_assignment_id ON hits (assignment_id)
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_assignments_table(cursor=None):
+    """
+    Creates a table for storing every assignment of the HITs in the hits table, so HITs posted with several assignments
+    (e.g. repeated by several workers) keep each worker's results
+    - assignment_id: the unique ID of the assignment assigned by Amazon
+    - hit_id: the HIT the assignment belongs to
+    - mturk_type: "production" if the HIT is in the production environment, "sandbox" otherwise
+    - worker_id: the unique Amazon ID for the worker who completed the assignment
+    - status: the status of the assignment, i.e. 'Submitted', 'Approved' or 'Rejected'
+    - auto_approve_time: the time at which the assignment will auto-approve, in UTC (see
+    assignment_manager.format_auto_approve_time)
+    - interaction_log, annotation_in_progress, result_data: empty - the assignment's annotation data is stored in the
+    assignment_blobs table
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a migration
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS assignments (
+        assignment_id TEXT PRIMARY KEY,
+        hit_id TEXT REFERENCES hits (hit_id),
+        mturk_type TEXT,
+        worker_id TEXT,
+        status TEXT,
+        auto_approve_time DATETIME,
+        interaction_log TEXT,
+        annotation_in_progress TEXT,
+        result_data TEXT
+    )
+    ''')
+    # The assignments of a HIT, the submitted assignments nearest their deadline, and the assignments of a worker
+    cursor.execute("CREATE INDEX IF NOT EXISTS assignments_hit_id ON assignments (hit_id)")
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS assignments_mturk_type_status_auto_approve_time
+    ON assignments (mturk_type, status, auto_approve_time)
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS assignments_worker_id ON assignments (worker_id, status)")
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_assignment_blobs_table(cursor=None):
+    """
+    Creates a table for storing the annotation data of each assignment, compressed, out of the rows of the hits,
+    assignments and training_tasks tables (see blob_store.py)
+    - assignment_id: the unique ID of the assignment assigned by Amazon
+    - codec: the compression the data was stored with, 'zlib' or 'zstd'
+    - interaction_log: the compressed interaction log data for the assignment
+    - annotation_in_progress: the compressed json data for in-progress annotations for the assignment
+    - result_data: the compressed json data for final annotations for the assignment
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a migration
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS assignment_blobs (
+        assignment_id TEXT PRIMARY KEY,
+        codec TEXT,
+        interaction_log BLOB,
+        annotation_in_progress BLOB,
+        result_data BLOB
+    )
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
 
 
 def create_exp_groups_table():
@@ -116,6 +259,8 @@ def create_training_task_table():
     """
     Creates a table for storing training task results
     Training tasks differ from experiment group HITs because there can be multiple assignments per task
+    The annotation data of the assignments is stored in the assignment_blobs table, and the interaction_log,
+    annotation_in_progress and result_data columns are left empty (see blob_store.py)
     - hit_id: the unique HIT ID assignned by Amazon when the HIT is created
     - mturk type: "production" if the hit is posted to the production environment, "sandbox" otherwise
     - exp_group: which experiment group the hit is a part of
@@ -156,6 +301,313 @@ def create_training_task_table():
         PRIMARY KEY (hit_id, assignment_id)
     )
     ''')
+    create_training_tasks_indexes(cursor)
+    create_assignment_blobs_table(cursor)
 
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+
+
+def create_training_tasks_indexes(cursor=None):
+    """
+    Creates the indexes for the hot lookups of the training_tasks table (lookups by HIT use the primary key)
+    - (mturk_type, status, qual_score, auto_approve_time): the qual review queue, which takes the unreviewed submission
+      nearest its auto-approval time
+    - (assignment_id): approving and rejecting an assignment
+    :param cursor: an optional database cursor to create the indexes through, e.g. in the middle of a migration
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS training_tasks_mturk_type_status_auto_approve_time
+    ON training_tasks (mturk_type, status, qual_score, auto_approve_time)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS training_tasks_assignment_id ON training_tasks (assignment_id)
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_qualification_types_table(cursor=None):
+    """
+    Creates a table that caches the IDs of the custom qualification types owned by the requester
+    Entries are filled in by worker_quals.get_qual_id and cleared by worker_quals.invalidate_qual_id_cache
+    - mturk_type: "production" if the qualification type exists in the production environment, "sandbox" otherwise
+    - qual_name: the name of the qualification type
+    - qual_type_id: the unique qualification type ID assigned by Amazon
+    - updated_at: the time at which the ID was last fetched from MTurk
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a transaction
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS qualification_types (
+        mturk_type TEXT,
+        qual_name TEXT,
+        qual_type_id TEXT,
+        updated_at DATETIME,
+        PRIMARY KEY (mturk_type, qual_name)
+    )
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_hit_types_table(cursor=None):
+    """
+    Creates a table that caches the HIT types registered for each experiment group, so they can be reused by every HIT
+    - hit_type_id: the unique HIT type ID assigned by Amazon
+    - mturk_type: "production" if the HIT type exists in the production environment, "sandbox" otherwise
+    - exp_group: the experiment group the HIT type was registered for
+    - reward: the reward size, in dollars, as sent to MTurk
+    - assignment_duration: the time limit for each assignment, in seconds
+    - qualification_key: a hash of the qualification requirements for the HIT type
+    - params_hash: a hash of all of the HIT type parameters, used to detect changes to the title, description, etc.
+    - created_at: the time at which the HIT type was registered
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a transaction
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS hit_types (
+        hit_type_id TEXT,
+        mturk_type TEXT,
+        exp_group TEXT,
+        reward TEXT,
+        assignment_duration INTEGER,
+        qualification_key TEXT,
+        params_hash TEXT,
+        created_at DATETIME,
+        PRIMARY KEY (mturk_type, exp_group, reward, assignment_duration, qualification_key)
+    )
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_hit_posting_journal_table(cursor=None):
+    """
+    Creates a table that journals each HIT request sent while posting a batch, so that an interrupted batch can resume
+    A row is written before the request is sent and updated once the HIT has been recorded in the hits table
+    - mturk_type: "production" if the HIT is posted to the production environment, "sandbox" otherwise
+    - exp_group: the experiment group the HIT is posted for
+    - img_url: the image for the HIT, which identifies the task within its experiment group
+    - request_token: the UniqueRequestToken sent with the request, which MTurk uses to reject duplicate HITs
+    - status: 'pending' if the request may have been sent, 'posted' once the HIT is recorded, 'failed' if MTurk rejected it
+    - hit_id: the HIT ID returned by MTurk, once the HIT is posted
+    - error: the error returned by MTurk, if the request failed
+    - token_sent_at: the time at which the request token was first sent (MTurk only remembers tokens for 24 hours)
+    - updated_at: the time at which the row was last updated
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a transaction
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS hit_posting_journal (
+        mturk_type TEXT,
+        exp_group TEXT,
+        img_url TEXT,
+        request_token TEXT,
+        status TEXT,
+        hit_id TEXT,
+        error TEXT,
+        token_sent_at DATETIME,
+        updated_at DATETIME,
+        PRIMARY KEY (mturk_type, exp_group, img_url)
+    )
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_sync_state_table(cursor=None):
+    """
+    Creates a table that records how far the incremental sync has got through the reviewable HITs of each HIT type
+    - mturk_type: "production" if the HITs are in the production environment, "sandbox" otherwise
+    - exp_group: the experiment group being synced
+    - hit_type_id: the HIT type whose reviewable HITs are listed, or '' if the group has no recorded HIT types
+    - next_token: the NextToken of the next page to fetch, if the last pass over the reviewable HITs was interrupted
+    - last_synced_at: the time at which the last complete pass over the reviewable HITs finished
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a transaction
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sync_state (
+        mturk_type TEXT,
+        exp_group TEXT,
+        hit_type_id TEXT,
+        next_token TEXT,
+        last_synced_at DATETIME,
+        PRIMARY KEY (mturk_type, exp_group, hit_type_id)
+    )
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_hit_sync_times_table(cursor=None):
+    """
+    Creates a table that records when each HIT was last synced with MTurk, so that status checks can tell which locally
+    stored HITs are out of date
+    - hit_id: the unique HIT ID assigned by Amazon
+    - synced_at: the time at which the HIT's assignments were last fetched from MTurk
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a transaction
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS hit_sync_times (
+        hit_id TEXT PRIMARY KEY,
+        synced_at DATETIME
+    )
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_status_inferences_table(cursor=None):
+    """
+    Creates a table that flags the HITs whose status was inferred locally rather than read from MTurk, for auditing
+    - hit_id: the unique HIT ID assigned by Amazon
+    - assignment_id: the assignment whose status was inferred
+    - mturk_type: "production" if the HIT is in the production environment, "sandbox" otherwise
+    - inferred_status: the status the HIT was given, e.g. 'Approved' once its auto_approve_time had passed
+    - inferred_at: the time at which the status was inferred
+    - audit_status: the assignment status MTurk reported when the inference was audited, or NULL if it has not been
+    - audited_at: the time at which the inference was audited
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a transaction
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS status_inferences (
+        hit_id TEXT,
+        assignment_id TEXT,
+        mturk_type TEXT,
+        inferred_status TEXT,
+        inferred_at DATETIME,
+        audit_status TEXT,
+        audited_at DATETIME,
+        PRIMARY KEY (hit_id, assignment_id)
+    )
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_mturk_call_metrics_table(cursor=None):
+    """
+    Creates a table that summarizes the MTurk calls each process made during each period (see mturk_metrics.py)
+    - period_start, period_end: the period the calls were made in
+    - pid: the process that made the calls
+    - mturk_type: "production" if the calls were made to the production environment, "sandbox" otherwise
+    - operation: the MTurk operation, e.g. 'GetAssignment'
+    - workflow: the workflow that made the calls, e.g. 'sync' or 'review'
+    - num_calls, num_errors: the number of calls, and the number of those that failed
+    - num_retries, num_throttled: the number of retried attempts, and the number of attempts that MTurk throttled
+    - total_latency, max_latency, p50_latency, p95_latency: the latencies of the calls, in seconds
+    - latency_buckets: a json list of the number of calls in each bucket of mturk_metrics.latency_buckets
+    - error_classes: a json dictionary of the number of failed calls by error code or exception class
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a transaction
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS mturk_call_metrics (
+        period_start DATETIME,
+        period_end DATETIME,
+        pid INTEGER,
+        mturk_type TEXT,
+        operation TEXT,
+        workflow TEXT,
+        num_calls INTEGER,
+        num_errors INTEGER,
+        num_retries INTEGER,
+        num_throttled INTEGER,
+        total_latency REAL,
+        max_latency REAL,
+        p50_latency REAL,
+        p95_latency REAL,
+        latency_buckets TEXT,
+        error_classes TEXT
+    )
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+
+def create_schema_migrations_table(cursor=None):
+    """
+    Creates a table that records the schema migrations applied to the database (see migrations.py)
+    - version: the version number of the migration
+    - name: the name of the migration
+    - applied_at: the time at which the migration was applied
+    :param cursor: an optional database cursor to create the table through, e.g. in the middle of a transaction
+    """
+
+    conn = None
+    if cursor is None:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at DATETIME
+    )
+    ''')
+
+    if conn is not None:
+        conn.commit()
+        conn.close()
@@ -0,0 +1,141 @@
+"""
+Connections to the experiment database
+
+Every connection opened with connect() puts the database in WAL journal mode, in which readers keep reading the last
+committed state while a write is in progress, and a writer does not wait for readers. A sync that is writing assignments
+therefore no longer blocks the review app, and the review app's reads no longer block a sync. Connections also wait up
+to mturk_seg_vars.db_busy_timeout seconds for another writer to finish instead of failing at once, and set the pragmas
+in apply_pragmas.
+
+A process that handles requests on several threads (e.g. the review app) uses a ConnectionPool: each thread reads
+through a read-only connection of its own, and every write goes through one shared writer connection, one transaction
+at a time.
+"""
+
+import contextlib
+import sqlite3
+import threading
+
+from mturksegutils import mturk_seg_vars
+
+
+def apply_pragmas(conn, read_only=False):
+    """
+    Sets the journal mode and the per-connection pragmas from mturk_seg_vars on a new connection
+    :param conn: the connection, which must not be in a transaction
+    :param read_only: True to reject writes through the connection
+    """
+
+    # The journal mode is stored in the database file, so it only needs to be changed once - if another connection is
+    # writing to the database, it is left as it is, and changed by the next connection instead
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    if journal_mode.lower() != mturk_seg_vars.db_journal_mode.lower():
+        try:
+            conn.execute(f"PRAGMA journal_mode = {mturk_seg_vars.db_journal_mode}")
+        except sqlite3.OperationalError:
+            pass
+    # In WAL mode, NORMAL only syncs to disk at checkpoints: a power failure can lose the last transactions, but cannot
+    # corrupt the database
+    conn.execute(f"PRAGMA synchronous = {mturk_seg_vars.db_synchronous}")
+    conn.execute(f"PRAGMA cache_size = -{mturk_seg_vars.db_cache_size_kb}")
+    conn.execute(f"PRAGMA mmap_size = {mturk_seg_vars.db_mmap_size_mb * 2 ** 20}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
+
+
+def connect(db_path=None, read_only=False, **connect_params):
+    """
+    Opens a connection to the experiment database
+    :param db_path: the database, defaults to mturk_seg_vars.db_path
+    :param read_only: True to reject writes through the connection
+    :param connect_params: other parameters for sqlite3.connect, e.g. isolation_level or check_same_thread
+    :return: the connection
+    """
+
+    if db_path is None:
+        db_path = mturk_seg_vars.db_path
+    connect_params.setdefault('timeout', mturk_seg_vars.db_busy_timeout)
+    conn = sqlite3.connect(db_path, **connect_params)
+    apply_pragmas(conn, read_only=read_only)
+    return conn
+
+
+class ConnectionPool:
+    """
+    The connections of a multi-threaded process: a read-only connection per thread, and one writer shared by every
+    thread
+    Reads never wait for the writer, so a request that only reads is answered while another request is writing, or is
+    waiting on MTurk in the middle of a write
+    """
+
+    def __init__(self, db_path=None):
+        """
+        :param db_path: the database, defaults to mturk_seg_vars.db_path
+        """
+
+        self.db_path = db_path if db_path is not None else mturk_seg_vars.db_path
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        self.writer_conn = None
+        self.writer_lock = threading.Lock()
+
+    def reader(self):
+        """
+        :return: the calling thread's read-only connection, which is opened the first time the thread reads
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = connect(self.db_path, read_only=True)
+            self.local.conn = conn
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def read(self):
+        """
+        Yields a cursor on the calling thread's read-only connection
+        The cursor is closed when the block exits, so that the snapshot it read from is released and does not hold back
+        the checkpoints of the write-ahead log
+        """
+        cursor = self.reader().cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    @contextlib.contextmanager
+    def write(self):
+        """
+        Yields the writer connection and a cursor on it, to one thread at a time
+        The transaction is committed when the block exits, or rolled back if it raises
+        """
+        with self.writer_lock:
+            if self.writer_conn is None:
+                # Only ever used by the thread holding the lock, so it can be shared between threads
+                self.writer_conn = connect(self.db_path, check_same_thread=False)
+            cursor = self.writer_conn.cursor()
+            try:
+                yield self.writer_conn, cursor
+                self.writer_conn.commit()
+            except BaseException:
+                self.writer_conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def close(self):
+        """
+        Closes the writer, and the read connections of every thread - a thread that reads again afterwards must not
+        reuse its closed connection, so the pool should not be used after it is closed
+        """
+        with self.writer_lock:
+            if self.writer_conn is not None:
+                self.writer_conn.close()
+                self.writer_conn = None
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
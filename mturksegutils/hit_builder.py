@@ -1,8 +1,41 @@
+import hashlib
+import datetime
+import json
 import numbers
+import os
+import re
 
-from mturksegutils import mturk_client, mturk_seg_vars, worker_quals, other_utils
+from mturksegutils import mturk_client, mturk_seg_vars, worker_quals, other_utils, posting_engine, database_builder, \
+    notification_ingest, reconciliation
 
 
+# The placeholders in the task html, and the names of the template slots they are filled in through
+question_template_slots = {
+    '${img_url}': 'img_url',
+    '${classes}': 'classes',
+    '${annotation_mode}': 'annotation_mode',
+    '[**X**]': 'num_objects_headline'
+}
+
+# Compiled question templates, keyed by (html file path, minify) and by the question xml text respectively
+compiled_question_cache = {}
+compiled_question_text_cache = {}
+
+# The create_hit parameters that are fixed by the HIT type, rather than sent with each HIT
+hit_type_param_names = ('Title', 'Description', 'Keywords', 'Reward', 'AssignmentDurationInSeconds',
+                        'AutoApprovalDelayInSeconds', 'QualificationRequirements')
+
+# HIT type IDs, keyed by (mturk_type, exp_group, reward, assignment duration, qualification key, params hash)
+hit_type_cache = {}
+
+# How long MTurk remembers a UniqueRequestToken - after this, re-sending a request may create a duplicate HIT
+request_token_lifetime = datetime.timedelta(hours=24)
+
+# How long after submission MTurk approves an assignment that has not been reviewed
+auto_approval_delay_in_seconds = 604800         # 7 days
+
+
+@mturk_client.request_workflow('posting')
 def create_segmentation_batch(mturk,
                               conn,
                               cursor,
@@ -11,7 +44,9 @@ def create_segmentation_batch(mturk,
                               end_at=8000,
                               num_assignments_per_hit=1,
                               print_status_every_n=10,
-                              invite_only=False):
+                              invite_only=False,
+                              num_workers=None,
+                              requests_per_second=None):
     """
     Creates a full batch of HITs by referencing the database for the given batch parameters
 
@@ -19,17 +54,26 @@ def create_segmentation_batch(mturk,
     :param conn: a connection to the sqlite3 database
     :param cursor: the database client
     :param exp_group: the experiment group ID
-    :param start_at: the index from the sequence of tasks for this exp_group to start at
-    :param end_at: the index from the sequence of tasks for this exp_group to stop at
+    :param start_at: the index from the sequence of tasks for this exp_group (ordered by img_url) to start at
+    :param end_at: the index from the sequence of tasks for this exp_group (ordered by img_url) to stop at
+    An interrupted batch is resumed by calling this again with the same arguments - tasks that were already posted are
+    skipped using the hit_posting_journal table, so there is no need to adjust start_at
     :param num_assignments_per_hit: the max number of assignments per hit that is constructed
     :param print_status_every_n: prints a status update after every N hits are posted
     :param invite_only: if true, apply the invite only qual when creating this batch of hits
+    :param num_workers: the max number of concurrent create_hit calls, defaults to mturk_seg_vars.posting_num_workers
+    :param requests_per_second: the target rate of create_hit calls, defaults to mturk_seg_vars.posting_requests_per_second
+    :return: the number of HITs created, and a list of the image URLs for any tasks that failed to post
     """
 
     mturk_type = mturk_client.get_mturk_type(mturk)
 
-    # Generate the MTurk task XML from the html file
-    question = load_html_as_mturk_question(mturk_seg_vars.html_task_path)
+    # If a HIT layout has been registered for this environment, HITs reference it instead of sending the task XML
+    hit_layout_id = get_hit_layout_id(mturk)
+    question = None
+    if hit_layout_id is None:
+        # Compile the MTurk task XML from the html file
+        question = load_question_template(mturk_seg_vars.html_task_path, minify=mturk_seg_vars.minify_question_html)
 
     # Establish what score the participant must have on the qual to complete this task
     exp_group_query = exp_group
@@ -61,53 +105,122 @@ def create_segmentation_batch(mturk,
     reward_size = exp_group_data[3]
     time_limit = exp_group_data[4]
 
-    # Get all rows in the task_config table matching this exp_group ID
-    cursor.execute("SELECT * FROM task_config WHERE exp_group=?", (exp_group,))
-    task_config_data = cursor.fetchall()
-    num_tasks = len(task_config_data)
-
-    # Iterate over each row and get the image URL, annotation mode, classes, and pre-annotations
-    index = 0
-    for row in task_config_data:
-
-        # The start-at term enables us to pick up where we left off due to a connection disruption
-        if index < start_at:
-            index += 1
-            continue
-
-        # The end-at term lets us limit the number of tasks created, such as for testing in the sandbox
-        if index == end_at:
+    # Resume from the posting journal - tasks whose HIT is already recorded are skipped, and requests that may have
+    # reached MTurk before an interruption are re-sent with the same token so MTurk does not create a second HIT
+    # The task_config rows are streamed a page at a time, so the first pass only counts the tasks left to post
+    database_builder.create_hit_posting_journal_table(cursor)
+    database_builder.create_hits_image_url_index(cursor)
+    num_to_post = 0
+    num_already_posted = 0
+    expired_tasks = []
+    for page in iter_task_config_pages(cursor, exp_group, start_at, end_at):
+        for row, state in get_posting_states(cursor, mturk_type, exp_group, page):
+            if state == 'posted':
+                num_already_posted += 1
+            elif state == 'expired':
+                expired_tasks.append(row[1])
+            else:
+                num_to_post += 1
+
+    if num_already_posted > 0:
+        print(f"Resuming experiment group {exp_group}: {num_already_posted} HITs were already posted")
+    if len(expired_tasks) > 0:
+        # MTurk forgets request tokens after 24 hours, so these can no longer be re-sent safely
+        print(f"{len(expired_tasks)} HITs for experiment group {exp_group} were interrupted more than "
+              f"{request_token_lifetime.days * 24} hours ago and may or may not exist on MTurk. Any that were posted are "
+              f"listed as orphaned by reconciliation.reconcile_hits - delete the hit_posting_journal rows of the rest "
+              f"to post them.")
+
+    def generate_hit_requests():
+        # The journal rows for each chunk of requests are committed before any of the requests are sent
+        chunk_size = mturk_seg_vars.posting_journal_chunk_size
+        hit_requests = []
+        for page in iter_task_config_pages(cursor, exp_group, start_at, end_at):
+            for row, state in get_posting_states(cursor, mturk_type, exp_group, page):
+                if state is not None:
+                    continue
+
+                # Read the task config data
+                img_url = row[1]
+                annotation_mode = row[2]
+                classes = row[3]
+                pre_annotations = row[4]
+
+                # Fix non-compliant data types
+                pre_annotations, task_time_limit = other_utils.fix_non_compliant_task_parameters(pre_annotations,
+                                                                                                  time_limit)
+
+                hit_params = build_segmentation_hit_params(question,
+                                                           img_url,
+                                                           classes,
+                                                           annotation_mode,
+                                                           pre_annotations,
+                                                           exp_group,
+                                                           reward_size,
+                                                           task_time_limit,
+                                                           qualification_requirements,
+                                                           num_assignments_per_hit,
+                                                           hit_layout_id)
+                hit_params = build_hit_with_hit_type_params(mturk, cursor, hit_params)
+                hit_params['UniqueRequestToken'] = build_unique_request_token(mturk_type, exp_group, img_url)
+                record = (img_url, classes, annotation_mode, pre_annotations)
+                hit_requests.append((hit_params, record))
+
+                if len(hit_requests) == chunk_size:
+                    yield from send_journaled(hit_requests)
+                    hit_requests = []
+        yield from send_journaled(hit_requests)
+
+    def send_journaled(hit_requests):
+        if len(hit_requests) == 0:
             return
+        journal_hit_requests(cursor, mturk_type, exp_group,
+                             [(record[0], hit_params['UniqueRequestToken']) for hit_params, record in hit_requests])
+        conn.commit()
+        yield from hit_requests
+
+    # Post the HITs concurrently - this thread is the only one that writes the results to the database
+    progress = posting_engine.PostingProgress(num_to_post, print_status_every_n, f'for experiment group {exp_group} ')
+    failed_tasks = list(expired_tasks)
+    for record, response, error in posting_engine.post_hits(mturk.create_hit_with_hit_type,
+                                                            generate_hit_requests(),
+                                                            num_workers=num_workers,
+                                                            requests_per_second=requests_per_second):
+        img_url, classes, annotation_mode, pre_annotations = record
+        if error is not None:
+            hit_id = get_existing_hit_id(error)
+            if hit_id is None:
+                # A failed HIT should not stop the rest of the batch from being posted
+                print(f"Failed to create HIT for image {img_url} in experiment group {exp_group}: {error}")
+                failed_tasks.append(img_url)
+                progress.update(succeeded=False)
+
+                # Only an error returned by MTurk means the HIT was not created - after a timeout, the request is left
+                # pending so that the next run re-sends it with the same token
+                if getattr(error, 'response', None) is not None:
+                    update_posting_journal(cursor, mturk_type, exp_group, img_url, 'failed', error=str(error))
+                continue
+        else:
+            hit_id = response['HIT']['HITId']
 
-        # Read the task config data
-        img_url = row[1]
-        annotation_mode = row[2]
-        classes = row[3]
-        pre_annotations = row[4]
-
-        # Fix non-compliant data types
-        pre_annotations, time_limit = other_utils.fix_non_compliant_task_parameters(pre_annotations, time_limit)
-
-        # Create a HIT for this task instance
-        create_segmentation_hit(mturk,
-                                conn,
-                                cursor,
-                                question,
-                                img_url,
-                                classes,
-                                annotation_mode,
-                                pre_annotations,
-                                exp_group,
-                                reward_size,
-                                time_limit,
-                                qualification_requirements,
-                                num_assignments_per_hit)
-        index += 1
+        record_hit_in_database(conn, cursor, hit_id, mturk_type, exp_group, img_url, classes,
+                               annotation_mode, pre_annotations, commit=False)
+        update_posting_journal(cursor, mturk_type, exp_group, img_url, 'posted', hit_id=hit_id)
+        progress.update(succeeded=True)
 
-        if index % print_status_every_n == 0:
-            print(f"Created HIT {index} of {num_tasks} for experiment group {exp_group}")
+        # Commit at intervals, rather than once per HIT, to limit the time spent waiting on the database
+        if progress.num_posted % print_status_every_n == 0:
+            conn.commit()
 
+    conn.commit()
+    if progress.num_posted > 0:
+        # The cached index of the account's HITs does not list the HITs that were just posted
+        reconciliation.invalidate_hit_index(mturk_type)
+    progress.report()
+    if len(failed_tasks) > 0:
+        print(f"{len(failed_tasks)} HITs could not be created for experiment group {exp_group}")
 
+    return progress.num_posted, failed_tasks
 
 
 def create_segmentation_hit(mturk,
@@ -129,7 +242,7 @@ def create_segmentation_hit(mturk,
     :param mturk: the mturk client instance
     :param conn: a connection to the sqlite3 database
     :param cursor: the database client
-    :param question: the MTurk question XML
+    :param question: the MTurk question XML, or a QuestionTemplate compiled from it (unused if a HIT layout is registered)
     :param img_url: the image to annotate
     :param classes: the list of objet classes to display in the user interface
     :param annotation_mode: the drawing modes available or annotation
@@ -142,17 +255,51 @@ def create_segmentation_hit(mturk,
     :return: the HIT Id
     """
 
+    hit_params = build_segmentation_hit_params(question, img_url, classes, annotation_mode, pre_annotations, exp_group,
+                                               reward, time_limit, qualification_requirements, max_assignments,
+                                               get_hit_layout_id(mturk))
+
+    # Send the HIT to MTurk under the HIT type registered for its experiment group
+    response = mturk.create_hit_with_hit_type(**build_hit_with_hit_type_params(mturk, cursor, hit_params))
+
+    # Enter a record of the HIT in the database
+    hit_id = response['HIT']['HITId']
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    record_hit_in_database(conn, cursor, hit_id, mturk_type, hit_params['RequesterAnnotation'], img_url, classes,
+                           annotation_mode, pre_annotations)
+    reconciliation.invalidate_hit_index(mturk_type)
+
+    return hit_id
+
+
+def build_segmentation_hit_params(question,
+                                  img_url=None,
+                                  classes=None,
+                                  annotation_mode=None,
+                                  pre_annotations=None,
+                                  exp_group=None,
+                                  reward=None,
+                                  time_limit=False,
+                                  qualification_requirements=None,
+                                  max_assignments=1,
+                                  hit_layout_id=None):
+    """
+    Builds the parameters for an MTurk create_hit request for the Duke HAL segmentation experiment
+    Parameters are the same as for create_segmentation_hit, plus:
+    :param hit_layout_id: if given, the HIT references this layout with the task parameters instead of sending the question
+    :return: a dictionary of the create_hit parameters
+    """
+
     num_objects_instruction = 'ALL objects'         # Text that appears in the MTurk details section
     num_objects_headline = 'THREE'                  # Text that appears at the top of the HIT
     training_group_label = 1                        # Number that appears in the HIT title for training tasks
 
-    # Fill in the HIT-specific layout parameters by overwriting the default text in the html
-    if img_url is not None and img_url != 'demo':
-        question = question.replace('${img_url}', img_url)
-    if classes is not None and classes != 'all':
-        question = question.replace('${classes}', classes)
-    if annotation_mode is not None:
-        question = question.replace('${annotation_mode}', annotation_mode)
+    # The HIT-specific layout parameters are filled in from the compiled template or sent as HIT layout parameters,
+    # and parameters that are left out keep their default text in the html
+    if img_url == 'demo':
+        img_url = None
+    if classes == 'all':
+        classes = None
     # TODO: handle preannotations once that functionality is available
 
     # Set the experiment group data, which influences the instruction text
@@ -183,8 +330,13 @@ def create_segmentation_hit(mturk,
                 training_group_label = 5
     requester_annotation = exp_group                       # This is a private string that assists API searches
 
-    # Update the headline text to describe the intended number of objects to annotate
-    question = question.replace('[**X**]', num_objects_headline)
+    # Fill in the layout parameters, along with headline text describing the intended number of objects to annotate
+    layout_parameters = {
+        'img_url': img_url,
+        'classes': classes,
+        'annotation_mode': annotation_mode,
+        'num_objects_headline': num_objects_headline
+    }
 
     # Set the reward size
     if isinstance(reward, numbers.Number) and 0 < reward <= 0.10:
@@ -197,7 +349,6 @@ def create_segmentation_hit(mturk,
     if time_limit:
         assignment_duration_in_seconds = 180        # 3 minutes
     lifetime_in_seconds = 2419200                      # 28 days
-    auto_approval_delay_in_seconds = 604800         # 7 days
 
     # Set the title and instruction data
     title = f'Duke HAL Image Segmentation Task ({exp_group})'
@@ -218,39 +369,376 @@ def create_segmentation_hit(mturk,
         'AssignmentDurationInSeconds': assignment_duration_in_seconds,
         'LifetimeInSeconds': lifetime_in_seconds,
         'AutoApprovalDelayInSeconds': auto_approval_delay_in_seconds,
-        'Question': question,
         'RequesterAnnotation': requester_annotation
     }
+    if hit_layout_id is not None:
+        hit_params['HITLayoutId'] = hit_layout_id
+        hit_params['HITLayoutParameters'] = build_hit_layout_parameters(layout_parameters)
+    else:
+        hit_params['Question'] = get_question_template(question).render(**layout_parameters)
     if qualification_requirements is not None:
         hit_params['QualificationRequirements'] = qualification_requirements
 
-    # Send the HIT to MTurk
-    response = mturk.create_hit(**hit_params)
+    return hit_params
+
+
+def register_hit_type(mturk, cursor, hit_params):
+    """
+    Gets the ID of the HIT type for a HIT's title, description, keywords, reward, durations and qualifications
+    The HIT type is registered with MTurk the first time it is needed and its ID is cached in memory and in the hit_types
+    table, so each experiment group only sends these parameters once
+    :param mturk: the mturk client instance
+    :param cursor: the database client - the caller is responsible for committing any new hit_types record
+    :param hit_params: the create_hit parameters for the HIT, as built by build_segmentation_hit_params
+    :return: the HIT type ID
+    """
 
-    # Get the HIT data to store in the database
-    hit_id = response['HIT']['HITId']
     mturk_type = mturk_client.get_mturk_type(mturk)
-    status = "Open"
+    exp_group = hit_params['RequesterAnnotation']
+    hit_type_params = {name: hit_params[name] for name in hit_type_param_names if name in hit_params}
+    reward = hit_type_params['Reward']
+    assignment_duration = hit_type_params['AssignmentDurationInSeconds']
+    qualification_key = hash_hit_params(hit_type_params.get('QualificationRequirements'))
+    params_hash = hash_hit_params(hit_type_params)
+
+    cache_key = (mturk_type, exp_group, reward, assignment_duration, qualification_key, params_hash)
+    if cache_key in hit_type_cache:
+        return hit_type_cache[cache_key]
+
+    # Reuse a HIT type registered by an earlier process, as long as none of its parameters have changed since
+    database_builder.create_hit_types_table(cursor)
+    cursor.execute("SELECT hit_type_id, params_hash FROM hit_types "
+                   "WHERE mturk_type = ? AND exp_group = ? AND reward = ? AND assignment_duration = ? "
+                   "AND qualification_key = ?",
+                   (mturk_type, exp_group, reward, assignment_duration, qualification_key))
+    row = cursor.fetchone()
+    if row is not None and row[1] == params_hash:
+        hit_type_id = row[0]
+    else:
+        response = mturk.create_hit_type(**hit_type_params)
+        hit_type_id = response['HITTypeId']
+        cursor.execute("INSERT OR REPLACE INTO hit_types "
+                       "(hit_type_id, mturk_type, exp_group, reward, assignment_duration, qualification_key, "
+                       "params_hash, created_at) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (hit_type_id, mturk_type, exp_group, reward, assignment_duration, qualification_key,
+                        params_hash, datetime.datetime.now()))
 
-    # Enter a record of the HIT in the database
+        # New HIT types send their submissions to the notification queue, if there is one
+        destination = mturk_seg_vars.notification_destinations.get(mturk_type)
+        if destination:
+            notification_ingest.register_notification(mturk, hit_type_id, destination)
+
+    hit_type_cache[cache_key] = hit_type_id
+    return hit_type_id
+
+
+def build_hit_with_hit_type_params(mturk, cursor, hit_params):
+    """
+    Converts create_hit parameters into create_hit_with_hit_type parameters, registering the HIT type if necessary
+    :param mturk: the mturk client instance
+    :param cursor: the database client
+    :param hit_params: the create_hit parameters for the HIT, as built by build_segmentation_hit_params
+    :return: a dictionary of the create_hit_with_hit_type parameters
+    """
+
+    hit_with_hit_type_params = {'HITTypeId': register_hit_type(mturk, cursor, hit_params)}
+    for name, value in hit_params.items():
+        if name not in hit_type_param_names:
+            hit_with_hit_type_params[name] = value
+    return hit_with_hit_type_params
+
+
+def hash_hit_params(params):
+    """
+    Computes a stable hash of a set of HIT parameters
+    :param params: a json-serializable object, e.g. a list of qualification requirements
+    :return: the hex digest of the hash
+    """
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def record_hit_in_database(conn, cursor, hit_id, mturk_type, exp_group, img_url, classes, annotation_mode,
+                           pre_annotations, commit=True):
+    """
+    Enters a record of a newly created HIT in the hits table
+    :param conn: a connection to the sqlite3 database
+    :param cursor: the database client
+    :param hit_id: the HIT ID returned by MTurk
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group
+    :param img_url: the image to annotate
+    :param classes: the list of objet classes displayed in the user interface
+    :param annotation_mode: the drawing modes available or annotation
+    :param pre_annotations: the pre-annotations displayed in the user interface
+    :param commit: if False, the caller is responsible for committing the transaction
+    """
+
+    status = "Open"
     cursor.execute("INSERT INTO hits "
                    "(hit_id, mturk_type, exp_group, image_url, classes, annotation_mode, pre_annotations, status) "
                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
                    (hit_id, mturk_type, exp_group, img_url, classes, annotation_mode, pre_annotations, status))
-    conn.commit()
+    if commit:
+        conn.commit()
 
-    return hit_id
+
+def build_unique_request_token(mturk_type, exp_group, img_url):
+    """
+    Builds the UniqueRequestToken for a task, which is the same every time the task is posted
+    Within 24 hours, MTurk rejects a second HIT sent with the same token and reports the ID of the first one instead
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group
+    :param img_url: the image for the task
+    :return: the token, which fits in MTurk's 64 character limit
+    """
+
+    return hash_hit_params([mturk_type, exp_group, img_url])
 
 
-def load_html_as_mturk_question(html_file_path):
+def get_existing_hit_id(error):
     """
-    Takes an html file and converts it to the XML format required for MTurk tasks
+    Checks whether a create_hit request failed because a HIT was already created with the same UniqueRequestToken
+    :param error: the exception raised by the client
+    :return: the ID of the existing HIT, or None if the error was caused by something else
+    """
+
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return None
+    error_code = response.get('Error', {}).get('Code', '') or ''
+    error_message = response.get('Error', {}).get('Message', '') or ''
+    if 'HitAlreadyExists' not in error_code and 'HitAlreadyExists' not in error_message \
+            and 'already exists' not in error_message.lower():
+        return None
+    match = re.search(r'\b[A-Z0-9]{30}\b', error_message)
+    if match is None:
+        return None
+    return match.group(0)
+
+
+def iter_task_config_pages(cursor, exp_group, start_at=0, end_at=None, page_size=None):
+    """
+    Streams the task_config rows for an experiment group in pages, ordered by img_url
+    Each page is read with keyset pagination on the (exp_group, img_url) primary key, so memory use does not grow with the
+    number of tasks, and start_at is found by walking the index rather than reading the rows before it
+    Every page is fully fetched before it is returned, so the cursor can be used for other queries between pages
+    :param cursor: the database client
+    :param exp_group: the experiment group ID
+    :param start_at: the index of the first task to return
+    :param end_at: the index to stop before, or None to read to the end
+    :param page_size: the number of rows per page, defaults to mturk_seg_vars.task_config_page_size
+    :return: a generator of lists of task_config rows
+    """
+
+    if page_size is None:
+        page_size = mturk_seg_vars.task_config_page_size
+    remaining = None if end_at is None else max(0, end_at - start_at)
+
+    # Seek to the img_url just before position start_at - this only reads the primary key index
+    last_img_url = None
+    if start_at > 0:
+        cursor.execute("SELECT img_url FROM task_config WHERE exp_group = ? ORDER BY img_url LIMIT 1 OFFSET ?",
+                       (exp_group, start_at - 1))
+        row = cursor.fetchone()
+        if row is None:
+            return
+        last_img_url = row[0]
+
+    while remaining is None or remaining > 0:
+        limit = page_size if remaining is None else min(page_size, remaining)
+        if last_img_url is None:
+            cursor.execute("SELECT * FROM task_config WHERE exp_group = ? ORDER BY img_url LIMIT ?", (exp_group, limit))
+        else:
+            cursor.execute("SELECT * FROM task_config WHERE exp_group = ? AND img_url > ? ORDER BY img_url LIMIT ?",
+                           (exp_group, last_img_url, limit))
+        page = cursor.fetchall()
+        if len(page) == 0:
+            return
+        yield page
+        if len(page) < limit:
+            return
+        last_img_url = page[-1][1]
+        if remaining is not None:
+            remaining -= len(page)
+
+
+def iter_task_config(cursor, exp_group, start_at=0, end_at=None, page_size=None):
+    """
+    Streams the task_config rows for an experiment group one at a time, ordered by img_url
+    Parameters are the same as for iter_task_config_pages
+    :return: a generator of task_config rows
+    """
+
+    for page in iter_task_config_pages(cursor, exp_group, start_at, end_at, page_size):
+        yield from page
+
+
+def get_posting_states(cursor, mturk_type, exp_group, rows):
+    """
+    Looks up where each task in a page of task_config rows stands in the posting journal and the hits table
+    :param cursor: the database client
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group
+    :param rows: a page of task_config rows
+    :return: a list of (row, state) tuples, where state is 'posted' if the HIT is already recorded, 'expired' if its
+    request was interrupted too long ago to re-send safely, or None if the HIT should be posted
+    """
+
+    img_urls = [row[1] for row in rows]
+    placeholders = ', '.join('?' * len(img_urls))
+    cursor.execute(f"SELECT img_url, status, token_sent_at FROM hit_posting_journal "
+                   f"WHERE mturk_type = ? AND exp_group = ? AND img_url IN ({placeholders})",
+                   [mturk_type, exp_group] + img_urls)
+    journal = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+    cursor.execute(f"SELECT image_url FROM hits "
+                   f"WHERE exp_group = ? AND mturk_type = ? AND image_url IN ({placeholders})",
+                   [exp_group, mturk_type] + img_urls)
+    recorded_img_urls = set(row[0] for row in cursor.fetchall())
+
+    states = []
+    for row in rows:
+        status, token_sent_at = journal.get(row[1], (None, None))
+        if status == 'posted' or row[1] in recorded_img_urls:
+            states.append((row, 'posted'))
+        elif status == 'pending' and is_request_token_expired(token_sent_at):
+            states.append((row, 'expired'))
+        else:
+            states.append((row, None))
+    return states
+
+
+def journal_hit_requests(cursor, mturk_type, exp_group, requests):
+    """
+    Marks a set of HIT requests as pending in the posting journal, before they are sent
+    A request that was already pending keeps the time its token was first sent
+    :param cursor: the database client - the caller must commit before sending the requests
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group
+    :param requests: a list of (img_url, request_token) tuples
+    """
+
+    now = datetime.datetime.now()
+    cursor.executemany("INSERT INTO hit_posting_journal "
+                       "(mturk_type, exp_group, img_url, request_token, status, token_sent_at, updated_at) "
+                       "VALUES (?, ?, ?, ?, 'pending', ?, ?) "
+                       "ON CONFLICT (mturk_type, exp_group, img_url) DO UPDATE SET "
+                       "token_sent_at = CASE WHEN status = 'pending' THEN token_sent_at "
+                       "ELSE excluded.token_sent_at END, "
+                       "request_token = excluded.request_token, status = 'pending', error = NULL, "
+                       "updated_at = excluded.updated_at",
+                       [(mturk_type, exp_group, img_url, request_token, now, now)
+                        for img_url, request_token in requests])
+
+
+def update_posting_journal(cursor, mturk_type, exp_group, img_url, status, hit_id=None, error=None):
+    """
+    Records the outcome of a HIT request in the posting journal
+    :param cursor: the database client - the caller is responsible for committing
+    :param mturk_type: 'sandbox' or 'production'
+    :param exp_group: the experiment group
+    :param img_url: the image for the task
+    :param status: 'posted' or 'failed'
+    :param hit_id: the HIT ID, if the HIT was posted
+    :param error: the error message, if the request failed
+    """
+
+    cursor.execute("UPDATE hit_posting_journal SET status = ?, hit_id = ?, error = ?, updated_at = ? "
+                   "WHERE mturk_type = ? AND exp_group = ? AND img_url = ?",
+                   (status, hit_id, error, datetime.datetime.now(), mturk_type, exp_group, img_url))
+
+
+def is_request_token_expired(token_sent_at):
+    """
+    :param token_sent_at: the time a request token was first sent, as stored in the posting journal
+    :return: True if MTurk may no longer recognise the token
+    """
+
+    if token_sent_at is None:
+        return False
+    if isinstance(token_sent_at, str):
+        token_sent_at = datetime.datetime.fromisoformat(token_sent_at)
+    return datetime.datetime.now() - token_sent_at > request_token_lifetime
+
+
+def get_hit_layout_id(mturk):
+    """
+    Gets the ID of the HIT layout registered for the client's MTurk environment in mturk_seg_vars.hit_layout_ids
+    :param mturk: the mturk client instance
+    :return: the HIT layout ID, or None if HITs should be posted with the full question XML
+    """
+
+    hit_layout_id = mturk_seg_vars.hit_layout_ids.get(mturk_client.get_mturk_type(mturk))
+    if not hit_layout_id:
+        return None
+    return hit_layout_id
+
+
+def build_hit_layout_parameters(layout_parameters):
+    """
+    Converts the task parameters into the HITLayoutParameters list for a create_hit request
+    MTurk requires a value for every parameter in the layout, so parameters that are left out are sent as their own
+    placeholder text, which the task html treats as the local demo configuration
+    :param layout_parameters: a dictionary of parameter values, keyed by the slot names in question_template_slots
+    :return: the list of HIT layout parameters
+    """
+
+    hit_layout_parameters = []
+    for placeholder, slot_name in question_template_slots.items():
+        value = layout_parameters.get(slot_name)
+        if value is None:
+            value = '${' + slot_name + '}'
+        hit_layout_parameters.append({'Name': slot_name, 'Value': str(value)})
+    return hit_layout_parameters
+
+
+def export_hit_layout_html(html_file_path, output_path, minify=False):
+    """
+    Writes the layout source to paste into a project on the MTurk requester website
+    MTurk does not offer an API for creating HIT layouts, so the layout is registered once by creating a project with this
+    source and recording the project's layout ID in mturk_seg_vars.hit_layout_ids
+    Every placeholder in the task html becomes a ${parameter} named after its slot in question_template_slots
     :param html_file_path: the path to the html file
-    :return: the xml text for the MTurk task
+    :param output_path: the path to write the layout source to
+    :param minify: if True, strips indentation and blank lines from the html
     """
 
     with open(html_file_path, 'r') as f:
         html_content = f.read()
+    if minify:
+        html_content = minify_html(html_content)
+    for placeholder, slot_name in question_template_slots.items():
+        html_content = html_content.replace(placeholder, '${' + slot_name + '}')
+
+    layout_content = f"""<script src="https://assets.crowd.aws/crowd-html-elements.js"></script>
+<crowd-form answer-format="flatten-objects">
+{html_content}
+</crowd-form>
+"""
+    with open(output_path, 'w') as f:
+        f.write(layout_content)
+
+
+def load_html_as_mturk_question(html_file_path, minify=False):
+    """
+    Takes an html file and converts it to the XML format required for MTurk tasks
+    The file is only read again if it has changed since the last call
+    :param html_file_path: the path to the html file
+    :param minify: if True, strips indentation and blank lines from the html to reduce the size of each request
+    :return: the xml text for the MTurk task
+    """
+
+    return load_question_template(html_file_path, minify=minify).source
+
+
+def wrap_html_as_mturk_question(html_content):
+    """
+    Wraps the contents of an html file in the HTMLQuestion XML format required for MTurk tasks
+    :param html_content: the html text
+    :return: the xml text for the MTurk task
+    """
+
     xml_content = f"""
 <HTMLQuestion xmlns="http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2011-11-11/HTMLQuestion.xsd">
   <HTMLContent><![CDATA[<!DOCTYPE html>
@@ -263,3 +751,135 @@ def load_html_as_mturk_question(html_file_path):
 </HTMLQuestion>
         """
     return xml_content
+
+
+def minify_html(html_content):
+    """
+    Strips leading and trailing whitespace from each line of the html and removes blank lines
+    Line breaks are kept so that javascript statements that rely on them are not merged together
+    :param html_content: the html text
+    :return: the minified html text
+    """
+
+    return '\n'.join(line.strip() for line in html_content.splitlines() if line.strip())
+
+
+class QuestionTemplate:
+    """
+    An MTurk question that has been split into literal segments and the slots that are filled in for each HIT
+    Rendering a HIT's question is a single join, rather than a full pass over the question text for each parameter
+    """
+
+    def __init__(self, source):
+        """
+        :param source: the xml text for the MTurk task, containing the placeholders in question_template_slots
+        """
+        self.source = source
+        self.parts = []
+        self.slot_positions = []
+
+        # Split the source on every placeholder, remembering where each slot sits in the list of parts
+        position = 0
+        while True:
+            next_slot = None
+            for placeholder, slot_name in question_template_slots.items():
+                index = source.find(placeholder, position)
+                if index != -1 and (next_slot is None or index < next_slot[0]):
+                    next_slot = (index, placeholder, slot_name)
+            if next_slot is None:
+                break
+            index, placeholder, slot_name = next_slot
+            self.parts.append(source[position:index])
+            self.slot_positions.append((len(self.parts), slot_name, placeholder))
+            self.parts.append(placeholder)
+            position = index + len(placeholder)
+        self.parts.append(source[position:])
+
+        self.literal_length = len(source) - sum(len(placeholder) for _, _, placeholder in self.slot_positions)
+
+    def render(self, **slot_values):
+        """
+        Fills in the slots of the template
+        Slots without a value keep their placeholder text, which the task html treats as the local demo configuration
+        :param slot_values: the value for each slot, keyed by slot name (img_url, classes, annotation_mode, num_objects_headline)
+        :return: the xml text for the MTurk task
+        """
+        parts = list(self.parts)
+        for position, slot_name, _ in self.slot_positions:
+            value = slot_values.get(slot_name)
+            if value is not None:
+                parts[position] = value
+        question = ''.join(parts)
+        if len(question) > mturk_seg_vars.max_question_length:
+            raise ValueError(f'The rendered question is {len(question)} characters long, '
+                             f'which is over the MTurk limit of {mturk_seg_vars.max_question_length}')
+        return question
+
+
+def compile_question_template(source, slot_budget=1024):
+    """
+    Compiles the xml text for an MTurk task into a QuestionTemplate, checking that it fits in an MTurk request
+    :param source: the xml text for the MTurk task
+    :param slot_budget: the number of characters to reserve for the values that are filled into the slots
+    :return: the QuestionTemplate
+    """
+
+    template = QuestionTemplate(source)
+    if template.literal_length + slot_budget > mturk_seg_vars.max_question_length:
+        raise ValueError(f'The question is {template.literal_length} characters long before its parameters are filled '
+                         f'in, which leaves less than {slot_budget} characters of the MTurk limit of '
+                         f'{mturk_seg_vars.max_question_length}. Try compiling it with minify=True.')
+    return template
+
+
+def load_question_template(html_file_path, minify=False):
+    """
+    Reads an html file and compiles it into a QuestionTemplate
+    Compiled templates are cached, and the file is only read again when its modification time or size changes
+    :param html_file_path: the path to the html file
+    :param minify: if True, strips indentation and blank lines from the html to reduce the size of each request
+    :return: the QuestionTemplate
+    """
+
+    cache_key = (os.path.abspath(html_file_path), minify)
+    file_stat = os.stat(html_file_path)
+    file_version = (file_stat.st_mtime_ns, file_stat.st_size)
+
+    cached = compiled_question_cache.get(cache_key)
+    if cached is not None and cached[0] == file_version:
+        return cached[2]
+
+    with open(html_file_path, 'r') as f:
+        html_content = f.read()
+
+    # A touched but unchanged file can keep using the existing template
+    content_hash = hashlib.sha1(html_content.encode('utf-8')).hexdigest()
+    if cached is not None and cached[1] == content_hash:
+        compiled_question_cache[cache_key] = (file_version, content_hash, cached[2])
+        return cached[2]
+
+    # The html is embedded in a CDATA section, which cannot contain its own terminator
+    if ']]>' in html_content:
+        raise ValueError(f'{html_file_path} contains the sequence "]]>", which cannot be embedded in an MTurk question')
+    if minify:
+        html_content = minify_html(html_content)
+
+    template = compile_question_template(wrap_html_as_mturk_question(html_content))
+    compiled_question_cache[cache_key] = (file_version, content_hash, template)
+    return template
+
+
+def get_question_template(question):
+    """
+    Gets the compiled template for a question that was passed as xml text, compiling it on first use
+    :param question: the xml text for the MTurk task, or a QuestionTemplate
+    :return: the QuestionTemplate
+    """
+
+    if isinstance(question, QuestionTemplate):
+        return question
+    template = compiled_question_text_cache.get(question)
+    if template is None:
+        template = compile_question_template(question)
+        compiled_question_text_cache[question] = template
+    return template
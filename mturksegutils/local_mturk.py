@@ -0,0 +1,818 @@
+"""
+A local HTTP stand-in for the MTurk requester API, for testing and benchmarking without a live MTurk endpoint
+
+The server speaks the same JSON protocol as MTurk, so the normal boto3 clients work against it once their endpoint URLs
+point at it (see use_local_mturk). boto3 still signs each request, so some AWS credentials must be configured, but any
+values will do. Sandbox and production clients are given separate paths on the server and never see each other's HITs.
+
+Synthetic workers accept and submit each HIT's assignments after a random delay, and the server can add latency to every
+request and throttle requests above a configured rate, the same way MTurk does. Notifications registered with
+update_notification_settings are delivered to local queues (see notification_queues.py) instead of SQS.
+"""
+
+import argparse
+import datetime
+import heapq
+import inspect
+import itertools
+import json
+import random
+import string
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+from mturksegutils import mturk_seg_vars, notification_queues
+
+
+# The prefix of the X-Amz-Target header, which names the operation for each request
+target_prefix = 'MTurkRequesterServiceV20170117.'
+
+answer_xml_namespace = 'http://mechanicalturk.amazonaws.com/AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd'
+
+
+class LocalMTurkError(Exception):
+    """
+    An error returned to the client as an MTurk error response, e.g. RequestError or ThrottlingException
+    """
+
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class LocalMTurkState:
+    """
+    The HITs, assignments and qualifications for one MTurk environment of the stand-in
+    All public methods take the state lock, so a state can be shared by every request handler thread
+    """
+
+    def __init__(self,
+                 submission_delay=5.0,
+                 empty_submission_fraction=0.1,
+                 num_workers=50,
+                 qualification_names=None,
+                 keep_questions=True,
+                 seed=0):
+        """
+        :param submission_delay: the mean number of seconds between a HIT being created and each of its assignments being
+        submitted, or None to only submit assignments when submit_assignments is called
+        :param empty_submission_fraction: the fraction of synthetic submissions that contain no annotations
+        :param num_workers: the number of synthetic workers
+        :param qualification_names: the names of the qualification types to create, defaults to those in mturk_seg_vars
+        :param keep_questions: if False, the question XML of each HIT is not kept, which saves memory in large load tests
+        :param seed: the seed for the random number generator, so that runs can be reproduced
+        """
+        self.submission_delay = submission_delay
+        self.keep_questions = keep_questions
+        self.empty_submission_fraction = empty_submission_fraction
+        self.rng = random.Random(seed)
+        self.worker_ids = [self.new_id('A', 13) for _ in range(num_workers)]
+        self.lock = threading.RLock()
+
+        self.hits = {}
+        self.hit_order = []
+        self.hits_by_status = {'Assignable': {}, 'Reviewable': {}, 'Reviewing': {}}
+        self.hit_types = {}
+        self.hit_types_by_params = {}
+        self.request_tokens = {}
+        self.assignments = {}
+        self.assignments_by_hit = {}
+        self.qualification_types = {}
+        self.worker_qualifications = {}
+        self.notification_settings = {}
+        self.notification_queues = {}
+
+        # Scheduled synthetic submissions and HIT expirations, as (time, sequence number, HIT ID)
+        self.pending_submissions = []
+        self.pending_expirations = []
+        self.sequence = itertools.count()
+
+        if qualification_names is None:
+            qualification_names = [mturk_seg_vars.main_seg_qual_name,
+                                   mturk_seg_vars.any_object_count_qual_name,
+                                   mturk_seg_vars.invite_only_qual_name]
+        for name in qualification_names:
+            if name:
+                self.create_qualification_type(Name=name, Description=name, QualificationTypeStatus='Active')
+
+    def new_id(self, prefix='', length=30):
+        return prefix + ''.join(self.rng.choices(string.ascii_uppercase + string.digits, k=length - len(prefix)))
+
+    def advance(self, now=None):
+        """
+        Submits every synthetic assignment that is due and expires HITs that have passed their expiration time
+        :param now: the current time, in seconds since the epoch
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            while self.pending_submissions and self.pending_submissions[0][0] <= now:
+                submit_time, _, hit_id = heapq.heappop(self.pending_submissions)
+                hit = self.hits.get(hit_id)
+                if hit is not None and hit['Expiration'] > submit_time:
+                    self.submit_assignment(hit, submit_time)
+                    self.update_hit_status(hit, now)
+            while self.pending_expirations and self.pending_expirations[0][0] <= now:
+                _, _, hit_id = heapq.heappop(self.pending_expirations)
+                hit = self.hits.get(hit_id)
+                if hit is not None:
+                    self.update_hit_status(hit, now)
+
+    def submit_assignments(self, hit_id=None, count=None):
+        """
+        Immediately submits synthetic assignments, regardless of the submission delay
+        :param hit_id: the HIT to submit assignments for, or None for every open HIT
+        :param count: the number of assignments to submit per HIT, defaults to all of the available assignments
+        :return: the number of assignments submitted
+        """
+        now = time.time()
+        num_submitted = 0
+        with self.lock:
+            hits = [self.get_open_hit(hit_id)] if hit_id is not None else list(self.hits.values())
+            for hit in hits:
+                if hit['HITStatus'] != 'Assignable':
+                    continue
+                num_to_submit = hit['NumberOfAssignmentsAvailable']
+                if count is not None:
+                    num_to_submit = min(count, num_to_submit)
+                for _ in range(num_to_submit):
+                    self.submit_assignment(hit, now)
+                    num_submitted += 1
+                self.update_hit_status(hit, now)
+        return num_submitted
+
+    def submit_assignment(self, hit, submit_time):
+        if hit['NumberOfAssignmentsAvailable'] <= 0:
+            return None
+
+        # A worker can only work on each HIT once
+        worked = set(self.assignments[assignment_id]['WorkerId']
+                     for assignment_id in self.assignments_by_hit[hit['HITId']])
+        available_workers = [worker_id for worker_id in self.worker_ids if worker_id not in worked]
+        if len(available_workers) == 0:
+            return None
+        worker_id = self.rng.choice(available_workers)
+
+        assignment = {
+            'AssignmentId': self.new_id(),
+            'WorkerId': worker_id,
+            'HITId': hit['HITId'],
+            'AssignmentStatus': 'Submitted',
+            'AutoApprovalTime': submit_time + hit['AutoApprovalDelayInSeconds'],
+            'AcceptTime': submit_time - self.rng.uniform(10, 120),
+            'SubmitTime': submit_time,
+            'Deadline': submit_time + hit['AssignmentDurationInSeconds'],
+            'Answer': self.build_answer(hit, submit_time)
+        }
+        self.assignments[assignment['AssignmentId']] = assignment
+        self.assignments_by_hit[hit['HITId']].append(assignment['AssignmentId'])
+        hit['NumberOfAssignmentsAvailable'] -= 1
+        hit['NumberOfAssignmentsCompleted'] += 1
+        self.notify('AssignmentSubmitted', hit, assignment, submit_time)
+        return assignment
+
+    def notify(self, event_type, hit, assignment=None, event_time=None):
+        """
+        Sends an event notification for a HIT, if its HIT type has an active notification for that event type
+        Only local destinations receive the notifications - any others (e.g. a real SQS queue) are ignored
+        """
+        settings = self.notification_settings.get(hit['HITTypeId'])
+        if settings is None or not settings['Active'] or event_type not in settings['EventTypes']:
+            return
+        destination = settings['Destination']
+        if not notification_queues.is_local_destination(destination):
+            return
+        if destination not in self.notification_queues:
+            self.notification_queues[destination] = notification_queues.open_queue(destination)
+        self.notification_queues[destination].send(self.build_event_message(event_type, hit, assignment, event_time))
+
+    def build_event_message(self, event_type, hit, assignment=None, event_time=None):
+        """
+        Builds a notification message in the form MTurk sends to SQS
+        """
+        event_time = event_time if event_time is not None else time.time()
+        event = {
+            'EventType': event_type,
+            'EventTimestamp': datetime.datetime.fromtimestamp(event_time, datetime.timezone.utc)
+            .strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'HITTypeId': hit['HITTypeId'],
+            'HITId': hit['HITId']
+        }
+        if assignment is not None:
+            event['AssignmentId'] = assignment['AssignmentId']
+        return json.dumps({'Events': [event], 'EventDocId': self.new_id(), 'SourceAccount': 'local-mturk',
+                           'CustomerId': 'local-mturk', 'EventDocVersion': '2014-08-15'})
+
+    def build_answer(self, hit, submit_time):
+        """
+        Builds the answer XML for a synthetic submission, in the same form the task html submits
+        """
+        ts = int(submit_time * 1000)
+        if self.rng.random() < self.empty_submission_fraction:
+            fields = {'interaction_log': f'start[{ts}]', 'annotation_in_progress': '[]', 'result_data': ''}
+        else:
+            classes = hit.get('LayoutParameters', {}).get('classes') or 'object'
+            annotations = []
+            interaction_log = f'start[{ts - 60000}]-toggle_mode[polygon|{ts - 59000}]'
+            for index in range(self.rng.randint(1, 3)):
+                cx, cy, radius = self.rng.randint(50, 450), self.rng.randint(50, 450), self.rng.randint(10, 40)
+                points = [[cx - radius, cy - radius], [cx + radius, cy - radius], [cx + radius, cy + radius],
+                          [cx - radius, cy + radius]]
+                annotations.append({
+                    'class': [classes.split('-')[0]],
+                    'modes': {'dot': False, 'link': False, 'bbox': False, 'polygon': True, 'outline': False,
+                              'paint': False},
+                    'exteriors': [],
+                    'interiors': [],
+                    'strokes': [{'type': 'positive', 'points': points}]
+                })
+                for x, y in points:
+                    interaction_log += f'-pointer_down[left|{x}|{y}|0]-pointer_up[{x}|{y}|80]'
+                interaction_log += f'-complete_annotation[{index}|{ts - 1000 * (3 - index)}]'
+            fields = {'interaction_log': interaction_log,
+                      'annotation_in_progress': json.dumps([None, None, None, None, None]),
+                      'result_data': json.dumps(annotations)}
+
+        answers = ''.join(f'<Answer><QuestionIdentifier>{name}</QuestionIdentifier>'
+                          f'<FreeText>{escape(value)}</FreeText></Answer>' for name, value in fields.items())
+        return f'<?xml version="1.0" encoding="ASCII"?><QuestionFormAnswers xmlns="{answer_xml_namespace}">' \
+               f'{answers}</QuestionFormAnswers>'
+
+    def update_hit_status(self, hit, now):
+        if hit['HITStatus'] == 'Reviewing':
+            return
+        if hit['NumberOfAssignmentsAvailable'] == 0 or hit['Expiration'] <= now:
+            self.set_hit_status(hit, 'Reviewable')
+        else:
+            self.set_hit_status(hit, 'Assignable')
+
+    def set_hit_status(self, hit, status):
+        # HITs are indexed by status so that list_reviewable_hits does not scan every HIT
+        self.hits_by_status[hit['HITStatus']].pop(hit['HITId'], None)
+        hit['HITStatus'] = status
+        self.hits_by_status[status][hit['HITId']] = hit
+
+    def schedule_expiration(self, hit):
+        heapq.heappush(self.pending_expirations, (hit['Expiration'], next(self.sequence), hit['HITId']))
+
+    def get_open_hit(self, hit_id):
+        hit = self.hits.get(hit_id)
+        if hit is None:
+            raise LocalMTurkError('RequestError', f'Hit {hit_id} does not exist. (AWS.MechanicalTurk.HitDoesNotExist)')
+        return hit
+
+    def get_assignment_record(self, assignment_id):
+        assignment = self.assignments.get(assignment_id)
+        if assignment is None:
+            raise LocalMTurkError('RequestError', f'Assignment {assignment_id} does not exist. '
+                                                  f'(AWS.MechanicalTurk.AssignmentDoesNotExist)')
+        return assignment
+
+    def paginate(self, items, key, NextToken=None, MaxResults=None, transform=None):
+        """
+        Returns one page of results, where NextToken is the position of the next page in items
+        :param items: an iterable of results, in a stable order
+        :param transform: an optional function applied to the results on the page, but not to those skipped over
+        """
+        start = int(NextToken) if NextToken else 0
+        page_size = MaxResults if MaxResults else 10
+        page = list(itertools.islice(items, start, start + page_size + 1))
+        results = page[:page_size] if transform is None else [transform(item) for item in page[:page_size]]
+        response = {'NumResults': len(results), key: results}
+        if len(page) > page_size:
+            response['NextToken'] = str(start + page_size)
+        return response
+
+    # The requester operations, named as in the MTurk API and taking the same parameters
+
+    def create_hit_type(self, **params):
+        with self.lock:
+            key = json.dumps(params, sort_keys=True)
+            hit_type_id = self.hit_types_by_params.get(key)
+            if hit_type_id is None:
+                hit_type_id = self.new_id()
+                self.hit_types[hit_type_id] = params
+                self.hit_types_by_params[key] = hit_type_id
+            return {'HITTypeId': hit_type_id}
+
+    def create_hit(self, **params):
+        hit_type_params = {name: params.pop(name) for name in ('Title', 'Description', 'Keywords', 'Reward',
+                                                               'AssignmentDurationInSeconds',
+                                                               'AutoApprovalDelayInSeconds',
+                                                               'QualificationRequirements') if name in params}
+        with self.lock:
+            params['HITTypeId'] = self.create_hit_type(**hit_type_params)['HITTypeId']
+            return self.create_hit_with_hit_type(**params)
+
+    def create_hit_with_hit_type(self, HITTypeId, LifetimeInSeconds, MaxAssignments=1, Question=None,
+                                 RequesterAnnotation=None, UniqueRequestToken=None, HITLayoutId=None,
+                                 HITLayoutParameters=None, **params):
+        now = time.time()
+        with self.lock:
+            hit_type = self.hit_types.get(HITTypeId)
+            if hit_type is None:
+                raise LocalMTurkError('RequestError', f'HIT type {HITTypeId} does not exist.')
+            if (Question is None) == (HITLayoutId is None):
+                raise LocalMTurkError('ParameterValidationError', 'Exactly one of Question or HITLayoutId is required.')
+            if UniqueRequestToken is not None and UniqueRequestToken in self.request_tokens:
+                raise LocalMTurkError('RequestError', f'The HIT with ID "{self.request_tokens[UniqueRequestToken]}" '
+                                                      f'already exists. (AWS.MechanicalTurk.HitAlreadyExists)')
+
+            hit_id = self.new_id()
+            hit = {
+                'HITId': hit_id,
+                'HITTypeId': HITTypeId,
+                'HITGroupId': HITTypeId,
+                'CreationTime': now,
+                'Title': hit_type.get('Title'),
+                'Description': hit_type.get('Description'),
+                'Keywords': hit_type.get('Keywords', ''),
+                'HITStatus': 'Assignable',
+                'MaxAssignments': MaxAssignments,
+                'Reward': hit_type.get('Reward'),
+                'AutoApprovalDelayInSeconds': hit_type.get('AutoApprovalDelayInSeconds', 2592000),
+                'Expiration': now + LifetimeInSeconds,
+                'AssignmentDurationInSeconds': hit_type.get('AssignmentDurationInSeconds'),
+                'QualificationRequirements': hit_type.get('QualificationRequirements', []),
+                'HITReviewStatus': 'NotReviewed',
+                'NumberOfAssignmentsPending': 0,
+                'NumberOfAssignmentsAvailable': MaxAssignments,
+                'NumberOfAssignmentsCompleted': 0
+            }
+            if Question is not None:
+                hit['Question'] = Question if self.keep_questions else ''
+            else:
+                hit['HITLayoutId'] = HITLayoutId
+                hit['LayoutParameters'] = {p['Name']: p['Value'] for p in HITLayoutParameters or []}
+            if RequesterAnnotation is not None:
+                hit['RequesterAnnotation'] = RequesterAnnotation
+
+            self.hits[hit_id] = hit
+            self.assignments_by_hit[hit_id] = []
+            if UniqueRequestToken is not None:
+                self.request_tokens[UniqueRequestToken] = hit_id
+
+            self.hit_order.append(hit_id)
+            self.hits_by_status['Assignable'][hit_id] = hit
+            self.schedule_expiration(hit)
+            if self.submission_delay is not None:
+                for _ in range(MaxAssignments):
+                    submit_time = now
+                    if self.submission_delay > 0:
+                        submit_time += self.rng.expovariate(1.0 / self.submission_delay)
+                    heapq.heappush(self.pending_submissions, (submit_time, next(self.sequence), hit_id))
+
+            return {'HIT': self.public_hit(hit)}
+
+    def public_hit(self, hit):
+        return {name: value for name, value in hit.items() if name != 'LayoutParameters'}
+
+    def get_hit(self, HITId):
+        with self.lock:
+            return {'HIT': self.public_hit(self.get_open_hit(HITId))}
+
+    def list_hits(self, NextToken=None, MaxResults=None):
+        with self.lock:
+            # The page token is a position in hit_order. Deleted HITs stay in hit_order, so that positions do not
+            # shift when HITs are deleted between pages, and are skipped over as the page is filled
+            position = int(NextToken) if NextToken else 0
+            page_size = MaxResults if MaxResults else 10
+            results = []
+            while position < len(self.hit_order) and len(results) < page_size:
+                hit = self.hits.get(self.hit_order[position])
+                position += 1
+                if hit is not None:
+                    results.append(self.public_hit(hit))
+            response = {'NumResults': len(results), 'HITs': results}
+            if position < len(self.hit_order):
+                response['NextToken'] = str(position)
+            return response
+
+    def list_reviewable_hits(self, HITTypeId=None, Status='Reviewable', NextToken=None, MaxResults=None):
+        with self.lock:
+            hits = (hit for hit in self.hits_by_status.get(Status, {}).values()
+                    if HITTypeId is None or hit['HITTypeId'] == HITTypeId)
+            return self.paginate(hits, 'HITs', NextToken, MaxResults, transform=self.public_hit)
+
+    def update_hit_review_status(self, HITId, Revert=False):
+        with self.lock:
+            hit = self.get_open_hit(HITId)
+            if hit['HITStatus'] not in ('Reviewable', 'Reviewing'):
+                raise LocalMTurkError('RequestError', f'Hit {HITId} is not in the Reviewable or Reviewing state.')
+            self.set_hit_status(hit, 'Reviewable' if Revert else 'Reviewing')
+            return {}
+
+    def update_expiration_for_hit(self, HITId, ExpireAt):
+        with self.lock:
+            hit = self.get_open_hit(HITId)
+            if isinstance(ExpireAt, datetime.datetime):
+                ExpireAt = ExpireAt.timestamp()
+            hit['Expiration'] = ExpireAt
+            self.update_hit_status(hit, time.time())
+            self.schedule_expiration(hit)
+            return {}
+
+    def delete_hit(self, HITId):
+        with self.lock:
+            hit = self.get_open_hit(HITId)
+            statuses = [self.assignments[assignment_id]['AssignmentStatus']
+                        for assignment_id in self.assignments_by_hit[HITId]]
+            if hit['HITStatus'] not in ('Reviewable', 'Reviewing') or 'Submitted' in statuses:
+                raise LocalMTurkError('RequestError', f'This HIT is currently in the state \'{hit["HITStatus"]}\'. '
+                                                      f'This operation can be called with a status of: Reviewing, '
+                                                      f'Reviewable (AWS.MechanicalTurk.InvalidHITState)')
+            self.hits_by_status[hit['HITStatus']].pop(HITId, None)
+            del self.hits[HITId]
+            for assignment_id in self.assignments_by_hit.pop(HITId):
+                del self.assignments[assignment_id]
+            return {}
+
+    def list_assignments_for_hit(self, HITId, AssignmentStatuses=None, NextToken=None, MaxResults=None):
+        with self.lock:
+            self.get_open_hit(HITId)
+            assignments = [dict(self.assignments[assignment_id]) for assignment_id in self.assignments_by_hit[HITId]]
+            if AssignmentStatuses:
+                assignments = [a for a in assignments if a['AssignmentStatus'] in AssignmentStatuses]
+            return self.paginate(assignments, 'Assignments', NextToken, MaxResults)
+
+    def get_assignment(self, AssignmentId):
+        with self.lock:
+            assignment = self.get_assignment_record(AssignmentId)
+            return {'Assignment': dict(assignment), 'HIT': self.public_hit(self.hits[assignment['HITId']])}
+
+    def approve_assignment(self, AssignmentId, RequesterFeedback=None, OverrideRejection=False):
+        with self.lock:
+            assignment = self.get_assignment_record(AssignmentId)
+            allowed = ('Submitted', 'Rejected') if OverrideRejection else ('Submitted',)
+            if assignment['AssignmentStatus'] not in allowed:
+                raise LocalMTurkError('RequestError', f'This operation can be called with a status of: Submitted '
+                                                      f'(AWS.MechanicalTurk.InvalidAssignmentState)')
+            assignment['AssignmentStatus'] = 'Approved'
+            assignment['ApprovalTime'] = time.time()
+            if RequesterFeedback is not None:
+                assignment['RequesterFeedback'] = RequesterFeedback
+            return {}
+
+    def reject_assignment(self, AssignmentId, RequesterFeedback):
+        with self.lock:
+            assignment = self.get_assignment_record(AssignmentId)
+            if assignment['AssignmentStatus'] != 'Submitted':
+                raise LocalMTurkError('RequestError', f'This operation can be called with a status of: Submitted '
+                                                      f'(AWS.MechanicalTurk.InvalidAssignmentState)')
+            assignment['AssignmentStatus'] = 'Rejected'
+            assignment['RejectionTime'] = time.time()
+            assignment['RequesterFeedback'] = RequesterFeedback
+            return {}
+
+    def update_notification_settings(self, HITTypeId, Notification=None, Active=None):
+        with self.lock:
+            if HITTypeId not in self.hit_types:
+                raise LocalMTurkError('RequestError', f'HITType {HITTypeId} does not exist.')
+            settings = self.notification_settings.get(HITTypeId)
+            if Notification is not None:
+                if Notification.get('Transport') not in ('Email', 'SQS', 'SNS') or not Notification.get('EventTypes'):
+                    raise LocalMTurkError('ParameterValidationError', 'A Notification requires a Destination, a '
+                                                                      'Transport of Email, SQS or SNS, and EventTypes.')
+                active = Active if Active is not None else (settings['Active'] if settings is not None else True)
+                settings = dict(Notification, Active=active)
+            elif settings is None:
+                raise LocalMTurkError('RequestError', f'HITType {HITTypeId} has no notification to update.')
+            elif Active is not None:
+                settings = dict(settings, Active=Active)
+            self.notification_settings[HITTypeId] = settings
+            return {}
+
+    def create_qualification_type(self, Name, Description, QualificationTypeStatus='Active', **params):
+        with self.lock:
+            for qualification_type in self.qualification_types.values():
+                if qualification_type['Name'] == Name:
+                    raise LocalMTurkError('RequestError', f'You have already created a QualificationType with this '
+                                                          f'name. (AWS.MechanicalTurk.QualificationTypeAlreadyExists)')
+            qualification_type = dict(params, Name=Name, Description=Description,
+                                      QualificationTypeStatus=QualificationTypeStatus,
+                                      QualificationTypeId=self.new_id(), CreationTime=time.time(), IsRequestable=True)
+            self.qualification_types[qualification_type['QualificationTypeId']] = qualification_type
+            return {'QualificationType': qualification_type}
+
+    def list_qualification_types(self, MustBeRequestable, Query=None, MustBeOwnedByCaller=None, NextToken=None,
+                                 MaxResults=None):
+        with self.lock:
+            qualification_types = [q for q in self.qualification_types.values()
+                                   if Query is None or Query.lower() in q['Name'].lower()]
+            return self.paginate(qualification_types, 'QualificationTypes', NextToken, MaxResults)
+
+    def associate_qualification_with_worker(self, QualificationTypeId, WorkerId, IntegerValue=1,
+                                            SendNotification=False):
+        with self.lock:
+            if QualificationTypeId not in self.qualification_types:
+                raise LocalMTurkError('RequestError', f'QualificationType {QualificationTypeId} does not exist.')
+            self.worker_qualifications[(QualificationTypeId, WorkerId)] = {
+                'QualificationTypeId': QualificationTypeId,
+                'WorkerId': WorkerId,
+                'GrantTime': time.time(),
+                'IntegerValue': IntegerValue,
+                'Status': 'Granted'
+            }
+            return {}
+
+    def get_qualification_score(self, QualificationTypeId, WorkerId):
+        with self.lock:
+            qualification = self.worker_qualifications.get((QualificationTypeId, WorkerId))
+            if qualification is None:
+                raise LocalMTurkError('RequestError', f'You requested a Qualification that does not exist. '
+                                                      f'(AWS.MechanicalTurk.QualificationDoesNotExist)')
+            return {'Qualification': dict(qualification)}
+
+
+# The MTurk operation names handled by LocalMTurkState, mapped to its method names
+operations = {
+    'CreateHIT': 'create_hit',
+    'CreateHITType': 'create_hit_type',
+    'CreateHITWithHITType': 'create_hit_with_hit_type',
+    'GetHIT': 'get_hit',
+    'ListHITs': 'list_hits',
+    'ListReviewableHITs': 'list_reviewable_hits',
+    'UpdateHITReviewStatus': 'update_hit_review_status',
+    'UpdateExpirationForHIT': 'update_expiration_for_hit',
+    'DeleteHIT': 'delete_hit',
+    'ListAssignmentsForHIT': 'list_assignments_for_hit',
+    'GetAssignment': 'get_assignment',
+    'ApproveAssignment': 'approve_assignment',
+    'RejectAssignment': 'reject_assignment',
+    'UpdateNotificationSettings': 'update_notification_settings',
+    'CreateQualificationType': 'create_qualification_type',
+    'ListQualificationTypes': 'list_qualification_types',
+    'AssociateQualificationWithWorker': 'associate_qualification_with_worker',
+    'GetQualificationScore': 'get_qualification_score'
+}
+
+
+# The response fields that boto3 returns as datetimes
+timestamp_fields = ('CreationTime', 'Expiration', 'AutoApprovalTime', 'AcceptTime', 'SubmitTime', 'Deadline',
+                    'ApprovalTime', 'RejectionTime', 'GrantTime')
+
+
+class LocalMTurkClientError(Exception):
+    """
+    Raised by LocalMTurkClient with the same response structure as botocore's ClientError
+    """
+
+    def __init__(self, error, operation_name):
+        super().__init__(f'An error occurred ({error.code}) when calling the {operation_name} operation: '
+                         f'{error.message}')
+        self.response = {'Error': {'Code': error.code, 'Message': error.message},
+                         'ResponseMetadata': {'HTTPStatusCode': error.status}}
+        self.operation_name = operation_name
+
+
+class LocalMTurkClient:
+    """
+    An in-process stand-in for a boto3 mturk client that calls a LocalMTurkState directly, without HTTP
+    Responses are shaped the way boto3 returns them, so the rest of the package can use it in place of a real client
+    """
+
+    class Endpoint:
+        def __init__(self, host):
+            self.host = host
+
+    def __init__(self, state=None, sandbox=False, latency=0.0):
+        """
+        :param state: the LocalMTurkState to use, defaults to a new one with no synthetic submissions
+        :param sandbox: if True, the client reports itself as a sandbox client to mturk_client.get_mturk_type
+        :param latency: the number of seconds to wait on every call, to stand in for the network round trip
+        """
+        self.state = state if state is not None else LocalMTurkState(submission_delay=None)
+        self.latency = latency
+        self._endpoint = self.Endpoint('local-mturk-sandbox' if sandbox else 'local-mturk-production')
+
+    def __getattr__(self, name):
+        if name not in operations.values():
+            raise AttributeError(name)
+        method = getattr(self.state, name)
+        operation_name = next(operation for operation, method_name in operations.items() if method_name == name)
+
+        def call(**params):
+            if self.latency > 0:
+                time.sleep(self.latency)
+            self.state.advance()
+            try:
+                inspect.signature(method).bind(**params)
+            except TypeError as e:
+                raise LocalMTurkClientError(LocalMTurkError('ParameterValidationError', str(e)), operation_name)
+            try:
+                return convert_timestamps(method(**params))
+            except LocalMTurkError as e:
+                raise LocalMTurkClientError(e, operation_name)
+
+        return call
+
+
+def convert_timestamps(value):
+    """
+    Converts the epoch timestamps in a LocalMTurkState response to timezone-aware datetimes, as boto3 does
+    """
+    if isinstance(value, dict):
+        return {key: datetime.datetime.fromtimestamp(item, datetime.timezone.utc)
+                if key in timestamp_fields and isinstance(item, (int, float)) else convert_timestamps(item)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [convert_timestamps(item) for item in value]
+    return value
+
+
+class LocalMTurkServer:
+    """
+    Serves a LocalMTurkState for each MTurk environment over HTTP, with optional latency and throttling
+    """
+
+    def __init__(self,
+                 host='127.0.0.1',
+                 port=0,
+                 latency=0.0,
+                 latency_jitter=0.0,
+                 requests_per_second=None,
+                 throttle_probability=0.0,
+                 seed=0,
+                 **state_params):
+        """
+        :param host: the address to listen on
+        :param port: the port to listen on, or 0 to pick a free port
+        :param latency: the number of seconds to wait before answering each request
+        :param latency_jitter: a random number of seconds, up to this value, added to the latency of each request
+        :param requests_per_second: if given, requests above this rate are rejected with a ThrottlingException
+        :param throttle_probability: the probability that any request is rejected with a ThrottlingException
+        :param seed: the seed for the random number generators, so that runs can be reproduced
+        :param state_params: the parameters for each environment's LocalMTurkState, e.g. submission_delay
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.requests_per_second = requests_per_second
+        self.throttle_probability = throttle_probability
+        self.rng = random.Random(seed)
+        self.states = {
+            'production': LocalMTurkState(seed=seed, **state_params),
+            'sandbox': LocalMTurkState(seed=seed + 1, **state_params)
+        }
+        self.request_counts = {}
+        self.throttle_tokens = float(requests_per_second) if requests_per_second else 0.0
+        self.throttle_refill_time = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), self.build_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    def endpoint_url(self, sandbox=False):
+        """
+        :param sandbox: if True, gets the URL for the sandbox environment, else the URL for the production environment
+        :return: the endpoint URL to give to the mturk client
+        """
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/{"sandbox" if sandbox else "production"}'
+
+    def start(self):
+        """
+        Starts serving requests on a background thread
+        :return: the server
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='local-mturk', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def is_throttled(self):
+        with self.lock:
+            if self.throttle_probability and self.rng.random() < self.throttle_probability:
+                return True
+            if not self.requests_per_second:
+                return False
+            now = time.monotonic()
+            self.throttle_tokens = min(float(self.requests_per_second),
+                                       self.throttle_tokens + (now - self.throttle_refill_time) *
+                                       self.requests_per_second)
+            self.throttle_refill_time = now
+            if self.throttle_tokens < 1:
+                return True
+            self.throttle_tokens -= 1
+            return False
+
+    def handle(self, path, target, params):
+        """
+        Runs one MTurk operation
+        :param path: the request path, which selects the environment
+        :param target: the value of the X-Amz-Target header
+        :param params: the request parameters
+        :return: the response dictionary
+        """
+        operation = target[len(target_prefix):] if target.startswith(target_prefix) else target
+        with self.lock:
+            self.request_counts[operation] = self.request_counts.get(operation, 0) + 1
+
+        delay = self.latency + (self.rng.uniform(0, self.latency_jitter) if self.latency_jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        if self.is_throttled():
+            raise LocalMTurkError('ThrottlingException', 'Rate exceeded')
+
+        method_name = operations.get(operation)
+        if method_name is None:
+            raise LocalMTurkError('UnknownOperationException', f'{operation} is not supported by the local stand-in')
+        state = self.states['sandbox' if path.strip('/').startswith('sandbox') else 'production']
+        state.advance()
+        method = getattr(state, method_name)
+        try:
+            inspect.signature(method).bind(**params)
+        except TypeError as e:
+            raise LocalMTurkError('ParameterValidationError', str(e))
+        return method(**params)
+
+    def build_handler(self):
+        server = self
+
+        class LocalMTurkRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # The headers and body are written separately, so without this every call waits on a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                try:
+                    params = json.loads(body) if body else {}
+                    response, status = server.handle(self.path, self.headers.get('X-Amz-Target', ''), params), 200
+                except LocalMTurkError as e:
+                    response, status = {'__type': e.code, 'Message': e.message}, e.status
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/x-amz-json-1.1')
+                self.send_header('Content-Length', str(len(payload)))
+                self.send_header('x-amzn-RequestId', str(uuid.uuid4()))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return LocalMTurkRequestHandler
+
+
+def use_local_mturk(server):
+    """
+    Points the shared mturk clients at a local stand-in, so that every module talks to it instead of MTurk
+    :param server: the LocalMTurkServer
+    """
+
+    from mturksegutils import mturk_client
+
+    mturk_seg_vars.mturk_endpoint_urls['production'] = server.endpoint_url(sandbox=False)
+    mturk_seg_vars.mturk_endpoint_urls['sandbox'] = server.endpoint_url(sandbox=True)
+    with mturk_client.mturk_clients_lock:
+        mturk_client.mturk_clients.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for the MTurk requester API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='random seconds added to every request')
+    parser.add_argument('--requests-per-second', type=float, default=None, help='throttle requests above this rate')
+    parser.add_argument('--throttle-probability', type=float, default=0.0)
+    parser.add_argument('--submission-delay', type=float, default=5.0,
+                        help='mean seconds until each assignment is submitted')
+    parser.add_argument('--empty-submission-fraction', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    local_server = LocalMTurkServer(host=args.host,
+                                    port=args.port,
+                                    latency=args.latency,
+                                    latency_jitter=args.latency_jitter,
+                                    requests_per_second=args.requests_per_second,
+                                    throttle_probability=args.throttle_probability,
+                                    seed=args.seed,
+                                    submission_delay=args.submission_delay,
+                                    empty_submission_fraction=args.empty_submission_fraction)
+    print(f'Serving MTurk production at {local_server.endpoint_url()} and sandbox at '
+          f'{local_server.endpoint_url(sandbox=True)}')
+    try:
+        local_server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
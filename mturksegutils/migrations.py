@@ -0,0 +1,287 @@
+"""
+Versioned schema migrations for the experiment database
+
+The database_builder functions create the latest schema for a new database. Databases created by older versions of the
+package are brought up to date in place by the migrations below. Each migration has a version number and runs once, in
+its own transaction, and is recorded in the schema_migrations table when it commits. Every migration also checks the
+schema before changing it, so running them against a database that database_builder just created only records them.
+
+To upgrade an existing database:
+    python -m mturksegutils.migrations
+To list the migrations and whether each has been applied:
+    python -m mturksegutils.migrations --status
+Migrations that free a lot of space (e.g. move_blobs_out_of_row) only shrink the database file once it is vacuumed:
+    python -m mturksegutils.migrations --vacuum
+"""
+
+import argparse
+import datetime
+
+from mturksegutils import mturk_seg_vars, database_builder, blob_store, db_connections, annotation_codec, \
+    assignment_manager
+
+
+def table_exists(cursor, table_name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+    return cursor.fetchone() is not None
+
+
+def get_column_names(cursor, table_name):
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return [row[1] for row in cursor.fetchall()]
+
+
+def fix_hits_columns(cursor):
+    """
+    Rebuilds a hits table created without the interaction_log column
+    Before the comma after auto_approve_time was added to its DDL, SQLite read 'DATETIME interaction_log TEXT' as the
+    type of auto_approve_time, so the table has one column fewer than the positional row[N] reads expect
+    The table is rebuilt with the schema of this version, rather than with database_builder.create_hits_table, so that
+    later changes to the builder (which the later migrations apply) do not change what this migration does
+    """
+
+    if not table_exists(cursor, 'hits') or 'interaction_log' in get_column_names(cursor, 'hits'):
+        return
+
+    cursor.execute("ALTER TABLE hits RENAME TO hits_before_migration")
+    # The indexes moved to the renamed table with it, so their names must be freed before the new table creates them
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'hits_before_migration' "
+                   "AND sql IS NOT NULL")
+    for (index_name,) in cursor.fetchall():
+        cursor.execute(f"DROP INDEX {index_name}")
+    cursor.execute('''
+    CREATE TABLE hits (
+        hit_id TEXT PRIMARY KEY,
+        mturk_type TEXT,
+        exp_group TEXT,
+        image_url TEXT,
+        classes TEXT,
+        annotation_mode TEXT,
+        pre_annotations TEXT,
+        status TEXT,
+        assignment_id TEXT,
+        auto_approve_time DATETIME,
+        interaction_log TEXT,
+        annotation_in_progress TEXT,
+        result_data TEXT,
+        worker_id TEXT
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX hits_exp_group_image_url ON hits (exp_group, image_url)
+    ''')
+
+    old_columns = set(get_column_names(cursor, 'hits_before_migration'))
+    columns = ', '.join(column for column in get_column_names(cursor, 'hits') if column in old_columns)
+    cursor.execute(f"INSERT INTO hits ({columns}) SELECT {columns} FROM hits_before_migration")
+    cursor.execute("DROP TABLE hits_before_migration")
+
+
+def add_covering_indexes(cursor):
+    """
+    Adds the indexes for the review queue, status syncs, per-group selections and assignment lookups (see
+    database_builder.create_hits_indexes and create_training_tasks_indexes), and gathers the statistics the query
+    planner uses to choose between them
+    """
+
+    if table_exists(cursor, 'hits'):
+        database_builder.create_hits_indexes(cursor)
+    if table_exists(cursor, 'training_tasks'):
+        database_builder.create_training_tasks_indexes(cursor)
+    cursor.execute("ANALYZE")
+
+
+def split_assignments(cursor):
+    """
+    Creates the assignments table, and copies the assignment recorded on each row of the hits table into it
+    Only the last synced assignment of a HIT with several was kept in the hits table, so the others are added by the
+    next full sync of the HIT's experiment group (assignment_manager.sync_hits_to_db), which re-lists the assignments of
+    every HIT that MTurk lists with more submitted assignments than are recorded, whatever the status of its row
+    """
+
+    database_builder.create_assignments_table(cursor)
+    if table_exists(cursor, 'hits'):
+        cursor.execute("""
+            INSERT OR IGNORE INTO assignments (assignment_id, hit_id, mturk_type, worker_id, status, auto_approve_time,
+                                               interaction_log, annotation_in_progress, result_data)
+            SELECT assignment_id, hit_id, mturk_type, worker_id, status, auto_approve_time, interaction_log,
+                   annotation_in_progress, result_data
+            FROM hits WHERE assignment_id IS NOT NULL
+        """)
+
+
+def move_blobs_out_of_row(cursor):
+    """
+    Moves the annotation data stored inline in the assignments, training_tasks and hits tables to the assignment_blobs
+    table, compressed with mturk_seg_vars.blob_compression (see blob_store.py)
+    The data is compressed by a function registered on the connection, so it is streamed through SQLite rather than
+    read into memory, and the pages it frees are reused by the database until it is vacuumed
+    """
+
+    database_builder.create_assignment_blobs_table(cursor)
+    codec = mturk_seg_vars.blob_compression
+    cursor.connection.create_function('compress_blob', 1, lambda text: blob_store.compress(text, codec),
+                                      deterministic=True)
+
+    has_blobs = "assignment_id IS NOT NULL AND " \
+                "(interaction_log IS NOT NULL OR annotation_in_progress IS NOT NULL OR result_data IS NOT NULL)"
+    for table in ('assignments', 'training_tasks', 'hits'):
+        if not table_exists(cursor, table):
+            continue
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO assignment_blobs
+            (assignment_id, codec, interaction_log, annotation_in_progress, result_data)
+            SELECT assignment_id, ?, compress_blob(interaction_log), compress_blob(annotation_in_progress),
+                   compress_blob(result_data)
+            FROM {table} WHERE {has_blobs}
+        """, (codec,))
+        cursor.execute(f"UPDATE {table} SET interaction_log = NULL, annotation_in_progress = NULL, result_data = NULL "
+                       f"WHERE {has_blobs}")
+
+
+def encode_result_data(cursor):
+    """
+    Re-stores the final annotations in the assignment_blobs table that annotation_codec can encode exactly in its binary
+    form (see blob_store.write_blobs), compressed with the codec each row already uses - the others are left as json
+    """
+
+    def encode_blob(codec, data):
+        text = blob_store.decompress(data, codec)
+        if not isinstance(text, str):
+            return data
+        encoded = annotation_codec.encode_annotation_json(text)
+        return data if encoded is None else blob_store.compress(encoded, codec)
+
+    if not table_exists(cursor, 'assignment_blobs'):
+        return
+    cursor.connection.create_function('encode_blob', 2, encode_blob, deterministic=True)
+    cursor.execute("UPDATE assignment_blobs SET result_data = encode_blob(codec, result_data) "
+                   "WHERE result_data IS NOT NULL")
+
+
+def normalize_auto_approve_times(cursor):
+    """
+    Re-stores the auto_approve_time of every assignment, HIT and training task in the form written by
+    assignment_manager.format_auto_approve_time, so that infer_auto_approved_hits can compare the stored times directly
+    Times were stored as datetime strings in the requester's local timezone or as timestamps before - any that cannot be
+    read are set to NULL, which leaves the assignment's status to be checked with MTurk
+    """
+
+    cursor.connection.create_function('format_auto_approve_time', 1, assignment_manager.format_auto_approve_time,
+                                      deterministic=True)
+    for table in ('assignments', 'hits', 'training_tasks'):
+        if table_exists(cursor, table):
+            cursor.execute(f"UPDATE {table} SET auto_approve_time = format_auto_approve_time(auto_approve_time) "
+                           f"WHERE auto_approve_time IS NOT NULL")
+
+
+# The migrations in the order they are applied, as (version, name, function) tuples - new migrations are appended with
+# the next version number, and released migrations are never changed
+migrations = [
+    (1, 'fix_hits_columns', fix_hits_columns),
+    (2, 'add_covering_indexes', add_covering_indexes),
+    (3, 'split_assignments', split_assignments),
+    (4, 'move_blobs_out_of_row', move_blobs_out_of_row),
+    (5, 'encode_result_data', encode_result_data),
+    (6, 'normalize_auto_approve_times', normalize_auto_approve_times),
+]
+
+
+def get_applied_versions(cursor):
+    """
+    :return: the versions of the migrations that have been applied to the database, as a set
+    """
+    database_builder.create_schema_migrations_table(cursor)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(db_path=None, target_version=None, verbose=False):
+    """
+    Applies every migration the database has not had yet, in order
+    :param db_path: the database to migrate, defaults to mturk_seg_vars.db_path
+    :param target_version: the last version to apply, or None to apply every migration
+    :param verbose: whether or not to print each migration as it is applied
+    :return: the versions that were applied
+    """
+
+    if db_path is None:
+        db_path = mturk_seg_vars.db_path
+
+    # Transactions are managed explicitly, so that each migration's DDL and its schema_migrations row commit together
+    conn = db_connections.connect(db_path, isolation_level=None)
+    cursor = conn.cursor()
+    applied = []
+    try:
+        for version, name, migration in migrations:
+            if target_version is not None and version > target_version:
+                break
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Checked inside the write transaction, so two processes never apply the same migration
+                if version in get_applied_versions(cursor):
+                    cursor.execute("COMMIT")
+                    continue
+                if verbose:
+                    print(f'Applying migration {version}: {name}')
+                migration(cursor)
+                cursor.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                               (version, name, datetime.datetime.now()))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            applied.append(version)
+    finally:
+        conn.close()
+    return applied
+
+
+def vacuum(db_path=None):
+    """
+    Rebuilds the database file, returning the pages freed by the migrations to the file system
+    The whole database is copied, so this needs as much free disk space as the database takes, and blocks every other
+    connection until it finishes
+    :param db_path: the database to vacuum, defaults to mturk_seg_vars.db_path
+    """
+
+    if db_path is None:
+        db_path = mturk_seg_vars.db_path
+    conn = db_connections.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def get_migration_status(db_path=None):
+    """
+    :param db_path: the database to check, defaults to mturk_seg_vars.db_path
+    :return: a list of (version, name, applied) tuples, one per migration
+    """
+
+    if db_path is None:
+        db_path = mturk_seg_vars.db_path
+    conn = db_connections.connect(db_path)
+    applied_versions = get_applied_versions(conn.cursor())
+    conn.commit()
+    conn.close()
+    return [(version, name, version in applied_versions) for version, name, _ in migrations]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Brings the schema of the experiment database up to date')
+    parser.add_argument('--db-path', default=None, help='the database to migrate, defaults to mturk_seg_vars.db_path')
+    parser.add_argument('--target-version', type=int, default=None, help='the last migration to apply')
+    parser.add_argument('--status', action='store_true', help='list the migrations instead of applying them')
+    parser.add_argument('--vacuum', action='store_true', help='vacuum the database after applying the migrations')
+    args = parser.parse_args()
+
+    if args.status:
+        for version, name, applied in get_migration_status(args.db_path):
+            print(f"{version:>4}  {name:<32} {'applied' if applied else 'pending'}")
+    else:
+        applied = migrate(args.db_path, target_version=args.target_version, verbose=True)
+        print(f'Applied {len(applied)} migrations')
+        if args.vacuum:
+            vacuum(args.db_path)
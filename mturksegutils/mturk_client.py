@@ -1,24 +1,228 @@
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
 import boto3
+from botocore.config import Config
 
+from mturksegutils import mturk_seg_vars, rate_limiter, mturk_metrics
 
-def create_mturk_instance(sandbox=False):
+
+sandbox_endpoint_url = 'https://mturk-requester-sandbox.us-east-1.amazonaws.com'
+
+# The shared mturk clients for this process, keyed by 'sandbox' or 'production'
+# boto3 clients are thread-safe, so every module and thread reuses the same client and its connection pool
+mturk_clients = {}
+mturk_clients_pid = os.getpid()
+mturk_clients_lock = threading.Lock()
+
+# The budget of MTurk requests shared with every other process using the same database, created on first use
+shared_request_budget = None
+
+# The priority of the MTurk requests made in the current context - see request_priority
+current_request_priority = contextvars.ContextVar('mturk_request_priority', default='background')
+
+# The workflow that the MTurk requests made in the current context are attributed to - see request_workflow
+current_request_workflow = contextvars.ContextVar('mturk_request_workflow', default='other')
+
+
+def get_mturk_client(sandbox=False):
+    """
+    Gets the shared mturk client for the sandbox or production environment, creating it on first use
+    :param sandbox: if True, gets the client for the sandbox environment, else gets the client for the production environment
+    :return: the mturk client
     """
-    Creates an mturk client instance
+
+    global mturk_clients_pid
+
+    mturk_type = 'sandbox' if sandbox else 'production'
+    mturk = mturk_clients.get(mturk_type)
+    if mturk is not None and mturk_clients_pid == os.getpid():
+        return mturk
+
+    with mturk_clients_lock:
+        # A forked process must not share the parent's connection pool, so it builds its own clients
+        if mturk_clients_pid != os.getpid():
+            mturk_clients.clear()
+            mturk_clients_pid = os.getpid()
+        if mturk_type not in mturk_clients:
+            mturk_clients[mturk_type] = build_mturk_client(sandbox)
+        return mturk_clients[mturk_type]
+
+
+def build_mturk_client(sandbox=False):
+    """
+    Builds a new mturk client with connection pooling, retries and timeouts configured in mturk_seg_vars
+    Most code should call get_mturk_client instead, so that the client is shared
     :param sandbox: if True, creates a client for the sandbox environment, else creates a client for the production environment
     :return: the mturk client
     """
-    if sandbox:
-        mturk = boto3.client('mturk',
-                             region_name='us-east-1',
-                             endpoint_url='https://mturk-requester-sandbox.us-east-1.amazonaws.com'
-                             )
+
+    config = Config(
+        max_pool_connections=mturk_seg_vars.mturk_max_pool_connections,
+        retries={
+            'mode': 'adaptive',
+            'max_attempts': mturk_seg_vars.mturk_max_attempts
+        },
+        connect_timeout=mturk_seg_vars.mturk_connect_timeout,
+        read_timeout=mturk_seg_vars.mturk_read_timeout
+    )
+
+    # Client creation is not thread-safe on boto3's default session, so each client gets its own session
+    session = boto3.session.Session()
+    mturk_type = 'sandbox' if sandbox else 'production'
+    endpoint_url = mturk_seg_vars.mturk_endpoint_urls.get(mturk_type)
+    if endpoint_url:
+        mturk = session.client('mturk',
+                               region_name='us-east-1',
+                               endpoint_url=endpoint_url,
+                               config=config
+                               )
+    elif sandbox:
+        mturk = session.client('mturk',
+                               region_name='us-east-1',
+                               endpoint_url=sandbox_endpoint_url,
+                               config=config
+                               )
     else:
-        mturk = boto3.client('mturk',
-                             region_name='us-east-1',
-                             )
+        mturk = session.client('mturk',
+                               region_name='us-east-1',
+                               config=config
+                               )
+
+    register_request_budget(mturk, mturk_type)
+    register_call_metrics(mturk, mturk_type)
     return mturk
 
 
+def register_request_budget(mturk, mturk_type):
+    """
+    Makes every request sent by the client, including retries, draw a token from the shared request budget first
+    Requests that MTurk throttles are recorded in the budget's throttle_events table, and in mturk_metrics
+    :param mturk: the mturk client
+    :param mturk_type: 'sandbox' or 'production'
+    """
+
+    def draw_from_request_budget(**kwargs):
+        budget = get_shared_request_budget()
+        if budget is not None:
+            budget.acquire(mturk_type, current_request_priority.get())
+
+    def record_throttled_request(response=None, operation=None, **kwargs):
+        budget = get_shared_request_budget()
+        if response is not None and rate_limiter.is_throttling_response(response[1]):
+            mturk_metrics.record_throttle(mturk_type, operation.name, current_request_workflow.get())
+            if budget is not None:
+                budget.record_throttle(mturk_type, operation.name, current_request_priority.get())
+
+    mturk.meta.events.register('before-send.mturk', draw_from_request_budget)
+    mturk.meta.events.register('needs-retry.mturk', record_throttled_request)
+
+
+def register_call_metrics(mturk, mturk_type):
+    """
+    Makes the client report the operation, latency, retries and outcome of every call it makes to mturk_metrics, with
+    the workflow that made the call (see request_workflow)
+    The latency is measured from the start of the call to its end, so it includes any wait for the request budget and
+    the backoff between retries
+    :param mturk: the mturk client
+    :param mturk_type: 'sandbox' or 'production'
+    """
+
+    def start_call(model=None, context=None, **kwargs):
+        context['metrics_operation'] = model.name
+        context['metrics_start'] = time.perf_counter()
+
+    def finish_call(context, error_class=None):
+        if 'metrics_start' not in context:
+            return
+        retries = context.get('retries', {}).get('attempt', 1) - 1
+        mturk_metrics.record_call(mturk_type, context['metrics_operation'], current_request_workflow.get(),
+                                  time.perf_counter() - context.pop('metrics_start'), retries, error_class)
+
+    def record_response(http_response=None, parsed=None, context=None, **kwargs):
+        error_class = None
+        if http_response.status_code >= 300:
+            error_class = parsed.get('Error', {}).get('Code') or f'HTTP{http_response.status_code}'
+        finish_call(context, error_class)
+
+    def record_exception(exception=None, context=None, **kwargs):
+        # Raised before MTurk responded, e.g. a connection error or timeout that outlasted the retries
+        finish_call(context, type(exception).__name__)
+
+    mturk.meta.events.register('before-call.mturk', start_call)
+    mturk.meta.events.register('after-call.mturk', record_response)
+    mturk.meta.events.register('after-call-error.mturk', record_exception)
+
+
+def get_shared_request_budget():
+    """
+    Gets the request budget shared by every process that calls MTurk for this experiment database
+    :return: the SharedRequestBudget, or None if the budget is disabled or there is no database to share it through
+    """
+
+    global shared_request_budget
+
+    if shared_request_budget is None:
+        budget_path = mturk_seg_vars.mturk_request_budget_path
+        if not budget_path and mturk_seg_vars.db_path:
+            budget_path = f'{mturk_seg_vars.db_path}.request_budget'
+        if not mturk_seg_vars.mturk_request_budget_enabled or not budget_path:
+            return None
+        with mturk_clients_lock:
+            if shared_request_budget is None:
+                shared_request_budget = rate_limiter.SharedRequestBudget(
+                    budget_path,
+                    mturk_seg_vars.mturk_request_budget_per_second,
+                    reserved_fractions=mturk_seg_vars.mturk_request_budget_reserved_fractions
+                )
+    return shared_request_budget
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """
+    Sets the priority of the MTurk requests made inside the with block
+    'interactive' requests (e.g. from the review app) may use the whole request budget, while 'background' requests
+    (the default) leave a share of it free
+    :param priority: one of the keys of mturk_seg_vars.mturk_request_budget_reserved_fractions
+    """
+
+    token = current_request_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_request_priority.reset(token)
+
+
+@contextlib.contextmanager
+def request_workflow(workflow):
+    """
+    Attributes the MTurk requests made inside the with block to a workflow in mturk_metrics, e.g. 'sync' or 'review'
+    Can also be used as a decorator, to attribute every request a function makes
+    :param workflow: the name of the workflow
+    """
+
+    token = current_request_workflow.set(workflow)
+    try:
+        yield
+    finally:
+        current_request_workflow.reset(token)
+
+
+def create_mturk_instance(sandbox=False):
+    """
+    Gets an mturk client instance
+    Kept for compatibility - this returns the same shared client as get_mturk_client
+    :param sandbox: if True, gets a client for the sandbox environment, else gets a client for the production environment
+    :return: the mturk client
+    """
+
+    return get_mturk_client(sandbox=sandbox)
+
+
 def get_mturk_type(mturk):
     """
     For an mturk client instance, determines whether it is a production or sandbox client
@@ -28,4 +232,4 @@ def get_mturk_type(mturk):
     mturk_type = 'production'
     if 'sandbox' in mturk._endpoint.host:
         mturk_type = 'sandbox'
-    return mturk_type
\ No newline at end of file
+    return mturk_type
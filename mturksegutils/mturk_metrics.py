@@ -0,0 +1,328 @@
+"""
+Per-operation metrics for the MTurk calls made by this process
+
+Every client built by mturk_client.build_mturk_client reports each call it makes here (see
+mturk_client.register_call_metrics). Each call is labelled with:
+- the environment
+- the operation
+- the workflow that made the call (see mturk_client.request_workflow)
+
+For each set of labels, this records the number of calls, a latency histogram, the number of retried and throttled
+attempts, and the failures by error class. The numbers are kept in two places:
+- prometheus_client metrics in the default registry. A long-running process can serve them with start_metrics_server,
+  and the review app can export them with prometheus-flask-exporter.
+- a periodic summary in the mturk_call_metrics table. A background thread writes it every mturk_metrics_flush_interval
+  seconds, and once more when the process exits.
+
+To summarize the calls of the last day from the database:
+    python -m mturksegutils.mturk_metrics --since-hours 24
+"""
+
+import argparse
+import atexit
+import bisect
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import prometheus_client
+
+from mturksegutils import mturk_seg_vars, database_builder, db_connections
+
+
+# The upper bounds, in seconds, of the latency histogram buckets
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+label_names = ('mturk_type', 'operation', 'workflow')
+
+request_count = prometheus_client.Counter('mturk_requests', 'MTurk API calls', label_names)
+request_latency = prometheus_client.Histogram('mturk_request_latency_seconds',
+                                              'The latency of MTurk API calls, including retries', label_names,
+                                              buckets=latency_buckets)
+request_retries = prometheus_client.Counter('mturk_request_retries', 'Retried attempts of MTurk API calls', label_names)
+request_throttles = prometheus_client.Counter('mturk_request_throttles',
+                                              'Attempts of MTurk API calls that were throttled', label_names)
+request_errors = prometheus_client.Counter('mturk_request_errors', 'MTurk API calls that failed, by error class',
+                                           label_names + ('error_class',))
+
+# The calls made since the last flush, keyed by (mturk_type, operation, workflow)
+call_summaries = {}
+call_summaries_lock = threading.Lock()
+period_start = time.time()
+
+# The background thread that flushes the summaries to the database, started on the first call in each process
+flusher = None
+flusher_pid = None
+
+
+class CallSummary:
+    """
+    The calls made with one set of labels during a period
+    """
+
+    def __init__(self):
+        self.num_calls = 0
+        self.num_errors = 0
+        self.num_retries = 0
+        self.num_throttled = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        # One count per latency bucket, plus one for the calls slower than the last bucket
+        self.bucket_counts = [0] * (len(latency_buckets) + 1)
+        self.error_classes = {}
+
+    def add_call(self, latency, retries, error_class=None):
+        self.num_calls += 1
+        self.num_retries += retries
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.bucket_counts[bisect.bisect_left(latency_buckets, latency)] += 1
+        if error_class is not None:
+            self.num_errors += 1
+            self.error_classes[error_class] = self.error_classes.get(error_class, 0) + 1
+
+
+def get_latency_quantile(bucket_counts, max_latency, quantile):
+    """
+    Estimates a latency quantile from a histogram, as the upper bound of the bucket the quantile falls in
+    :param bucket_counts: the number of calls in each bucket of latency_buckets, plus the calls slower than the last
+    :param max_latency: the slowest call, which bounds the last bucket
+    :param quantile: the quantile, e.g. 0.95
+    :return: the estimated latency in seconds, or None if there were no calls
+    """
+
+    total = sum(bucket_counts)
+    if total == 0:
+        return None
+    rank = quantile * total
+    count = 0
+    for bound, bucket_count in zip(latency_buckets, bucket_counts):
+        count += bucket_count
+        if count >= rank:
+            return min(bound, max_latency)
+    return max_latency
+
+
+def record_call(mturk_type, operation, workflow, latency, retries=0, error_class=None):
+    """
+    Records a completed MTurk call
+    :param mturk_type: 'sandbox' or 'production'
+    :param operation: the name of the MTurk operation, e.g. 'GetAssignment'
+    :param workflow: the workflow that made the call
+    :param latency: the seconds the call took, including retries
+    :param retries: the number of times the call was retried
+    :param error_class: the error code or exception class the call failed with, or None if it succeeded
+    """
+
+    labels = (mturk_type, operation, workflow)
+    request_count.labels(*labels).inc()
+    request_latency.labels(*labels).observe(latency)
+    if retries > 0:
+        request_retries.labels(*labels).inc(retries)
+    if error_class is not None:
+        request_errors.labels(*labels, error_class).inc()
+
+    with call_summaries_lock:
+        summary = call_summaries.get(labels)
+        if summary is None:
+            summary = call_summaries[labels] = CallSummary()
+        summary.add_call(latency, retries, error_class)
+    start_flusher()
+
+
+def record_throttle(mturk_type, operation, workflow):
+    """
+    Records an attempt of an MTurk call that was throttled
+    """
+
+    labels = (mturk_type, operation, workflow)
+    request_throttles.labels(*labels).inc()
+    with call_summaries_lock:
+        summary = call_summaries.get(labels)
+        if summary is None:
+            summary = call_summaries[labels] = CallSummary()
+        summary.num_throttled += 1
+
+
+def flush_call_metrics(db_path=None):
+    """
+    Writes the summaries of the calls made since the last flush to the mturk_call_metrics table, and starts a new period
+    :param db_path: the database to write to, defaults to mturk_seg_vars.db_path
+    :return: the number of rows written
+    """
+
+    global period_start
+
+    if db_path is None:
+        db_path = mturk_seg_vars.db_path
+    with call_summaries_lock:
+        summaries = dict(call_summaries)
+        call_summaries.clear()
+        start, end = period_start, time.time()
+        period_start = end
+    if len(summaries) == 0 or not db_path:
+        return 0
+
+    rows = []
+    for (mturk_type, operation, workflow), summary in summaries.items():
+        rows.append((datetime.datetime.fromtimestamp(start), datetime.datetime.fromtimestamp(end), os.getpid(),
+                     mturk_type, operation, workflow, summary.num_calls, summary.num_errors, summary.num_retries,
+                     summary.num_throttled, summary.total_latency, summary.max_latency,
+                     get_latency_quantile(summary.bucket_counts, summary.max_latency, 0.5),
+                     get_latency_quantile(summary.bucket_counts, summary.max_latency, 0.95),
+                     json.dumps(summary.bucket_counts), json.dumps(summary.error_classes)))
+
+    conn = db_connections.connect(db_path)
+    cursor = conn.cursor()
+    database_builder.create_mturk_call_metrics_table(cursor)
+    cursor.executemany("INSERT INTO mturk_call_metrics (period_start, period_end, pid, mturk_type, operation, "
+                       "workflow, num_calls, num_errors, num_retries, num_throttled, total_latency, max_latency, p50_latency, "
+                       "p95_latency, latency_buckets, error_classes) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+
+def try_flush_call_metrics():
+    """
+    Flushes the call summaries to the database, reporting rather than raising any database error, since the metrics
+    must never interrupt the calls they describe
+    """
+
+    try:
+        flush_call_metrics()
+    except sqlite3.Error as e:
+        print(f'Failed to write the MTurk call metrics: {e}')
+
+
+class MetricsFlusher:
+    """
+    Flushes the call summaries to the database at a fixed interval, on a daemon thread
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='mturk-metrics-flusher', daemon=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try_flush_call_metrics()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def start_flusher():
+    """
+    Starts the background flusher for this process, unless it is running or mturk_metrics_flush_interval is 0
+    """
+
+    global flusher, flusher_pid
+
+    # A forked process does not inherit the parent's thread, so it starts its own
+    if flusher_pid == os.getpid() or mturk_seg_vars.mturk_metrics_flush_interval <= 0:
+        return
+    with call_summaries_lock:
+        if flusher_pid == os.getpid():
+            return
+        if flusher_pid is None:
+            atexit.register(try_flush_call_metrics)
+        flusher = MetricsFlusher(mturk_seg_vars.mturk_metrics_flush_interval).start()
+        flusher_pid = os.getpid()
+
+
+def start_metrics_server(port=None):
+    """
+    Serves the prometheus metrics of this process over HTTP, on a daemon thread
+    :param port: the port to serve on, defaults to mturk_seg_vars.mturk_metrics_port
+    """
+
+    if port is None:
+        port = mturk_seg_vars.mturk_metrics_port
+    prometheus_client.start_http_server(port)
+
+
+def summarize_call_metrics(cursor, since=None, mturk_type=None):
+    """
+    Combines the summaries in the mturk_call_metrics table by workflow and operation
+    :param cursor: the database cursor
+    :param since: the earliest period to include, as a datetime, or None for every period
+    :param mturk_type: the environment to include, or None for both
+    :return: a list of dictionaries, one per workflow and operation, ordered by the total time spent in the calls
+    """
+
+    database_builder.create_mturk_call_metrics_table(cursor)
+    query = "SELECT workflow, operation, num_calls, num_errors, num_retries, num_throttled, total_latency, " \
+            "max_latency, latency_buckets, error_classes FROM mturk_call_metrics WHERE 1 = 1"
+    params = []
+    if since is not None:
+        query += " AND period_end >= ?"
+        params.append(since)
+    if mturk_type is not None:
+        query += " AND mturk_type = ?"
+        params.append(mturk_type)
+    cursor.execute(query, params)
+
+    combined = {}
+    for workflow, operation, num_calls, num_errors, num_retries, num_throttled, total_latency, max_latency, \
+            bucket_counts, error_classes in cursor.fetchall():
+        entry = combined.setdefault((workflow, operation), {
+            'workflow': workflow, 'operation': operation, 'num_calls': 0, 'num_errors': 0, 'num_retries': 0,
+            'num_throttled': 0, 'total_latency': 0.0, 'max_latency': 0.0,
+            'bucket_counts': [0] * (len(latency_buckets) + 1), 'error_classes': {}})
+        entry['num_calls'] += num_calls
+        entry['num_errors'] += num_errors
+        entry['num_retries'] += num_retries
+        entry['num_throttled'] += num_throttled
+        entry['total_latency'] += total_latency
+        entry['max_latency'] = max(entry['max_latency'], max_latency)
+        entry['bucket_counts'] = [a + b for a, b in zip(entry['bucket_counts'], json.loads(bucket_counts))]
+        for error_class, count in json.loads(error_classes).items():
+            entry['error_classes'][error_class] = entry['error_classes'].get(error_class, 0) + count
+
+    summaries = sorted(combined.values(), key=lambda entry: entry['total_latency'], reverse=True)
+    for entry in summaries:
+        entry['mean_latency'] = entry['total_latency'] / entry['num_calls'] if entry['num_calls'] > 0 else None
+        entry['p50_latency'] = get_latency_quantile(entry['bucket_counts'], entry['max_latency'], 0.5)
+        entry['p95_latency'] = get_latency_quantile(entry['bucket_counts'], entry['max_latency'], 0.95)
+    return summaries
+
+
+def print_call_metrics(summaries):
+    """
+    Prints the result of summarize_call_metrics as a table
+    """
+
+    print(f"{'workflow':<16} {'operation':<32} {'calls':>8} {'errors':>7} {'retries':>7} {'throttled':>9} "
+          f"{'mean s':>7} {'p95 s':>7} {'max s':>7}  errors by class")
+    for entry in summaries:
+        error_classes = ', '.join(f'{error_class}: {count}' for error_class, count in
+                                  sorted(entry['error_classes'].items(), key=lambda item: -item[1]))
+        print(f"{entry['workflow']:<16} {entry['operation']:<32} {entry['num_calls']:>8} {entry['num_errors']:>7} "
+              f"{entry['num_retries']:>7} {entry['num_throttled']:>9} {entry['mean_latency'] or 0:>7.3f} "
+              f"{entry['p95_latency'] or 0:>7.3f} {entry['max_latency']:>7.3f}  {error_classes}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarizes the MTurk calls recorded in the mturk_call_metrics table')
+    parser.add_argument('--since-hours', type=float, default=None, help='only include the last this many hours')
+    parser.add_argument('--sandbox', action='store_true', help='summarize the sandbox calls instead of production')
+    args = parser.parse_args()
+
+    since = None
+    if args.since_hours is not None:
+        since = datetime.datetime.now() - datetime.timedelta(hours=args.since_hours)
+    conn = db_connections.connect()
+    print_call_metrics(summarize_call_metrics(conn.cursor(), since=since,
+                                              mturk_type='sandbox' if args.sandbox else 'production'))
+    conn.close()
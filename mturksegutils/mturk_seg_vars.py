@@ -21,4 +21,109 @@ any_object_count_qual_name = ''
 invite_only_qual_name = ''
 
 # The score required on the vocab screening quiz for entry into the study
-vocab_score_requirement = 80
\ No newline at end of file
+vocab_score_requirement = 80
+
+# The number of concurrent create_hit calls and the target request rate used when posting a batch of HITs
+posting_num_workers = 8
+posting_requests_per_second = 5
+
+# The number of concurrent requests and the target request rate used when syncing HITs and assignments from MTurk
+# The results are written to the database from a single thread, committing once every sync_commit_every_n results
+sync_num_workers = 8
+sync_requests_per_second = 10
+sync_commit_every_n = 100
+
+# If greater than 1, the answer XML of the assignments fetched during a sync is parsed in a pool of this many processes,
+# rather than in the thread that writes to the database
+sync_parse_processes = 0
+
+# Settings for the background sync scheduler (see sync_scheduler.py) - its calls are spread evenly at this rate, and
+# submitted HITs that auto-approve within the review horizon (in seconds) are reported as at risk
+sync_scheduler_requests_per_second = 2
+sync_scheduler_discovery_interval = 300
+sync_scheduler_review_horizon = 86400
+sync_scheduler_batch_size = 50
+
+# The per-operation metrics of the MTurk calls made by each process (see mturk_metrics.py) are summarized into the
+# mturk_call_metrics table every this many seconds (0 to only keep them in memory), and served to prometheus on this
+# port by mturk_metrics.start_metrics_server
+mturk_metrics_flush_interval = 300
+mturk_metrics_port = 9464
+
+# Submitted HITs are marked as approved locally once their auto_approve_time is this many seconds in the past, which
+# allows for the clock here running ahead of MTurk's (see assignment_manager.infer_auto_approved_hits)
+status_inference_grace_seconds = 300
+# The number of locally inferred statuses checked against MTurk after each status update (-1 for all of them, 0 for none)
+status_inference_audits_per_pass = 20
+
+# Settings for the connections to the experiment database (see db_connections.py) - WAL mode lets the review app read
+# while a sync is writing, but is not supported on network file systems, where the journal mode should be 'DELETE'
+db_journal_mode = 'WAL'
+db_synchronous = 'NORMAL'
+# The seconds a connection waits for another connection's write to finish before failing with 'database is locked'
+db_busy_timeout = 30
+db_cache_size_kb = 65536
+db_mmap_size_mb = 256
+
+# The annotation data of each assignment is stored compressed, out of row (see blob_store.py), with 'zlib' or 'zstd' (which
+# requires the zstandard package) at this compression level
+blob_compression = 'zlib'
+blob_compression_level = 6
+
+# Settings for notification-driven ingestion (see notification_ingest.py) - when a destination is set, the HIT types
+# registered while posting send these events to it, and notification_ingest ingests each submitted assignment from it
+# A destination is an SQS queue URL, or for offline use a local directory or 'sqlite:<path>' queue
+notification_destinations = {
+    'production': '',
+    'sandbox': ''
+}
+notification_event_types = ['AssignmentSubmitted', 'AssignmentReturned', 'AssignmentAbandoned']
+
+# The index of every HIT on the account built by reconciliation.HitIndex is reused for lookups by requester annotation
+# until it is this many seconds old
+hit_index_max_age_seconds = 300
+
+# The number of HIT requests whose posting journal rows are committed together, before any of them are sent
+posting_journal_chunk_size = 50
+
+# The number of task_config rows read from the database at a time when posting a batch
+task_config_page_size = 500
+
+# MTurk rejects HITs whose question XML is longer than this many characters
+max_question_length = 131072
+
+# If True, indentation and blank lines are stripped from the task html before it is sent to MTurk
+minify_question_html = False
+
+# The IDs of the HIT layouts registered for the task html (see hit_builder.export_hit_layout_html)
+# When an ID is set for an environment, HITs are posted with HITLayoutParameters instead of the full question XML
+hit_layout_ids = {
+    'production': '',
+    'sandbox': ''
+}
+
+# Settings for the shared mturk clients - the connection pool should be at least as large as the number of threads that
+# make requests at the same time (e.g. posting_num_workers)
+mturk_max_pool_connections = 20
+mturk_max_attempts = 5
+mturk_connect_timeout = 10
+mturk_read_timeout = 30
+
+# If set, the mturk clients send requests to these URLs instead of MTurk, e.g. a local_mturk.LocalMTurkServer
+# The sandbox URL must contain 'sandbox', so that mturk_client.get_mturk_type can tell the environments apart
+mturk_endpoint_urls = {
+    'production': '',
+    'sandbox': ''
+}
+
+# Every process that calls MTurk draws from one shared request budget, stored in a small SQLite file
+# If no path is given, the budget is stored next to the experiment database as '<db_path>.request_budget'
+mturk_request_budget_enabled = True
+mturk_request_budget_path = ''
+mturk_request_budget_per_second = 10
+
+# The fraction of the request budget that each priority level must leave untouched
+mturk_request_budget_reserved_fractions = {
+    'interactive': 0.0,
+    'background': 0.5
+}
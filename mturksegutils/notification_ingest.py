@@ -0,0 +1,326 @@
+"""
+Event-driven ingestion of submitted assignments, from MTurk notifications
+
+Instead of polling MTurk for new submissions, each HIT type is registered to send an event to a queue whenever one of
+its assignments is submitted, returned or abandoned (see register_notifications - HIT types registered while posting
+are set up automatically when mturk_seg_vars.notification_destinations is set). The ingester consumes the queue and
+ingests exactly the assignment each AssignmentSubmitted event names, with one get_assignment call, so submissions reach
+the database within seconds and the polling syncs only need to run occasionally, as a safety net.
+
+Messages are only deleted from the queue once their assignments are committed, and assignments that are already in the
+database are skipped, so an event that is delivered more than once is only ingested once. To consume the queue:
+    python -m mturksegutils.notification_ingest --destination sqlite:/path/to/events.db
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from mturksegutils import mturk_seg_vars, mturk_client, assignment_manager, database_builder, notification_queues, \
+    posting_engine, mturk_metrics, db_connections
+
+
+def register_notification(mturk, hit_type_id, destination, event_types=None):
+    """
+    Registers a HIT type to send notifications for its assignment events to a queue
+    :param mturk: the mturk client instance
+    :param hit_type_id: the HIT type to register
+    :param destination: an SQS queue URL, or a local queue (see notification_queues.open_queue)
+    :param event_types: the events to send, defaults to mturk_seg_vars.notification_event_types
+    """
+
+    if event_types is None:
+        event_types = mturk_seg_vars.notification_event_types
+    mturk.update_notification_settings(HITTypeId=hit_type_id,
+                                       Notification={'Destination': destination, 'Transport': 'SQS',
+                                                     'Version': '2014-08-15', 'EventTypes': list(event_types)},
+                                       Active=True)
+
+
+def register_notifications(mturk, destination=None, exp_group=None, event_types=None):
+    """
+    Registers every HIT type recorded in the hit_types table for an environment to send notifications to a queue
+    :param mturk: the mturk client instance
+    :param destination: the queue, defaults to the environment's entry in mturk_seg_vars.notification_destinations
+    :param exp_group: the experiment group to register the HIT types of, or None for every group
+    :param event_types: the events to send, defaults to mturk_seg_vars.notification_event_types
+    :return: the number of HIT types registered
+    """
+
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    if destination is None:
+        destination = mturk_seg_vars.notification_destinations[mturk_type]
+
+    conn = db_connections.connect()
+    cursor = conn.cursor()
+    database_builder.create_hit_types_table(cursor)
+    if exp_group is None:
+        cursor.execute("SELECT DISTINCT hit_type_id FROM hit_types WHERE mturk_type = ?", (mturk_type,))
+    else:
+        cursor.execute("SELECT DISTINCT hit_type_id FROM hit_types WHERE mturk_type = ? AND exp_group = ?",
+                       (mturk_type, exp_group))
+    hit_type_ids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+
+    for hit_type_id in hit_type_ids:
+        register_notification(mturk, hit_type_id, destination, event_types)
+    return len(hit_type_ids)
+
+
+def parse_event_messages(bodies):
+    """
+    :param bodies: the bodies of notification messages, each a json event document from MTurk
+    :return: a list of the events in the messages - messages that are not event documents (e.g. the test message SQS
+    sends when a queue is subscribed) have no events
+    """
+
+    events = []
+    for body in bodies:
+        try:
+            document = json.loads(body)
+        except ValueError:
+            continue
+        if isinstance(document, dict):
+            events.extend(event for event in document.get('Events', []) if isinstance(event, dict))
+    return events
+
+
+class NotificationIngester:
+    """
+    Consumes assignment event notifications for one MTurk environment, and ingests each submitted assignment
+    """
+
+    def __init__(self, destination=None, sandbox=False, mturk=None, batch_size=10, visibility_timeout=60,
+                 max_receive_count=5):
+        """
+        :param destination: the queue to consume, defaults to the environment's entry in
+        mturk_seg_vars.notification_destinations
+        :param sandbox: True to ingest the sandbox environment's events, False for production
+        :param mturk: an optional mturk client to use instead of the shared client
+        :param batch_size: the max number of messages received at a time
+        :param visibility_timeout: the seconds a received message is hidden from other consumers before it is delivered
+        again, if it has not been deleted
+        :param max_receive_count: the number of times an assignment that cannot be fetched from MTurk (e.g. of a
+        deleted HIT) is tried before its message is deleted anyway - the full sync still finds the assignment if it
+        exists. The count is kept in memory, so an SQS queue may also set a redrive policy for messages that fail
+        across restarts
+        """
+
+        self.mturk = mturk if mturk is not None else mturk_client.get_mturk_client(sandbox=sandbox)
+        self.mturk_type = mturk_client.get_mturk_type(self.mturk)
+        if destination is None:
+            destination = mturk_seg_vars.notification_destinations[self.mturk_type]
+        self.queue = notification_queues.open_queue(destination)
+        self.batch_size = batch_size
+        self.visibility_timeout = visibility_timeout
+        self.max_receive_count = max_receive_count
+        # The number of times each assignment has failed to be fetched
+        self.failure_counts = {}
+
+        self.num_events = 0
+        self.num_ingested = 0
+        self.num_skipped = 0
+        self.num_errors = 0
+        self.max_latency = 0.0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def run_once(self, conn, cursor):
+        """
+        Receives a batch of messages, ingests the assignments their events name, and deletes them from the queue
+        :param conn: the database connection
+        :param cursor: the database cursor
+        :return: the number of messages handled
+        """
+
+        messages = self.queue.receive(max_messages=self.batch_size, visibility_timeout=self.visibility_timeout)
+        if len(messages) == 0:
+            return 0
+
+        message_events = [parse_event_messages([body]) for _, body in messages]
+        events = [event for events in message_events for event in events]
+        self.num_events += len(events)
+        num_ingested, failed_assignment_ids = self.ingest_events(conn, cursor, events)
+
+        # Messages are only deleted once their assignments are committed, so none are lost if ingestion fails - a
+        # message with an assignment that could not be fetched is delivered again after the visibility timeout, until
+        # the assignment has failed max_receive_count times
+        given_up = set()
+        for assignment_id in failed_assignment_ids:
+            self.failure_counts[assignment_id] = self.failure_counts.get(assignment_id, 0) + 1
+            if self.failure_counts[assignment_id] >= self.max_receive_count:
+                print(f'Giving up on assignment {assignment_id} after {self.max_receive_count} failed attempts')
+                given_up.add(assignment_id)
+                del self.failure_counts[assignment_id]
+        retried = set(failed_assignment_ids) - given_up
+        for (receipt, _), events in zip(messages, message_events):
+            if not any(event.get('AssignmentId') in retried for event in events):
+                self.queue.delete(receipt)
+        return len(messages)
+
+    def ingest_events(self, conn, cursor, events):
+        """
+        Ingests the assignment named by each AssignmentSubmitted event, unless it is already in the database
+        Returned and abandoned assignments leave their HITs open, so there is nothing to record for them
+        :param conn: the database connection
+        :param cursor: the database cursor
+        :param events: the events, as returned by parse_event_messages
+        :return: the number of assignments ingested, and the IDs of the assignments that could not be fetched from MTurk
+        """
+
+        submitted = {}
+        for event in events:
+            if event.get('EventType') == 'AssignmentSubmitted' and event.get('AssignmentId'):
+                submitted[event['AssignmentId']] = event
+        if len(submitted) == 0:
+            return 0, []
+
+        database_builder.create_hit_sync_times_table(cursor)
+        database_builder.create_assignments_table(cursor)
+        database_builder.create_assignment_blobs_table(cursor)
+        new_events = self.select_new_submissions(cursor, list(submitted.values()))
+        self.num_skipped += len(submitted) - len(new_events)
+
+        jobs = (({'AssignmentId': event['AssignmentId']}, event) for event in new_events)
+        num_ingested = 0
+        failed_assignment_ids = []
+        for event, response, error in posting_engine.fetch_results(self.mturk.get_assignment, jobs):
+            if error is not None:
+                print(f"Failed to get assignment {event['AssignmentId']}: {error}")
+                failed_assignment_ids.append(event['AssignmentId'])
+                continue
+            assignment_manager.record_assignments_for_hit(cursor, event['HITId'], self.mturk_type,
+                                                          [response['Assignment']], is_qual=event['is_qual'])
+            assignment_manager.record_hit_sync_times(cursor, [event['HITId']])
+            num_ingested += 1
+            submit_time = response['Assignment'].get('SubmitTime')
+            if hasattr(submit_time, 'timestamp'):
+                self.max_latency = max(self.max_latency, time.time() - submit_time.timestamp())
+        conn.commit()
+
+        self.num_ingested += num_ingested
+        self.num_errors += len(failed_assignment_ids)
+        return num_ingested, failed_assignment_ids
+
+    def select_new_submissions(self, cursor, events):
+        """
+        Filters a set of AssignmentSubmitted events down to the assignments of our HITs that are not yet recorded
+        :param cursor: the database cursor
+        :param events: the events
+        :return: the events to ingest, each with an 'is_qual' flag added
+        """
+
+        hit_ids = list({event['HITId'] for event in events})
+        placeholders = ', '.join('?' * len(hit_ids))
+        cursor.execute(f"SELECT hit_id, exp_group FROM hits WHERE mturk_type = ? "
+                       f"AND hit_id IN ({placeholders})", (self.mturk_type, *hit_ids))
+        hits = dict(cursor.fetchall())
+
+        # The assignments of qual HITs are recorded in the training_tasks table and the others in the assignments
+        # table, both of which can hold several per HIT
+        recorded_assignments = set()
+        for table, is_qual in (('training_tasks', True), ('assignments', False)):
+            table_hit_ids = [hit_id for hit_id, exp_group in hits.items() if exp_group.startswith('qual') == is_qual]
+            if len(table_hit_ids) > 0:
+                cursor.execute(f"SELECT assignment_id FROM {table} "
+                               f"WHERE hit_id IN ({', '.join('?' * len(table_hit_ids))})", table_hit_ids)
+                recorded_assignments.update(row[0] for row in cursor.fetchall())
+
+        new_events = []
+        for event in events:
+            exp_group = hits.get(event['HITId'])
+            if exp_group is None:
+                # Not one of the HITs in the database (see reconciliation.reconcile_hits for orphaned HITs)
+                continue
+            is_qual = exp_group.startswith('qual')
+            if event['AssignmentId'] in recorded_assignments:
+                continue
+            new_events.append(dict(event, is_qual=is_qual))
+        return new_events
+
+    def status(self):
+        return {
+            'num_events': self.num_events,
+            'num_ingested': self.num_ingested,
+            'num_skipped': self.num_skipped,
+            'num_errors': self.num_errors,
+            'max_latency_seconds': self.max_latency
+        }
+
+    def print_status(self):
+        status = self.status()
+        print(f"[{self.mturk_type} notifications] {status['num_events']} events, {status['num_ingested']} ingested, "
+              f"{status['num_skipped']} skipped, {status['num_errors']} errors, max submission-to-database "
+              f"latency {status['max_latency_seconds']:.1f}s", flush=True)
+
+    def run(self, status_interval=60, idle_sleep=1):
+        """
+        Consumes the queue until stop is called
+        :param status_interval: the seconds between status lines printed to the console, or None for no status lines
+        :param idle_sleep: the seconds to sleep when the queue is empty (SQS queues also wait for messages to arrive)
+        """
+
+        conn = db_connections.connect()
+        cursor = conn.cursor()
+        last_status = time.time()
+        try:
+            with mturk_client.request_priority('background'), mturk_client.request_workflow('notifications'):
+                while not self.stop_event.is_set():
+                    try:
+                        num_handled = self.run_once(conn, cursor)
+                    except Exception as e:
+                        print(f'Notification ingestion error: {e}')
+                        self.num_errors += 1
+                        conn.rollback()
+                        num_handled = 0
+
+                    if status_interval is not None and time.time() - last_status >= status_interval:
+                        self.print_status()
+                        last_status = time.time()
+
+                    if num_handled == 0:
+                        self.stop_event.wait(idle_sleep)
+        finally:
+            conn.close()
+
+    def start(self, **run_params):
+        """
+        Runs the ingester on a background thread
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, kwargs=run_params, name=f'notifications-{self.mturk_type}',
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingests submitted assignments from MTurk event notifications')
+    parser.add_argument('--destination', default=None,
+                        help='the queue to consume, defaults to the one in mturk_seg_vars.notification_destinations')
+    parser.add_argument('--sandbox', action='store_true', help='ingest the sandbox instead of production')
+    parser.add_argument('--register', action='store_true',
+                        help='first register every recorded HIT type to send notifications to the queue')
+    parser.add_argument('--status-interval', type=float, default=60)
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve the MTurk call metrics to prometheus on this port')
+    args = parser.parse_args()
+
+    if args.metrics_port is not None:
+        mturk_metrics.start_metrics_server(args.metrics_port)
+
+    ingester = NotificationIngester(destination=args.destination, sandbox=args.sandbox)
+    if args.register:
+        destination = args.destination or mturk_seg_vars.notification_destinations[ingester.mturk_type]
+        print(f'Registered {register_notifications(ingester.mturk, destination)} HIT types for notifications')
+    try:
+        ingester.run(status_interval=args.status_interval)
+    except KeyboardInterrupt:
+        ingester.print_status()
@@ -0,0 +1,168 @@
+"""
+The queues that MTurk notifications are consumed from (see notification_ingest.py)
+
+MTurk delivers notifications to an Amazon SQS queue. For offline use, a local directory or SQLite file can stand in for
+the queue - local_mturk.LocalMTurkState delivers its notifications to these, the same way MTurk delivers to SQS.
+
+Every queue has the same interface: send(body), receive(max_messages, visibility_timeout) returning a list of
+(receipt, body) tuples, and delete(receipt) once a message has been handled. A received message is hidden from other
+consumers until its visibility timeout passes, and is delivered again if it is not deleted by then, so each message is
+handled at least once.
+"""
+
+import os
+import sqlite3
+import time
+import uuid
+
+
+class DirectoryQueue:
+    """
+    A queue stored as one json file per message in a local directory
+    Messages are claimed by moving them into a 'claimed' subdirectory, which is atomic, so several consumers can share
+    the directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.claimed_path = os.path.join(path, 'claimed')
+        os.makedirs(self.claimed_path, exist_ok=True)
+
+    def send(self, body):
+        # Messages are written under a temporary name first, so consumers never see a partially written message
+        name = f'{time.time_ns():020d}-{uuid.uuid4().hex}.json'
+        temp_path = os.path.join(self.path, f'.{name}.tmp')
+        with open(temp_path, 'w') as f:
+            f.write(body)
+        os.replace(temp_path, os.path.join(self.path, name))
+
+    def receive(self, max_messages=10, visibility_timeout=60):
+        self.release_expired_claims(visibility_timeout)
+        messages = []
+        for name in sorted(os.listdir(self.path)):
+            if len(messages) >= max_messages:
+                break
+            if not name.endswith('.json'):
+                continue
+            claimed = os.path.join(self.claimed_path, name)
+            try:
+                os.replace(os.path.join(self.path, name), claimed)
+            except FileNotFoundError:
+                # Another consumer claimed it first
+                continue
+            os.utime(claimed)
+            with open(claimed) as f:
+                messages.append((claimed, f.read()))
+        return messages
+
+    def delete(self, receipt):
+        try:
+            os.remove(receipt)
+        except FileNotFoundError:
+            pass
+
+    def release_expired_claims(self, visibility_timeout):
+        now = time.time()
+        for name in os.listdir(self.claimed_path):
+            claimed = os.path.join(self.claimed_path, name)
+            try:
+                if now - os.path.getmtime(claimed) > visibility_timeout:
+                    os.replace(claimed, os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+
+
+class SQLiteQueue:
+    """
+    A queue stored in a table of a local SQLite file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        conn = sqlite3.connect(path)
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS notification_queue (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            body TEXT,
+            visible_at REAL
+        )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def send(self, body):
+        conn = self.connect()
+        conn.execute("INSERT INTO notification_queue (body, visible_at) VALUES (?, ?)", (body, time.time()))
+        conn.close()
+
+    def receive(self, max_messages=10, visibility_timeout=60):
+        conn = self.connect()
+        now = time.time()
+        # Claim the messages in a write transaction, so no two consumers receive the same message
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute("SELECT message_id, body FROM notification_queue WHERE visible_at <= ? "
+                            "ORDER BY message_id LIMIT ?", (now, max_messages)).fetchall()
+        conn.executemany("UPDATE notification_queue SET visible_at = ? WHERE message_id = ?",
+                         [(now + visibility_timeout, message_id) for message_id, _ in rows])
+        conn.execute("COMMIT")
+        conn.close()
+        return rows
+
+    def delete(self, receipt):
+        conn = self.connect()
+        conn.execute("DELETE FROM notification_queue WHERE message_id = ?", (receipt,))
+        conn.close()
+
+
+class SQSQueue:
+    """
+    An Amazon SQS queue, which is where MTurk delivers notifications
+    The queue's access policy must allow MTurk to send messages to it
+    """
+
+    def __init__(self, queue_url, sqs=None, wait_seconds=20):
+        """
+        :param queue_url: the URL of the queue, e.g. https://sqs.us-east-1.amazonaws.com/123456789012/mturk-events
+        :param sqs: an optional boto3 sqs client, defaults to a client for the queue's region
+        :param wait_seconds: how long each receive waits for a message to arrive (long polling)
+        """
+        if sqs is None:
+            import boto3
+            sqs = boto3.client('sqs', region_name=queue_url.split('.')[1])
+        self.queue_url = queue_url
+        self.sqs = sqs
+        self.wait_seconds = wait_seconds
+
+    def send(self, body):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=body)
+
+    def receive(self, max_messages=10, visibility_timeout=60):
+        response = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=min(max_messages, 10),
+                                            VisibilityTimeout=visibility_timeout, WaitTimeSeconds=self.wait_seconds)
+        return [(message['ReceiptHandle'], message['Body']) for message in response.get('Messages', [])]
+
+    def delete(self, receipt):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+
+def is_local_destination(destination):
+    """
+    :return: True if a notification destination is a local stand-in for an SQS queue
+    """
+    return not destination.startswith('https://')
+
+
+def open_queue(destination):
+    """
+    Opens the queue for a notification destination
+    :param destination: an SQS queue URL, 'sqlite:<path>' for a SQLiteQueue, or a directory path for a DirectoryQueue
+    :return: the queue
+    """
+    if not is_local_destination(destination):
+        return SQSQueue(destination)
+    if destination.startswith('sqlite:'):
+        return SQLiteQueue(destination[len('sqlite:'):])
+    return DirectoryQueue(destination)
@@ -0,0 +1,134 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from mturksegutils import mturk_seg_vars, rate_limiter
+
+
+class PostingProgress:
+    """
+    Tracks the number of HITs posted during a batch and reports the posting rate and estimated time remaining
+    """
+
+    def __init__(self, total=None, print_status_every_n=10, label=''):
+        """
+        :param total: the total number of HITs expected in the batch, if known
+        :param print_status_every_n: prints a status update after every N hits are posted
+        :param label: a description of the batch to include in status updates
+        """
+        self.total = total
+        self.print_status_every_n = print_status_every_n
+        self.label = label
+        self.num_posted = 0
+        self.num_failed = 0
+        self.start_time = time.monotonic()
+
+    def hits_per_second(self):
+        elapsed = time.monotonic() - self.start_time
+        return self.num_posted / elapsed if elapsed > 0 else 0.0
+
+    def eta_seconds(self):
+        rate = self.hits_per_second()
+        if self.total is None or rate == 0:
+            return None
+        return max(0, self.total - self.num_posted - self.num_failed) / rate
+
+    def update(self, succeeded=True):
+        """
+        Records the outcome of one HIT request and prints a status update at the configured interval
+        :param succeeded: True if the HIT was posted, False if the request failed
+        """
+        if succeeded:
+            self.num_posted += 1
+        else:
+            self.num_failed += 1
+        if self.print_status_every_n and (self.num_posted + self.num_failed) % self.print_status_every_n == 0:
+            self.report()
+
+    def report(self):
+        total = self.total if self.total is not None else '?'
+        eta = self.eta_seconds()
+        eta_string = f'{eta:.0f}s' if eta is not None else 'unknown'
+        print(f"Created HIT {self.num_posted} of {total} {self.label}"
+              f"({self.hits_per_second():.2f} HITs/s, {self.num_failed} failed, ETA {eta_string})")
+
+
+def post_hits(request_func, jobs, num_workers=None, requests_per_second=None, max_retries=5):
+    """
+    Sends HIT requests to MTurk from a bounded pool of worker threads behind a shared token bucket
+    Results are yielded back to the calling thread as they complete, so that the caller can remain the only
+    thread that writes to the database
+
+    :param request_func: a function that takes a dict of HIT parameters and sends it to MTurk, e.g. mturk.create_hit
+    :param jobs: an iterable of (hit_params, record) tuples, where record is any data the caller needs to store the HIT
+    :param num_workers: the max number of concurrent requests, defaults to mturk_seg_vars.posting_num_workers
+    :param requests_per_second: the target request rate, defaults to mturk_seg_vars.posting_requests_per_second
+    :param max_retries: the number of times to retry a throttled request before reporting it as failed
+    :return: a generator of (record, response, error) tuples, where exactly one of response and error is None
+    """
+
+    if num_workers is None:
+        num_workers = mturk_seg_vars.posting_num_workers
+    if requests_per_second is None:
+        requests_per_second = mturk_seg_vars.posting_requests_per_second
+    return send_requests(request_func, jobs, num_workers, requests_per_second, max_retries)
+
+
+def fetch_results(request_func, jobs, num_workers=None, requests_per_second=None, max_retries=5):
+    """
+    Sends read requests to MTurk, e.g. mturk.list_assignments_for_hit, in the same way as post_hits
+    The number of workers and the rate default to mturk_seg_vars.sync_num_workers and sync_requests_per_second
+    :return: a generator of (record, response, error) tuples, where exactly one of response and error is None
+    """
+
+    if num_workers is None:
+        num_workers = mturk_seg_vars.sync_num_workers
+    if requests_per_second is None:
+        requests_per_second = mturk_seg_vars.sync_requests_per_second
+    return send_requests(request_func, jobs, num_workers, requests_per_second, max_retries)
+
+
+def send_requests(request_func, jobs, num_workers, requests_per_second, max_retries=5):
+    """
+    Sends requests to MTurk from a bounded pool of worker threads behind a shared token bucket
+    :param request_func: the client method to call
+    :param jobs: an iterable of (params, record) tuples, where params are passed to request_func as keyword arguments
+    :param num_workers: the max number of concurrent requests
+    :param requests_per_second: the target request rate
+    :param max_retries: the number of times to retry a throttled request before reporting it as failed
+    :return: a generator of (record, response, error) tuples, in the order the requests complete
+    """
+
+    limiter = rate_limiter.TokenBucket(requests_per_second)
+
+    def send(params):
+        return rate_limiter.call_with_backoff(request_func, rate_limiter=limiter, max_retries=max_retries, **params)
+
+    # Jobs are read lazily so that only a bounded number of requests are ever held in memory
+    max_in_flight = num_workers * 2
+    jobs = iter(jobs)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    params, record = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                # Each request runs in a copy of the caller's context, so it keeps the caller's request priority and
+                # workflow (see mturk_client.request_priority and request_workflow)
+                in_flight[executor.submit(contextvars.copy_context().run, send, params)] = record
+
+            if not in_flight:
+                return
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = in_flight.pop(future)
+                error = future.exception()
+                if error is not None:
+                    yield record, None, error
+                else:
+                    yield record, future.result(), None
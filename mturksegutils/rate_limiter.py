@@ -0,0 +1,253 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+# The MTurk error codes that indicate a request was rejected because the account is sending requests too quickly
+throttling_error_codes = ('ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded')
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket for limiting the rate of MTurk API requests
+    Tokens refill continuously at `rate` tokens per second, up to a maximum of `capacity` tokens
+    The refill rate can be lowered when MTurk reports throttling and gradually restored as requests succeed
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.5):
+        """
+        :param rate: the target number of requests per second
+        :param capacity: the maximum burst size, defaults to one second's worth of tokens
+        :param min_rate: the lowest rate the bucket will back off to when throttled
+        """
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.max_rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.last_backoff = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until the requested number of tokens is available and then consumes them
+        :param tokens: the number of tokens to consume
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def on_throttled(self, factor=0.5, cooldown=1.0):
+        """
+        Multiplicatively lowers the refill rate after MTurk reports throttling, and drains any saved-up burst
+        Several concurrent requests are usually throttled together, so the rate is lowered at most once per cooldown
+        :param factor: the fraction of the current rate to keep
+        :param cooldown: the minimum number of seconds between two reductions of the rate
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+            if self.last_refill - self.last_backoff >= cooldown:
+                self.rate = max(self.min_rate, self.rate * factor)
+                self.last_backoff = self.last_refill
+
+    def on_success(self, step=None):
+        """
+        Additively restores the refill rate towards its maximum after a successful request
+        :param step: the number of requests per second to add back to the rate, defaults to 5% of the max rate
+        """
+        if step is None:
+            step = self.max_rate * 0.05
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + step)
+
+
+class SharedRequestBudget:
+    """
+    A token bucket for MTurk requests that is shared by every process using the same budget file
+    The bucket state lives in a small SQLite database, and each request takes a token inside an IMMEDIATE transaction, so
+    the review app, sync scripts, batch posting and auto-approval scripts all draw from one budget
+
+    Each priority level may only take a token while the bucket holds more than its reserved fraction of the capacity,
+    which keeps part of the budget free for interactive calls while background jobs are running
+    """
+
+    def __init__(self, budget_path, rate, capacity=None, reserved_fractions=None):
+        """
+        :param budget_path: the path to the SQLite file that stores the bucket
+        :param rate: the number of requests per second allowed across all processes
+        :param capacity: the maximum burst size, defaults to two seconds' worth of tokens
+        :param reserved_fractions: a dictionary mapping each priority to the fraction of the bucket it must leave untouched
+        """
+        self.budget_path = budget_path
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, 2 * self.rate)
+        self.reserved_fractions = reserved_fractions if reserved_fractions is not None else {'interactive': 0.0,
+                                                                                              'background': 0.5}
+        self.local = threading.local()
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads, so each thread gets its own
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.budget_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS request_budget (
+                    mturk_type TEXT PRIMARY KEY,
+                    tokens REAL,
+                    updated_at REAL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS throttle_events (
+                    event_time REAL,
+                    mturk_type TEXT,
+                    operation TEXT,
+                    priority TEXT,
+                    pid INTEGER
+                )
+            """)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def acquire(self, mturk_type, priority='background'):
+        """
+        Blocks until a token is available for the given priority and then consumes it
+        :param mturk_type: 'sandbox' or 'production' - each environment has its own bucket
+        :param priority: the priority of the request, one of the keys of reserved_fractions
+        """
+        reserve = self.capacity * self.reserved_fractions.get(priority, 0.0)
+        conn = self._connect()
+        while True:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, updated_at FROM request_budget WHERE mturk_type = ?",
+                                   (mturk_type,)).fetchone()
+                if row is None:
+                    tokens = self.capacity
+                else:
+                    tokens = min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate)
+                acquired = tokens - 1 >= reserve
+                if acquired:
+                    tokens -= 1
+                conn.execute("INSERT OR REPLACE INTO request_budget (mturk_type, tokens, updated_at) VALUES (?, ?, ?)",
+                             (mturk_type, tokens, now))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if acquired:
+                return
+            time.sleep((reserve + 1 - tokens) / self.rate)
+
+    def record_throttle(self, mturk_type, operation, priority):
+        """
+        Records that MTurk throttled a request, and empties the shared bucket so that every process slows down
+        :param mturk_type: 'sandbox' or 'production'
+        :param operation: the name of the MTurk operation that was throttled
+        :param priority: the priority of the throttled request
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT INTO throttle_events (event_time, mturk_type, operation, priority, pid) "
+                         "VALUES (?, ?, ?, ?, ?)", (now, mturk_type, operation, priority, os.getpid()))
+            conn.execute("UPDATE request_budget SET tokens = MIN(tokens, 0), updated_at = ? WHERE mturk_type = ?",
+                         (now, mturk_type))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def is_throttling_error(error):
+    """
+    Checks whether an exception raised by a boto3 client call was caused by MTurk throttling the request
+    :param error: the exception raised by the client
+    :return: True if the error is a throttling error, False otherwise
+    """
+
+    return is_throttling_response(getattr(error, 'response', None))
+
+
+def is_throttling_response(response):
+    """
+    Checks whether a parsed MTurk response is an error telling the caller to slow down
+    :param response: the parsed response dictionary
+    :return: True if the response is a throttling error, False otherwise
+    """
+
+    if not isinstance(response, dict):
+        return False
+    error_code = response.get('Error', {}).get('Code', '')
+    error_message = response.get('Error', {}).get('Message', '') or ''
+    return error_code in throttling_error_codes or 'rate exceeded' in error_message.lower()
+
+
+def client_retries_requests(func):
+    """
+    :param func: a client method, e.g. mturk.create_hit
+    :return: True if the method belongs to a botocore client that retries throttled requests itself, as the clients
+    built by mturk_client.build_mturk_client do (up to mturk_seg_vars.mturk_max_attempts)
+    """
+    config = getattr(getattr(getattr(func, '__self__', None), 'meta', None), 'config', None)
+    if config is None:
+        return False
+    # Clients built without a retry config use botocore's legacy mode, which retries
+    retries = getattr(config, 'retries', None) or {}
+    return retries.get('total_max_attempts', 2) > 1
+
+
+def call_with_backoff(func, rate_limiter=None, max_retries=5, base_delay=1.0, max_delay=60.0, **kwargs):
+    """
+    Calls an MTurk client method, waiting on the rate limiter first and retrying with exponential backoff if throttled
+    Methods of clients that retry throttled requests themselves are not retried again here, since each retry here would
+    repeat all of the client's attempts
+    :param func: the client method to call, e.g. mturk.create_hit
+    :param rate_limiter: an optional TokenBucket shared by all callers
+    :param max_retries: the number of times to retry a throttled request before giving up, if the client does not
+    retry requests itself
+    :param base_delay: the delay, in seconds, before the first retry
+    :param max_delay: the maximum delay, in seconds, between retries
+    :param kwargs: the parameters for the client method
+    :return: the response from the client method
+    """
+
+    if client_retries_requests(func):
+        max_retries = 0
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            response = func(**kwargs)
+        except Exception as e:
+            if not is_throttling_error(e) or attempt >= max_retries:
+                raise
+            if rate_limiter is not None:
+                rate_limiter.on_throttled()
+            time.sleep(min(max_delay, base_delay * (2 ** attempt)))
+            attempt += 1
+            continue
+        if rate_limiter is not None:
+            rate_limiter.on_success()
+        return response
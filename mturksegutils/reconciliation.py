@@ -0,0 +1,265 @@
+"""
+Reconciles the hits table with the HITs that actually exist on MTurk
+
+The HITs on the account are listed once into a HitIndex, which is keyed by HIT ID and by requester annotation (the
+experiment group a HIT was posted for), and the index is then diffed against the hits table:
+- orphaned: HITs on MTurk that have no row in the hits table, e.g. from a batch that was interrupted between sending a
+  request and recording the HIT
+- missing: open or submitted rows whose HIT no longer exists on MTurk, e.g. after remove_hits_early deleted it
+- mismatched: rows whose state drifted from MTurk - the HIT was posted for a different experiment group, or MTurk lists
+  submissions that have not been synced into the table yet
+
+The index is cached per environment, so lookups by requester annotation (assignment_manager.get_hits_with_annotation)
+reuse it instead of listing every HIT on the account again. Posting HITs (hit_builder) drops the cached index of its
+environment, so new HITs are listed by the next lookup. To check an experiment group:
+    python -m mturksegutils.reconciliation --exp-group 3 --apply
+"""
+
+import argparse
+import time
+
+from mturksegutils import mturk_seg_vars, mturk_client, assignment_manager, db_connections
+
+
+# The fields of each HIT kept in the index, which leaves out the (large) question content
+hit_index_fields = ('HITId', 'HITTypeId', 'RequesterAnnotation', 'HITStatus', 'MaxAssignments',
+                    'NumberOfAssignmentsAvailable', 'NumberOfAssignmentsPending', 'NumberOfAssignmentsCompleted',
+                    'CreationTime', 'Expiration')
+
+# The cached index for each environment, keyed by mturk_type
+hit_indexes = {}
+
+
+class HitIndex:
+    """
+    An in-memory index of every HIT on an MTurk account, built with a single pass over list_hits
+    """
+
+    def __init__(self, mturk_type, hits, built_at=None):
+        """
+        :param mturk_type: 'sandbox' or 'production'
+        :param hits: the HIT summaries returned by list_hits
+        :param built_at: the time the HITs were listed, in seconds since the epoch
+        """
+        self.mturk_type = mturk_type
+        self.built_at = built_at if built_at is not None else time.time()
+        self.hits_by_id = {}
+        self.hit_ids_by_annotation = {}
+        for hit in hits:
+            hit = {name: hit[name] for name in hit_index_fields if name in hit}
+            self.hits_by_id[hit['HITId']] = hit
+            self.hit_ids_by_annotation.setdefault(hit.get('RequesterAnnotation'), []).append(hit['HITId'])
+
+    @classmethod
+    def build(cls, mturk, max_results=100):
+        """
+        Lists every HIT on the account into a new index
+        :param mturk: the mturk client instance
+        :param max_results: the number of HITs to list per request (MTurk allows at most 100)
+        :return: the index
+        """
+        built_at = time.time()
+        hits = []
+        response = mturk.list_hits(MaxResults=max_results)
+        while True:
+            hits.extend(response['HITs'])
+            if len(response['HITs']) == 0 or 'NextToken' not in response:
+                break
+            response = mturk.list_hits(NextToken=response['NextToken'], MaxResults=max_results)
+        return cls(mturk_client.get_mturk_type(mturk), hits, built_at)
+
+    def __len__(self):
+        return len(self.hits_by_id)
+
+    def get_hit(self, hit_id):
+        """
+        :return: the summary of a HIT, or None if it is not on MTurk
+        """
+        return self.hits_by_id.get(hit_id)
+
+    def get_hit_ids_with_annotation(self, annotation):
+        """
+        :return: the IDs of the HITs with a particular requester annotation, in the order MTurk listed them
+        """
+        return list(self.hit_ids_by_annotation.get(annotation, []))
+
+    def get_age(self):
+        """
+        :return: the number of seconds since the HITs were listed
+        """
+        return time.time() - self.built_at
+
+
+def get_hit_index(mturk, max_age_seconds=None, refresh=False, max_results=100):
+    """
+    Returns the cached index of the HITs in an MTurk environment, listing them again if the index is too old
+    :param mturk: the mturk client instance
+    :param max_age_seconds: the oldest index to reuse, defaults to mturk_seg_vars.hit_index_max_age_seconds
+    :param refresh: if True, the HITs are always listed again
+    :param max_results: the number of HITs to list per request
+    :return: a HitIndex
+    """
+
+    if max_age_seconds is None:
+        max_age_seconds = mturk_seg_vars.hit_index_max_age_seconds
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    index = hit_indexes.get(mturk_type)
+    if refresh or index is None or index.get_age() > max_age_seconds:
+        index = HitIndex.build(mturk, max_results=max_results)
+        hit_indexes[mturk_type] = index
+    return index
+
+
+def invalidate_hit_index(mturk_type):
+    """
+    Drops the cached index of an MTurk environment, so that the next lookup lists its HITs again
+    Called after HITs are posted, since the index would otherwise not include them until it expires
+    :param mturk_type: 'sandbox' or 'production'
+    """
+    hit_indexes.pop(mturk_type, None)
+
+
+def count_submitted_assignments(hit):
+    """
+    :param hit: a HIT summary from the index
+    :return: the number of the HIT's assignments that have been submitted (including those approved or rejected since)
+    """
+    return hit.get('MaxAssignments', 1) - hit.get('NumberOfAssignmentsAvailable', 0) - \
+        hit.get('NumberOfAssignmentsPending', 0)
+
+
+def diff_hits(index, cursor, exp_group=None):
+    """
+    Diffs an index of the HITs on MTurk against the rows of the hits table for the same environment
+    :param index: a HitIndex
+    :param cursor: the database cursor
+    :param exp_group: the experiment group to diff, or None for every group
+    :return: a dictionary with the lists of 'orphaned' HIT summaries, 'missing' rows from the hits table, and
+    'mismatched' (row, HIT summary, reason) tuples, where the reason is 'exp_group' or 'unsynced_submissions'
+    """
+
+    if exp_group is None:
+        cursor.execute("SELECT hit_id, exp_group, status FROM hits WHERE mturk_type = ?", (index.mturk_type,))
+    else:
+        cursor.execute("SELECT hit_id, exp_group, status FROM hits WHERE mturk_type = ? AND exp_group = ?",
+                       (index.mturk_type, exp_group))
+    rows = cursor.fetchall()
+
+    # Look the HITs that are in a different experiment group up by ID, so they are not reported as orphaned
+    if exp_group is None:
+        candidates = index.hits_by_id.values()
+    else:
+        candidates = [index.hits_by_id[hit_id] for hit_id in index.hit_ids_by_annotation.get(exp_group, [])]
+    candidate_ids = [hit['HITId'] for hit in candidates]
+    recorded_ids = {row[0] for row in rows}
+    for start in range(0, len(candidate_ids), 500):
+        chunk = [hit_id for hit_id in candidate_ids[start:start + 500] if hit_id not in recorded_ids]
+        if len(chunk) > 0:
+            cursor.execute(f"SELECT hit_id FROM hits WHERE hit_id IN ({', '.join('?' * len(chunk))})", chunk)
+            recorded_ids.update(row[0] for row in cursor.fetchall())
+    orphaned = [hit for hit in candidates if hit['HITId'] not in recorded_ids]
+
+    missing = []
+    mismatched = []
+    open_rows = {}
+    for row in rows:
+        hit_id, row_exp_group, status = row
+        hit = index.get_hit(hit_id)
+        if hit is None:
+            # MTurk disposes of reviewed HITs after a while, so only the HITs that still need syncing count as missing
+            if status in ('Open', 'Submitted'):
+                missing.append(row)
+            continue
+        if hit.get('RequesterAnnotation') != row_exp_group:
+            mismatched.append((row, hit, 'exp_group'))
+        elif status == 'Open' and count_submitted_assignments(hit) > 0:
+            open_rows.setdefault(row_exp_group, []).append((row, hit))
+
+    # An open HIT only drifted if MTurk has more submissions than are recorded (qual HITs can have several)
+    for row_exp_group, group_rows in open_rows.items():
+        recorded_counts = assignment_manager.get_recorded_assignment_counts(
+            cursor, index.mturk_type, row_exp_group, [row[0] for row, hit in group_rows],
+            is_qual=row_exp_group.startswith('qual'))
+        for row, hit in group_rows:
+            if count_submitted_assignments(hit) > recorded_counts.get(row[0], 0):
+                mismatched.append((row, hit, 'unsynced_submissions'))
+
+    return {'orphaned': orphaned, 'missing': missing, 'mismatched': mismatched}
+
+
+def apply_fixes(mturk, conn, cursor, diff, verbose=False):
+    """
+    Fixes the rows of the hits table reported by diff_hits, in bulk:
+    - the new assignments of the HITs with unsynced submissions are added to the table
+    - open rows whose HIT no longer exists on MTurk are marked 'Deleted'
+    Orphaned HITs, rows in the wrong experiment group, and submitted rows whose HIT was deleted are only reported, since
+    MTurk does not return the task data needed to fix them
+    :param mturk: the mturk client instance for the environment that was diffed
+    :param conn: the database connection
+    :param cursor: the database cursor
+    :param diff: the result of diff_hits
+    :param verbose: whether or not to print details to the console
+    :return: the number of rows that were fixed
+    """
+
+    hit_ids_by_group = {}
+    for row, hit, reason in diff['mismatched']:
+        if reason == 'unsynced_submissions':
+            hit_ids_by_group.setdefault(row[1], []).append(row[0])
+    num_fixed = 0
+    for exp_group, hit_ids in hit_ids_by_group.items():
+        num_fixed += assignment_manager.add_new_assignments_for_hits_to_database(
+            mturk, conn, cursor, hit_ids, verbose=verbose, is_qual=exp_group.startswith('qual'))
+
+    deleted_hit_ids = [row[0] for row in diff['missing'] if row[2] == 'Open']
+    cursor.executemany("UPDATE hits SET status = 'Deleted' WHERE hit_id = ? AND status = 'Open'",
+                       [(hit_id,) for hit_id in deleted_hit_ids])
+    conn.commit()
+    return num_fixed + len(deleted_hit_ids)
+
+
+@mturk_client.request_workflow('reconciliation')
+def reconcile_hits(mturk, exp_group=None, apply=False, max_age_seconds=0, verbose=False):
+    """
+    Diffs the HITs in an MTurk environment against the hits table, and optionally fixes the rows that drifted
+    :param mturk: the mturk client instance
+    :param exp_group: the experiment group to reconcile, or None for every group
+    :param apply: if True, the fixes described in apply_fixes are made
+    :param max_age_seconds: the oldest cached index to reuse - by default the HITs are listed again
+    :param verbose: whether or not to print details to the console
+    :return: the result of diff_hits
+    """
+
+    index = get_hit_index(mturk, max_age_seconds=max_age_seconds)
+    conn = db_connections.connect()
+    cursor = conn.cursor()
+
+    diff = diff_hits(index, cursor, exp_group)
+    print(f"Listed {len(index)} {index.mturk_type} HITs: {len(diff['orphaned'])} orphaned, "
+          f"{len(diff['missing'])} missing, {len(diff['mismatched'])} mismatched")
+    if verbose:
+        for hit in diff['orphaned']:
+            print(f"Orphaned: HIT {hit['HITId']} ({hit.get('RequesterAnnotation')}, {hit['HITStatus']})")
+        for hit_id, row_exp_group, status in diff['missing']:
+            print(f"Missing: HIT {hit_id} ({row_exp_group}, {status})")
+        for (hit_id, row_exp_group, status), hit, reason in diff['mismatched']:
+            print(f"Mismatched: HIT {hit_id} ({row_exp_group}, {status}) - {reason}")
+
+    if apply:
+        num_fixed = apply_fixes(mturk, conn, cursor, diff, verbose=verbose)
+        print(f"Fixed {num_fixed} rows")
+
+    conn.close()
+    return diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Diffs the HITs on MTurk against the hits table')
+    parser.add_argument('--exp-group', default=None, help='the experiment group to reconcile, defaults to every group')
+    parser.add_argument('--sandbox', action='store_true', help='reconcile the sandbox instead of production')
+    parser.add_argument('--apply', action='store_true', help='fix the rows that drifted from MTurk')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    reconcile_hits(mturk_client.get_mturk_client(sandbox=args.sandbox), exp_group=args.exp_group, apply=args.apply,
+                   verbose=args.verbose)
@@ -0,0 +1,352 @@
+"""
+A long-running scheduler that keeps the hits table in sync with MTurk in the background
+
+Assignments are approved automatically once their auto_approve_time passes, so work that is not synced and reviewed in
+time escapes review. The scheduler keeps a queue of sync jobs ordered by the deadline they protect, and works through
+the jobs nearest their deadline first, at a steady rate within the request budget:
+- a 'discover' job for each experiment group runs an incremental sync (assignment_manager.sync_reviewable_hits_to_db),
+  which finds new submissions on the group's open HITs - any submission made since the last pass auto-approves at the
+  earliest one auto-approval delay after it, which is the job's deadline
+- a 'submitted' job for each submitted assignment (every assignment of a HIT posted with several) marks it as approved
+  once its auto_approve_time has passed (see assignment_manager.infer_auto_approved_hits), and only asks MTurk about
+  assignments whose auto_approve_time is unknown
+
+Run it alongside the review app, which shows reviewers the submitted HITs nearest their auto_approve_time first:
+    python -m mturksegutils.sync_scheduler --exp-groups 3,4
+"""
+
+import argparse
+import heapq
+import itertools
+import threading
+import time
+
+from mturksegutils import mturk_seg_vars, mturk_client, assignment_manager, database_builder, hit_builder, \
+    rate_limiter, mturk_metrics, db_connections
+
+
+class RateLimitedClient:
+    """
+    Wraps an mturk client so that every call waits on a token bucket, which spreads the calls evenly over time
+    """
+
+    def __init__(self, mturk, limiter):
+        self.mturk = mturk
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attribute = getattr(self.mturk, name)
+        if not callable(attribute):
+            return attribute
+
+        def limited_call(*args, **kwargs):
+            self.limiter.acquire()
+            return attribute(*args, **kwargs)
+
+        return limited_call
+
+
+class SyncScheduler:
+    """
+    Syncs the open HITs and submitted assignments of one MTurk environment, nearest deadline first
+    Jobs wait in one queue until they are due (not_before), and due jobs are run from a second queue in deadline order
+    """
+
+    def __init__(self, exp_groups=None, sandbox=False, mturk=None, requests_per_second=None, discovery_interval=None,
+                 review_horizon=None, batch_size=None, recheck_interval=3600):
+        """
+        :param exp_groups: the experiment groups to sync, or None for every group with open or submitted HITs
+        :param sandbox: True to sync the sandbox environment, False for production
+        :param mturk: an optional mturk client to use instead of the shared client
+        :param requests_per_second: the rate the scheduler spreads its calls at, defaults to
+        mturk_seg_vars.sync_scheduler_requests_per_second
+        :param discovery_interval: the seconds between discovery passes over each group, defaults to
+        mturk_seg_vars.sync_scheduler_discovery_interval
+        :param review_horizon: submitted assignments due to auto-approve within this many seconds are reported as at
+        risk, defaults to mturk_seg_vars.sync_scheduler_review_horizon
+        :param batch_size: the max number of jobs run together, defaults to mturk_seg_vars.sync_scheduler_batch_size
+        :param recheck_interval: the seconds to wait before checking a submitted assignment again, if MTurk has not yet
+        approved it when its auto_approve_time passes
+        """
+
+        if mturk is None:
+            mturk = mturk_client.get_mturk_client(sandbox=sandbox)
+        if requests_per_second is None:
+            requests_per_second = mturk_seg_vars.sync_scheduler_requests_per_second
+        self.mturk = RateLimitedClient(mturk, rate_limiter.TokenBucket(requests_per_second))
+        self.mturk_type = mturk_client.get_mturk_type(mturk)
+        self.exp_groups = list(exp_groups) if exp_groups is not None else None
+        self.requests_per_second = requests_per_second
+        self.discovery_interval = discovery_interval if discovery_interval is not None else \
+            mturk_seg_vars.sync_scheduler_discovery_interval
+        self.review_horizon = review_horizon if review_horizon is not None else \
+            mturk_seg_vars.sync_scheduler_review_horizon
+        self.batch_size = batch_size if batch_size is not None else mturk_seg_vars.sync_scheduler_batch_size
+        self.recheck_interval = recheck_interval
+
+        # waiting holds (not_before, deadline, sequence, job) and ready holds (deadline, not_before, sequence, job)
+        self.waiting = []
+        self.ready = []
+        self.queued = set()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.last_load = None
+
+        self.num_synced = 0
+        self.num_errors = 0
+        self.max_lag = 0.0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def schedule(self, job, not_before, deadline):
+        """
+        Queues a job, unless it is already queued
+        :param job: a ('discover', exp_group) or ('submitted', assignment_id) tuple
+        :param not_before: the time, in seconds since the epoch, before which the job should not run
+        :param deadline: the time by which the job should have run
+        """
+        # A job is never due before it is queued, so that the lag only measures the time jobs wait on the scheduler
+        not_before = max(not_before, time.time())
+        with self.lock:
+            if job in self.queued:
+                return
+            self.queued.add(job)
+            heapq.heappush(self.waiting, (not_before, deadline, next(self.sequence), job))
+
+    def load(self, cursor, exp_group=None):
+        """
+        Queues a job for every experiment group with open HITs and every submitted assignment in the database
+        Jobs that are already queued are left as they are, so this can be called again to pick up new submissions
+        :param cursor: the database cursor
+        :param exp_group: an optional experiment group to load, instead of every group the scheduler syncs
+        """
+
+        now = time.time()
+        exp_groups = [exp_group] if exp_group is not None else self.exp_groups
+        group_filter, group_params = '', ()
+        if exp_groups is not None:
+            group_filter = f" AND hits.exp_group IN ({', '.join('?' * len(exp_groups))})"
+            group_params = tuple(exp_groups)
+
+        # A group that has never had a complete discovery pass is overdue
+        cursor.execute("SELECT DISTINCT exp_group FROM hits WHERE mturk_type = ? AND status = 'Open'" + group_filter,
+                       (self.mturk_type, *group_params))
+        open_groups = [row[0] for row in cursor.fetchall()]
+        for open_group in open_groups:
+            last_pass = self.get_last_discovery_pass(cursor, open_group)
+            if last_pass is None:
+                self.schedule(('discover', open_group), now, now)
+            else:
+                self.schedule(('discover', open_group), last_pass + self.discovery_interval,
+                              last_pass + hit_builder.auto_approval_delay_in_seconds)
+
+        cursor.execute("SELECT assignments.assignment_id, assignments.auto_approve_time FROM assignments "
+                       "JOIN hits ON hits.hit_id = assignments.hit_id "
+                       "WHERE assignments.mturk_type = ? AND assignments.status = 'Submitted'" + group_filter,
+                       (self.mturk_type, *group_params))
+        for assignment_id, auto_approve_time in cursor.fetchall():
+            deadline = assignment_manager.parse_auto_approve_time(auto_approve_time)
+            deadline = deadline.timestamp() if deadline is not None else now
+            self.schedule(('submitted', assignment_id), deadline, deadline)
+
+        if exp_group is None:
+            self.last_load = now
+
+    def get_last_discovery_pass(self, cursor, exp_group):
+        """
+        :return: the time, in seconds since the epoch, of the oldest complete incremental sync pass over the group's HIT
+        types, or None if any of them has never completed one
+        """
+        database_builder.create_sync_state_table(cursor)
+        cursor.execute("SELECT last_synced_at FROM sync_state WHERE mturk_type = ? AND exp_group = ?",
+                       (self.mturk_type, exp_group))
+        passes = [assignment_manager.parse_auto_approve_time(row[0]) for row in cursor.fetchall()]
+        if len(passes) == 0 or None in passes:
+            return None
+        return min(passes).timestamp()
+
+    def take_due_jobs(self, now):
+        """
+        Moves the jobs that are due from the waiting queue to the ready queue, and takes a batch of the ready jobs
+        nearest their deadlines
+        :return: a list of (deadline, not_before, job) tuples
+        """
+        with self.lock:
+            while len(self.waiting) > 0 and self.waiting[0][0] <= now:
+                not_before, deadline, sequence, job = heapq.heappop(self.waiting)
+                heapq.heappush(self.ready, (deadline, not_before, sequence, job))
+
+            batch = []
+            while len(self.ready) > 0 and len(batch) < self.batch_size:
+                deadline, not_before, _, job = heapq.heappop(self.ready)
+                self.queued.discard(job)
+                batch.append((deadline, not_before, job))
+            return batch
+
+    def run_once(self, conn, cursor):
+        """
+        Runs one batch of due jobs
+        :return: the number of jobs that were run
+        """
+
+        now = time.time()
+        if self.last_load is None or now - self.last_load >= self.discovery_interval:
+            self.load(cursor)
+
+        batch = self.take_due_jobs(now)
+        if len(batch) == 0:
+            return 0
+        self.max_lag = max(self.max_lag, max(now - not_before for _, not_before, _ in batch))
+
+        # Discovery passes are run one at a time, since each one pages through a group's reviewable HITs
+        for _, _, job in batch:
+            if job[0] != 'discover':
+                continue
+            exp_group = job[1]
+            try:
+                assignment_manager.sync_reviewable_hits_to_db(self.mturk, conn, cursor, exp_group)
+                self.num_synced += 1
+                finished = time.time()
+                self.schedule(job, finished + self.discovery_interval,
+                              finished + hit_builder.auto_approval_delay_in_seconds)
+            except Exception as e:
+                print(f'Failed to sync the reviewable HITs of {exp_group}: {e}')
+                self.num_errors += 1
+                self.schedule(job, time.time() + self.recheck_interval, time.time())
+            # Queue the submitted assignments the pass found
+            self.load(cursor, exp_group)
+
+        # Submitted assignments past their auto_approve_time are marked as approved locally, and only the assignments
+        # whose auto_approve_time cannot be read are checked with MTurk, together, through the concurrent fetch in
+        # update_status_of_submitted_hits
+        assignment_ids = [job[1] for _, _, job in batch if job[0] == 'submitted']
+        if len(assignment_ids) > 0:
+            self.num_synced += assignment_manager.infer_auto_approved_hits(cursor, self.mturk_type,
+                                                                           assignment_ids=assignment_ids)
+            conn.commit()
+            rows = [row for row in assignment_manager.select_submitted_assignments(cursor, self.mturk_type,
+                                                                                   assignment_ids=assignment_ids)
+                    if assignment_manager.auto_approve_timestamp(row[9]) is None]
+            assignment_manager.update_status_of_submitted_hits(self.mturk, conn, cursor, rows)
+            self.num_synced += len(rows)
+
+            # Assignments within the grace period of their auto_approve_time are inferred on a later check
+            for row in assignment_manager.select_submitted_assignments(cursor, self.mturk_type,
+                                                                       assignment_ids=assignment_ids):
+                self.schedule(('submitted', row[8]), time.time() + self.recheck_interval, time.time())
+
+        return len(batch)
+
+    def status(self):
+        """
+        :return: a dictionary describing the scheduler's backlog and how far behind schedule it is
+        - backlog: the number of jobs that are due but have not run yet
+        - lag_seconds: how long the oldest due job has been waiting to run
+        - max_lag_seconds: the longest any job has waited to run since the scheduler started
+        - next_deadline_seconds: the seconds until the nearest deadline of any queued job (negative if it has passed)
+        - num_at_risk: the submitted assignments that auto-approve within the review horizon
+        - num_queued, num_synced, num_errors: the number of queued jobs, synced assignments and groups, and failed
+        jobs
+        """
+
+        now = time.time()
+        with self.lock:
+            # Each entry as (not_before, deadline, job)
+            entries = [(not_before, deadline, job) for deadline, not_before, _, job in self.ready] + \
+                      [(not_before, deadline, job) for not_before, deadline, _, job in self.waiting]
+        due = [not_before for not_before, _, _ in entries if not_before <= now]
+        deadlines = [deadline for _, deadline, _ in entries]
+        num_at_risk = sum(1 for _, deadline, job in entries
+                          if job[0] == 'submitted' and deadline - now <= self.review_horizon)
+        num_queued = len(entries)
+
+        return {
+            'backlog': len(due),
+            'lag_seconds': now - min(due) if len(due) > 0 else 0.0,
+            'max_lag_seconds': self.max_lag,
+            'next_deadline_seconds': min(deadlines) - now if len(deadlines) > 0 else None,
+            'num_at_risk': num_at_risk,
+            'num_queued': num_queued,
+            'num_synced': self.num_synced,
+            'num_errors': self.num_errors,
+            'requests_per_second': self.requests_per_second
+        }
+
+    def print_status(self):
+        status = self.status()
+        next_deadline = status['next_deadline_seconds']
+        next_deadline = f"{next_deadline / 3600:.1f}h" if next_deadline is not None else 'none'
+        print(f"[{self.mturk_type} sync] backlog {status['backlog']}, lag {status['lag_seconds']:.0f}s, "
+              f"{status['num_at_risk']} at risk, next deadline in {next_deadline}, {status['num_queued']} queued, "
+              f"{status['num_synced']} synced, {status['num_errors']} errors", flush=True)
+
+    def run(self, status_interval=60, idle_sleep=5):
+        """
+        Runs jobs until stop is called
+        :param status_interval: the seconds between status lines printed to the console, or None for no status lines
+        :param idle_sleep: the max seconds to sleep when no jobs are due
+        """
+
+        conn = db_connections.connect()
+        cursor = conn.cursor()
+        last_status = time.time()
+        try:
+            with mturk_client.request_priority('background'), mturk_client.request_workflow('scheduler'):
+                while not self.stop_event.is_set():
+                    try:
+                        num_run = self.run_once(conn, cursor)
+                    except Exception as e:
+                        print(f'Sync scheduler error: {e}')
+                        self.num_errors += 1
+                        conn.rollback()
+                        num_run = 0
+
+                    if status_interval is not None and time.time() - last_status >= status_interval:
+                        self.print_status()
+                        last_status = time.time()
+
+                    if num_run == 0:
+                        with self.lock:
+                            wait_time = self.waiting[0][0] - time.time() if len(self.waiting) > 0 else idle_sleep
+                        self.stop_event.wait(min(idle_sleep, max(0.0, wait_time)))
+        finally:
+            conn.close()
+
+    def start(self, **run_params):
+        """
+        Runs the scheduler on a background thread
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, kwargs=run_params, name=f'sync-scheduler-{self.mturk_type}',
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keeps the database in sync with MTurk, nearest deadline first')
+    parser.add_argument('--exp-groups', default=None, help='a comma separated list of experiment groups to sync')
+    parser.add_argument('--sandbox', action='store_true', help='sync the sandbox instead of production')
+    parser.add_argument('--requests-per-second', type=float, default=None)
+    parser.add_argument('--discovery-interval', type=float, default=None,
+                        help='seconds between discovery passes over each experiment group')
+    parser.add_argument('--status-interval', type=float, default=60)
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve the MTurk call metrics to prometheus on this port')
+    args = parser.parse_args()
+
+    if args.metrics_port is not None:
+        mturk_metrics.start_metrics_server(args.metrics_port)
+    exp_groups = [group.strip() for group in args.exp_groups.split(',')] if args.exp_groups else None
+    scheduler = SyncScheduler(exp_groups=exp_groups, sandbox=args.sandbox, requests_per_second=args.requests_per_second,
+                              discovery_interval=args.discovery_interval)
+    try:
+        scheduler.run(status_interval=args.status_interval)
+    except KeyboardInterrupt:
+        scheduler.print_status()
@@ -1,5 +1,9 @@
 import csv
-from mturksegutils import mturk_seg_vars, mturk_client
+import datetime
+import sqlite3
+import threading
+
+from mturksegutils import mturk_seg_vars, mturk_client, database_builder, db_connections
 
 """
 There are three quals that are used to manage worker enrollment in tasks
@@ -15,6 +19,11 @@ main_seg_qual_name = mturk_seg_vars.main_seg_qual_name
 any_object_count_qual_name = mturk_seg_vars.any_object_count_qual_name
 invite_only_qual_name = mturk_seg_vars.invite_only_qual_name
 vocab_score_requirement = 80
+db_path = mturk_seg_vars.db_path
+
+# Qualification type IDs, keyed by (mturk_type, qual_name), so they only need to be looked up once per process
+qual_id_cache = {}
+qual_id_cache_lock = threading.Lock()
 
 
 def get_task_qualification_set(mturk, qual_criteria=1, invite_only=False):
@@ -123,23 +132,131 @@ def assign_qualification_to_worker(mturk, worker_id, qual_type_id, integer_value
 def get_qual_id(mturk, qual_name):
     """
     Gets the type ID for given qualification name
+    IDs are cached in memory and in the qualification_types table, so MTurk is only queried the first time a name is seen
     :param mturk: the mturk client instance
     :param qual_name: the name of the qualification to get the ID for
     :return: the qualification type ID
     """
 
-    # Query MTurk for the qualification name
-    response = mturk.list_qualification_types(
-        Query=qual_name,
-        MustBeRequestable=False,
-        MustBeOwnedByCaller=True
-    )
+    mturk_type = mturk_client.get_mturk_type(mturk)
+    key = (mturk_type, qual_name)
+    if key in qual_id_cache:
+        return qual_id_cache[key]
+
+    with qual_id_cache_lock:
+        if key not in qual_id_cache:
+            # Check the database before going to MTurk, and if the name is not there, refresh every owned qual at once
+            qual_ids = load_qual_ids_from_database(mturk_type)
+            if qual_name not in qual_ids:
+                qual_ids = list_owned_qual_ids(mturk)
+                save_qual_ids_to_database(mturk_type, qual_ids)
+            for name, qual_type_id in qual_ids.items():
+                qual_id_cache[(mturk_type, name)] = qual_type_id
+
+    if key not in qual_id_cache:
+        raise ValueError(f"No qualification type named '{qual_name}' is owned by this requester in {mturk_type}")
+    return qual_id_cache[key]
+
+
+def list_owned_qual_ids(mturk):
+    """
+    Pages through all of the qualification types owned by the requester in a single pass
+    :param mturk: the mturk client instance
+    :return: a dictionary mapping each qualification name to its type ID
+    """
+
+    qual_ids = {}
+    request_params = {
+        'MustBeRequestable': False,
+        'MustBeOwnedByCaller': True,
+        'MaxResults': 100
+    }
+    while True:
+        response = mturk.list_qualification_types(**request_params)
+        for qualification in response['QualificationTypes']:
+            # Disposed qualification types keep their name, so do not let them shadow an active one
+            if qualification['Name'] in qual_ids and qualification.get('QualificationTypeStatus') != 'Active':
+                continue
+            qual_ids[qualification['Name']] = qualification['QualificationTypeId']
 
-    # Extract qualification details from the response
-    qualifications = response['QualificationTypes']
-    return qualifications[0]['QualificationTypeId']
+        # Check if there are more results to fetch
+        if 'NextToken' in response and len(response['QualificationTypes']) > 0:
+            request_params['NextToken'] = response['NextToken']
+        else:
+            return qual_ids
 
 
+def load_qual_ids_from_database(mturk_type):
+    """
+    Reads the cached qualification type IDs for an MTurk environment from the qualification_types table
+    :param mturk_type: 'sandbox' or 'production'
+    :return: a dictionary mapping each qualification name to its type ID
+    """
+
+    conn = db_connections.connect(db_path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT qual_name, qual_type_id FROM qualification_types WHERE mturk_type = ?", (mturk_type,))
+        return dict(cursor.fetchall())
+    except sqlite3.OperationalError:
+        # The table has not been created yet
+        return {}
+    finally:
+        conn.close()
+
+
+def save_qual_ids_to_database(mturk_type, qual_ids):
+    """
+    Replaces the cached qualification type IDs for an MTurk environment in the qualification_types table
+    :param mturk_type: 'sandbox' or 'production'
+    :param qual_ids: a dictionary mapping each qualification name to its type ID
+    """
+
+    updated_at = datetime.datetime.now()
+    try:
+        # A short timeout, since waiting on a write transaction held by the caller can only end in the same error
+        conn = db_connections.connect(db_path, timeout=5)
+        cursor = conn.cursor()
+        database_builder.create_qualification_types_table(cursor)
+        cursor.execute("DELETE FROM qualification_types WHERE mturk_type = ?", (mturk_type,))
+        cursor.executemany("INSERT INTO qualification_types (mturk_type, qual_name, qual_type_id, updated_at) "
+                           "VALUES (?, ?, ?, ?)",
+                           [(mturk_type, name, qual_type_id, updated_at) for name, qual_type_id in qual_ids.items()])
+        conn.commit()
+        conn.close()
+    except sqlite3.OperationalError as e:
+        # The caller may be holding an open write transaction on the database - the IDs are still cached in memory
+        print(f'Could not save qualification type IDs to the database: {e}')
+
+
+def invalidate_qual_id_cache(mturk_type=None):
+    """
+    Clears the cached qualification type IDs, e.g. after a qualification type has been created, renamed or disposed
+    The next call to get_qual_id will fetch the IDs from MTurk again
+    :param mturk_type: 'sandbox' or 'production' to only clear one environment, or None to clear both
+    """
+
+    with qual_id_cache_lock:
+        for key in list(qual_id_cache.keys()):
+            if mturk_type is None or key[0] == mturk_type:
+                del qual_id_cache[key]
+
+        conn = db_connections.connect(db_path)
+        cursor = conn.cursor()
+        try:
+            if mturk_type is None:
+                cursor.execute("DELETE FROM qualification_types")
+            else:
+                cursor.execute("DELETE FROM qualification_types WHERE mturk_type = ?", (mturk_type,))
+            conn.commit()
+        except sqlite3.OperationalError:
+            # The table has not been created yet, so there is nothing to clear
+            pass
+        finally:
+            conn.close()
+
+
+@mturk_client.request_workflow('quals')
 def assign_qualifications_to_consent_and_vocab_batch(mturk, batch_csv_file):
     """
     Reads the csv file containing results of a screening qualifier batch (consent form + vocab quiz)
@@ -173,6 +290,7 @@ def assign_qualifications_to_consent_and_vocab_batch(mturk, batch_csv_file):
                 assign_qualification_to_worker(mturk, worker_id, duke_hal_seg_qual_id, integer_value=1)
 
 
+@mturk_client.request_workflow('quals')
 def pass_list_of_workers(passing_workers, qual_id, qual_score):
     """
     Assigns the specified qualification to the workers in the list
@@ -182,7 +300,7 @@ def pass_list_of_workers(passing_workers, qual_id, qual_score):
     """
 
     # Establish a connection to MTurk
-    mturk = mturk_client.create_mturk_instance(sandbox=False)
+    mturk = mturk_client.get_mturk_client(sandbox=False)
 
     for worker_id in passing_workers:
 